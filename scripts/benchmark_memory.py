@@ -0,0 +1,66 @@
+import os
+import sys
+import time
+import argparse
+import resource
+import multiprocessing
+
+from copy import deepcopy
+from pathlib import Path
+
+"""
+Peak RSS of handing geometry between the normalization / denormalization stages of the pipeline,
+either as deep copied point clouds (as Pipeline.run used to) or as shared read-only arrays (as it does now).
+The registration stages are left out since they do not depend on how their inputs are handed over.
+"""
+
+SRC = Path(__file__).parent.parent.joinpath('src')
+
+
+def run(path: str, mode: str, queue):
+  # the pipeline modules resolve configs relative to src/
+  sys.path.insert(0, str(SRC))
+  os.chdir(SRC)
+  from organ import Organ
+  from steps import normalize_rigid, normalize_nonrigid, denormalize_nonrigid, denormalize_rigid
+  from utils.conversions import readonly
+
+  organ = Organ(path)
+  baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  start = time.perf_counter()
+
+  handoff = deepcopy if mode == 'copy' else (lambda geometry: geometry)
+  geometry = organ.pointcloud if mode == 'copy' else readonly(organ)
+
+  rigid = normalize_rigid(source=handoff(geometry), target=handoff(geometry))
+  nonrigid = normalize_nonrigid(source=handoff(rigid.output['Source']), target=handoff(rigid.output['Target']))
+  denormalized = denormalize_nonrigid(source=handoff(nonrigid.output['Source']), 
+                                      target=handoff(nonrigid.output['Source']), 
+                                      transforms=nonrigid.transform)
+  denormalize_rigid(source=handoff(denormalized.output['Source']), 
+                    target=handoff(denormalized.output['Source']), 
+                    transforms=rigid.transform)
+
+  # ru_maxrss is in kilobytes on Linux
+  queue.put({'mode': mode, 
+             'vertices': len(organ.vertices), 
+             'seconds': time.perf_counter() - start, 
+             'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 
+             'peak_rss_delta_mb': (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline) / 1024})
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Benchmark peak memory of the geometry handoff between pipeline stages')
+  parser.add_argument('path', help='Path to the organ to benchmark with (e.g. data/Heart/Source/humanHeart1.vtk)')
+  args = parser.parse_args()
+
+  # a fresh process per mode so that the peak RSS of one does not hide the other
+  context = multiprocessing.get_context('spawn')
+  for mode in ['copy', 'shared']:
+    queue = context.Queue()
+    process = context.Process(target=run, args=(str(Path(args.path).resolve()), mode, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    print(f"{result['mode']:>6}: {result['vertices']} vertices, {result['seconds']:.2f} s, "
+          f"peak RSS {result['peak_rss_mb']:.1f} MB (+{result['peak_rss_delta_mb']:.1f} MB over the loaded organ)")
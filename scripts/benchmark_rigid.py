@@ -0,0 +1,73 @@
+import os
+import sys
+import time
+import argparse
+import numpy as np
+
+from pathlib import Path
+
+"""
+Single-scale (FPFH + RANSAC at `voxel_size`, then one point-to-plane ICP) against multi-scale (RANSAC at the coarsest
+level of a voxel pyramid, then ICP warm-started at every finer level) rigid registration on the bundled organs.
+Both are scored on the full resolution organs: ICP fitness / inlier RMSE at the refine threshold and the mean
+distance from the registered source to the target surface, in the unit normalized space of the pipeline.
+"""
+
+SRC = Path(__file__).parent.parent.joinpath('src')
+DATA = Path(__file__).parent.parent.joinpath('data')
+PAIRS = {'Kidney': ('Kidney/Source/VH_F_Kidney_R.glb', 'Kidney/Reference/VH_M_Kidney_R.glb'),
+         'Heart': ('Heart/Source/humanHeart_M.glb', 'Heart/Reference/VH_M_Heart.glb'),
+         'Colon': ('Colon/Source/VHM_Colon_Low_path-bs-s.stl', 'Colon/Reference/SBU_M_Intestine_Large.glb')}
+
+# the pipeline modules resolve configs relative to src/
+sys.path.insert(0, str(SRC))
+os.chdir(SRC)
+import open3d as o3d
+
+from organ import Organ
+from utils.io import read_yaml
+from utils.conversions import readonly, to_mesh, to_pointcloud
+from utils.metrics import error_field
+from steps import normalize_rigid, global_registration, refine_registration, multiscale_registration
+
+
+def single(source, target, params):
+  global_step = global_registration(source=source, target=target, params=params)
+  return refine_registration(source=source, target=target, transform=global_step.transform, params=params), [global_step]
+
+def multiscale(source, target, params):
+  return multiscale_registration(source=source, target=target, params=params), []
+
+def score(step, target, target_faces, source_faces, params):
+  # full resolution agreement at the single-scale refine threshold
+  threshold = params['voxel_size'] * params['refine_distance_threshold_factor']
+  evaluation = o3d.pipelines.registration.evaluate_registration(to_pointcloud(step.output['Source']), to_pointcloud(target), threshold)
+  field = error_field(to_mesh(np.asarray(target), target_faces, process=False), 
+                      to_mesh(np.asarray(step.output['Source']), source_faces, process=False), 
+                      symmetric=False)
+  return evaluation.fitness, evaluation.inlier_rmse, field.statistics['mean_distance']
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Benchmark single-scale against multi-scale rigid registration')
+  parser.add_argument('--organs', nargs='*', default=list(PAIRS), choices=list(PAIRS), help='Organs to benchmark')
+  parser.add_argument('--params', default=str(SRC.parent.joinpath('configs', 'params.yaml')), help='Pipeline params')
+  parser.add_argument('--repeats', type=int, default=3, help='Runs per mode (RANSAC is randomized)')
+  args = parser.parse_args()
+
+  params = read_yaml(args.params)['rigid_registration']
+  modes = {'single': single, 'multiscale': multiscale}
+  print(f"{'organ':>8} {'mode':>11} {'points':>15} {'seconds':>8} {'fitness':>8} {'rmse':>9} {'mean dist':>10} {'levels':>7}")
+  for organ in args.organs:
+    source, target = (Organ(str(DATA.joinpath(path))) for path in PAIRS[organ])
+    normalized = normalize_rigid(source=readonly(source), target=readonly(target))
+    source_array, target_array = normalized.output['Source'], normalized.output['Target']
+
+    for mode, register in modes.items():
+      for _ in range(args.repeats):
+        start = time.perf_counter()
+        step, _ = register(source_array, target_array, params)
+        seconds = time.perf_counter() - start
+        fitness, rmse, distance = score(step, target_array, target.faces, source.faces, params)
+        levels = len(step.output.get('Levels', [])) or '-'
+        print(f"{organ:>8} {mode:>11} {f'{len(source_array)}/{len(target_array)}':>15} {seconds:>8.2f} {fitness:>8.3f} {rmse:>9.5f} {distance:>10.5f} {levels:>7}")
@@ -0,0 +1,42 @@
+import sys
+import time
+import argparse
+import tracemalloc
+import numpy as np
+
+from pathlib import Path
+
+"""
+Peak memory and time of the blocked Sinkhorn distance (and the sliced Wasserstein check) as the point count grows.
+Memory should stay flat, set by the tile size, while a dense cost matrix would grow quadratically.
+"""
+
+sys.path.insert(0, str(Path(__file__).parent.parent.joinpath('src')))
+from utils.metrics import sinkhorn_points, sliced_wasserstein_points
+
+
+def measure(function, *args, **kwargs):
+  tracemalloc.start()
+  start = time.perf_counter()
+  value = function(*args, **kwargs)
+  seconds = time.perf_counter() - start
+  _, peak = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  return value, seconds, peak / 2 ** 20
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Benchmark memory of the Sinkhorn and sliced Wasserstein metrics')
+  parser.add_argument('--points', type=int, nargs='*', default=[2500, 5000, 10000, 20000, 40000], help='Point counts to benchmark')
+  parser.add_argument('--tile-size', type=int, default=2048, help='Tile size of the cost matrix blocks')
+  parser.add_argument('--iterations', type=int, default=10, help='Sinkhorn iterations (fixed, to compare like for like)')
+  args = parser.parse_args()
+
+  rng = np.random.default_rng(0)
+  print(f"{'points':>8} {'dense cost MB':>14} {'sinkhorn MB':>12} {'sinkhorn s':>11} {'sliced MB':>10} {'sliced s':>9}")
+  for points in args.points:
+    a = rng.normal(size=(points, 3))
+    b = rng.normal(size=(points, 3)) + [0.1, 0, 0]
+    _, sinkhorn_seconds, sinkhorn_peak = measure(sinkhorn_points, a, b, eps=1e-2, tile_size=args.tile_size, max_iterations=args.iterations)
+    _, sliced_seconds, sliced_peak = measure(sliced_wasserstein_points, a, b)
+    print(f"{points:>8} {points * points * 8 / 2 ** 20:>14.1f} {sinkhorn_peak:>12.1f} {sinkhorn_seconds:>11.2f} {sliced_peak:>10.1f} {sliced_seconds:>9.2f}")
@@ -4,56 +4,123 @@ import numpy as np
 import pyvista as pv
 
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
 
 """
-This is the conversion script used for converting the ovary vtk into a processable and registrable geometry
+This is the conversion script used for converting the ovary vtk into a processable and registrable geometry.
+Blocks are labelled by the active scalars of the vtk (numbered in order of first appearance, as in the file)
+and split in a single pass over the faces, then written as a .glb scene (one node per block) or as arrays (.npz).
 """
 
-parser = argparse.ArgumentParser(description='Convert vtk to glb for the Millitome use case')
-parser.add_argument('--vtk', 
-                    dest='path_to_vtk',
-                    default=Path(__file__).parent.parent.joinpath('data/Ovary/Source/ovary.vtk'),
-                    help='Path to the .vtk file to convert')
-parser.add_argument('--glb', 
-                    dest='path_to_glb',
-                    required=True,
-                    help='Path to save the converted Millitome compatible .glb file')
-
-args = parser.parse_args()
-
-# check for the extension
-if Path(args.path_to_glb).suffix != '.glb':
-  raise ValueError("Please include the filename with the .glb extension as part of the path you provide")
-
-# use pyvista to load the file
-pyvista_mesh = pv.read(Path(args.path_to_vtk)).extract_surface()
-
-# initialize a trimesh.base.Trimesh object from it
-# the repository adopts trimesh.base.Trimesh objects as the prefered representation for meshes
-# preserve order and ensure labels from the vtk file are transfered correctly
-mesh = trimesh.Trimesh(vertices=pyvista_mesh.points,
-                       faces=pyvista_mesh.regular_faces,
-                       vertex_colors=trimesh.visual.interpolate(pyvista_mesh.active_scalars, color_map='viridis'),
-                       process=False)
-
-# extract the unique block colors (preserve order)
-_, sort_index = np.unique(mesh.visual.vertex_colors, axis=0, return_index=True)
-block_colors = mesh.visual.vertex_colors[np.sort(sort_index)]
-
-# extract the indices of each block within the combined geometry
-block_indices = [np.flatnonzero(np.all(mesh.visual.vertex_colors == block_color, axis=1)) for block_color in block_colors]
-
-# extract the faces corresponding to each block
-block_faces = [np.any(np.isin(mesh.faces, indices), axis=1) for indices in block_indices]
-
-# extract the blocks using the obtained face sequences
-blocks = [mesh.submesh([faces])[0] for faces in block_faces]
-
-# merge back into a scene (but blocks separate and accessible)
-# blocks are numbered as in the original .vtk file since the order is preserved
-scene = trimesh.Scene()
-for block_number, block in enumerate(blocks, start=1):
-  scene.add_geometry(block, geom_name=str(block_number), node_name=str(block_number))
-
-# export as .glb
-scene.export(file_obj=Path(args.path_to_glb))
+
+def load(path_to_vtk: str) -> tuple:
+  # use pyvista to load the file
+  pyvista_mesh = pv.read(Path(path_to_vtk)).extract_surface()
+  scalars = np.asarray(pyvista_mesh.active_scalars)
+
+  # initialize a trimesh.base.Trimesh object from it
+  # the repository adopts trimesh.base.Trimesh objects as the prefered representation for meshes
+  # preserve order and ensure labels from the vtk file are transfered correctly
+  mesh = trimesh.Trimesh(vertices=pyvista_mesh.points,
+                         faces=pyvista_mesh.regular_faces,
+                         vertex_colors=trimesh.visual.interpolate(scalars, color_map='viridis'),
+                         process=False)
+  return mesh, scalars
+
+def label(scalars: np.ndarray) -> np.ndarray:
+  """Block label of every vertex, blocks numbered by the first appearance of their scalar value"""
+  _, first, inverse = np.unique(scalars, axis=0 if scalars.ndim > 1 else None, return_index=True, return_inverse=True)
+  inverse = inverse.reshape(-1)
+
+  # np.unique numbers the values in sorted order, renumber them in order of appearance
+  order = np.empty_like(first)
+  order[np.argsort(first)] = np.arange(first.shape[0])
+  return order[inverse]
+
+def split(mesh: trimesh.Trimesh, labels: np.ndarray) -> list:
+  """Splits the mesh into one mesh per block label, a face belongs to every block one of its vertices belongs to"""
+  # (face, label) pairs, one per distinct label of the face's vertices
+  face_labels = labels[mesh.faces]
+  pairs = np.unique(np.column_stack([np.tile(np.arange(len(mesh.faces)), 3), face_labels.T.reshape(-1)]), axis=0)
+
+  # sort by label (then face, preserving the face order within a block) and cut at the label boundaries
+  pairs = pairs[np.lexsort((pairs[:, 0], pairs[:, 1]))]
+  boundaries = np.flatnonzero(np.diff(pairs[:, 1])) + 1
+  colors = mesh.visual.vertex_colors
+
+  blocks = []
+  for block in np.split(pairs[:, 0], boundaries):
+    # compact the vertices of the block, in their original order
+    vertices, faces = np.unique(mesh.faces[block], return_inverse=True)
+    blocks.append(trimesh.Trimesh(vertices=mesh.vertices[vertices],
+                                  faces=faces.reshape(-1, 3),
+                                  vertex_colors=colors[vertices],
+                                  process=False))
+  return blocks
+
+def write_glb(blocks: list, path: Path):
+  # merge back into a scene (but blocks separate and accessible)
+  # blocks are numbered as in the original .vtk file since the order is preserved
+  scene = trimesh.Scene()
+  for block_number, block in enumerate(blocks, start=1):
+    scene.add_geometry(block, geom_name=str(block_number), node_name=str(block_number))
+  scene.export(file_obj=path)
+
+def write_npz(blocks: list, path: Path):
+  # concatenated arrays, block i spans vertex_offsets[i]:vertex_offsets[i + 1] (faces index into the block's vertices)
+  np.savez(path,
+           blocks=np.arange(1, len(blocks) + 1),
+           vertices=np.concatenate([block.vertices for block in blocks]),
+           faces=np.concatenate([block.faces for block in blocks]),
+           vertex_colors=np.concatenate([block.visual.vertex_colors for block in blocks]),
+           vertex_offsets=np.cumsum([0] + [len(block.vertices) for block in blocks]),
+           face_offsets=np.cumsum([0] + [len(block.faces) for block in blocks]))
+
+def convert(path_to_vtk: str, output: str) -> tuple:
+  output = Path(output)
+  mesh, scalars = load(path_to_vtk)
+  blocks = split(mesh, label(scalars))
+  if output.suffix == '.glb':
+    write_glb(blocks, output)
+  elif output.suffix == '.npz':
+    write_npz(blocks, output)
+  else:
+    raise ValueError(f"{output.suffix} not recognized, the output must be a .glb or .npz file")
+  return (str(output), len(blocks))
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Convert vtk to glb (or npz arrays) for the Millitome use case')
+  parser.add_argument('--vtk',
+                      dest='paths_to_vtk',
+                      nargs='+',
+                      default=[Path(__file__).parent.parent.joinpath('data/Ovary/Source/ovary.vtk')],
+                      help='Path(s) to the .vtk file(s) to convert')
+  parser.add_argument('--glb',
+                      dest='path_to_glb',
+                      default=None,
+                      help='Path to save the converted Millitome compatible .glb (or .npz) file, for a single .vtk')
+  parser.add_argument('--output-dir',
+                      default=None,
+                      help='Directory to save the converted files to, named after the .vtk files (batch conversion)')
+  parser.add_argument('--format',
+                      choices=['glb', 'npz'],
+                      default='glb',
+                      help='Output format with --output-dir: a .glb scene or the blocks as .npz arrays')
+  parser.add_argument('--workers', type=int, default=1, help='Files converted in parallel')
+  args = parser.parse_args()
+
+  # single file (as before) or batch
+  if args.path_to_glb:
+    if len(args.paths_to_vtk) > 1:
+      parser.error('--glb converts a single .vtk, use --output-dir for several')
+    outputs = [args.path_to_glb]
+  elif args.output_dir:
+    Path(args.output_dir).mkdir(parents=True, exist_ok=True)
+    outputs = [Path(args.output_dir).joinpath(f'{Path(path).stem}.{args.format}') for path in args.paths_to_vtk]
+  else:
+    parser.error('one of --glb or --output-dir is required')
+
+  with ProcessPoolExecutor(max_workers=args.workers) as executor:
+    for output, count in executor.map(convert, args.paths_to_vtk, outputs):
+      print(f'{output}: {count} blocks')
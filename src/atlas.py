@@ -0,0 +1,153 @@
+import os
+import json
+import shutil
+import argparse
+import tempfile
+import numpy as np
+import open3d as o3d
+
+from pathlib import Path
+from typing import Optional
+from dataclasses import dataclass, field
+
+from config import get_registry
+from steps import normalize_rigid
+from utils.io import read_yaml, content_hash
+from utils.cache import CACHE_DIR, load_mesh
+from utils.conversions import Geometry, readonly, to_pointcloud
+from utils.preprocess import compute_features
+
+# bump whenever the features are computed differently, this invalidates built indexes
+ATLAS_VERSION = 2
+ATLAS_DIR = Path(os.environ.get('HRA_AMAP_ATLAS', CACHE_DIR / 'atlas'))
+
+
+def _voxel_key(voxel_size: float) -> str:
+    return f'{float(voxel_size):.6g}'
+
+@dataclass
+class AtlasLevel:
+    """Voxel downsampled reference organ (in the unit normalized space) with its normals and FPFH features"""
+    points: np.ndarray
+    normals: np.ndarray
+    fpfh: np.ndarray
+
+    @property
+    def pointcloud(self) -> o3d.geometry.PointCloud:
+        pointcloud = to_pointcloud(self.points)
+        pointcloud.normals = o3d.utility.Vector3dVector(np.require(self.normals, dtype=np.float64, requirements=['C', 'W']))
+        return pointcloud
+
+    @property
+    def features(self) -> o3d.pipelines.registration.Feature:
+        features = o3d.pipelines.registration.Feature()
+        features.data = np.require(self.fpfh, dtype=np.float64, requirements=['C', 'W'])
+        return features
+
+@dataclass
+class AtlasIndex:
+    """
+    Precomputed target side of the rigid registration of one reference organ, memory mapped from disk.
+    Matched by the content of the (raw) target vertices, the per voxel size levels are only valid for the same `max_nn`.
+    """
+    name: str
+    sha256: str
+    max_nn: int
+    voxel_sizes: tuple
+    _directory: Path = field(default=None, repr=False)
+
+    @classmethod
+    def load(cls, directory: str) -> 'AtlasIndex':
+        directory = Path(directory)
+        with open(directory / 'index.json') as f:
+            data = json.load(f)
+        return cls(name=data['name'],
+                   sha256=data['sha256'],
+                   max_nn=data['max_nn'],
+                   voxel_sizes=tuple(data['voxel_sizes']),
+                   _directory=directory)
+
+    @property
+    def normals(self) -> np.ndarray:
+        """Normals of the full resolution target (as used by point-to-plane ICP)"""
+        return np.load(self._directory / 'normals.npy', mmap_mode='r')
+
+    @property
+    def pointcloud(self) -> o3d.geometry.PointCloud:
+        pointcloud = to_pointcloud(np.load(self._directory / 'points.npy', mmap_mode='r'))
+        pointcloud.normals = o3d.utility.Vector3dVector(np.require(self.normals, dtype=np.float64, requirements=['C', 'W']))
+        return pointcloud
+
+    def level(self, voxel_size: float, max_nn: int) -> Optional[AtlasLevel]:
+        if max_nn != self.max_nn or _voxel_key(voxel_size) not in self.voxel_sizes:
+            return None
+        directory = self._directory / _voxel_key(voxel_size)
+        return AtlasLevel(*(np.load(directory / f'{name}.npy', mmap_mode='r') for name in ('points', 'normals', 'fpfh')))
+
+def build(name: str, path: str, voxel_sizes: list, max_nn: int, output_dir: str = ATLAS_DIR) -> Path:
+    """Precomputes the normalized target, its normals and per voxel size the downsampled points, normals and FPFH features"""
+    faces, vertices = load_mesh(path, Path(path).suffix or '.glb')
+    target = readonly(np.asarray(vertices))
+
+    # the same normalization as Step 1 of the pipeline
+    normalized = Geometry(normalize_rigid(source=target, target=target).output['Target'])
+    pointcloud = to_pointcloud(normalized, normals=True)
+
+    # write next to the final location and rename, so that a running pipeline never sees a partial index
+    sha256 = content_hash(target)
+    directory = Path(output_dir) / f'{sha256[:16]}-{ATLAS_VERSION}'
+    directory.parent.mkdir(parents=True, exist_ok=True)
+    staging = Path(tempfile.mkdtemp(dir=directory.parent))
+    np.save(staging / 'points.npy', np.asarray(pointcloud.points))
+    np.save(staging / 'normals.npy', np.asarray(pointcloud.normals))
+
+    for voxel_size in voxel_sizes:
+        params = {'voxel_size': float(voxel_size), 'max_nn': max_nn}
+        level = to_pointcloud(normalized).voxel_down_sample(params['voxel_size'])
+        features = compute_features(level, params)
+        (staging / _voxel_key(voxel_size)).mkdir()
+        np.save(staging / _voxel_key(voxel_size) / 'points.npy', np.asarray(level.points))
+        np.save(staging / _voxel_key(voxel_size) / 'normals.npy', np.asarray(level.normals))
+        np.save(staging / _voxel_key(voxel_size) / 'fpfh.npy', np.asarray(features.data))
+
+    with open(staging / 'index.json', 'w') as f:
+        json.dump({'name': name,
+                   'path': str(path),
+                   'sha256': sha256,
+                   'max_nn': max_nn,
+                   'version': ATLAS_VERSION,
+                   'voxel_sizes': [_voxel_key(voxel_size) for voxel_size in voxel_sizes]}, f, indent='\t')
+
+    shutil.rmtree(directory, ignore_errors=True)
+    os.replace(staging, directory)
+    return directory
+
+def find(target: np.ndarray, atlas_dir: str = ATLAS_DIR) -> Optional[AtlasIndex]:
+    """The index built for this target (by the content of its raw vertices), None if there is none"""
+    directory = Path(atlas_dir) / f'{content_hash(target)[:16]}-{ATLAS_VERSION}'
+    if not directory.joinpath('index.json').exists():
+        return None
+    return AtlasIndex.load(directory)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Precompute the target side of the rigid registration for the HRA reference organs')
+    parser.add_argument('command', choices=['build'], help='build the index')
+    parser.add_argument('--organs', nargs='*', default=None, help='RUI organ names (default: every organ in atlas_paths.yaml RUI)')
+    parser.add_argument('--params', default='../configs/params.yaml', help='Pipeline params, for voxel_size, pyramid_voxel_sizes and max_nn')
+    parser.add_argument('--voxel-sizes', type=float, nargs='*', default=None, help='Voxel sizes (default: voxel_size and the pyramid levels)')
+    parser.add_argument('--output', default=str(ATLAS_DIR), help='Index directory')
+    args = parser.parse_args()
+
+    params = read_yaml(args.params)['rigid_registration']
+    voxel_sizes = args.voxel_sizes or sorted({float(params['voxel_size'])} | {float(size) for size in params.get('pyramid_voxel_sizes', []) if float(size) > 0})
+    references = get_registry().mappings['RUI']
+    unknown = [name for name in args.organs or [] if name not in references]
+    if unknown:
+        parser.error(f"{', '.join(unknown)} not in the RUI section of atlas_paths.yaml")
+    for name in args.organs or list(references):
+        if not Path(references[name]).exists():
+            print(f'{name}: {references[name]} not found, skipped')
+            continue
+        directory = build(name, references[name], voxel_sizes, int(params['max_nn']), args.output)
+        print(f'{name}: {directory}')
@@ -0,0 +1,135 @@
+import logging
+import numpy as np
+
+from dataclasses import dataclass, field
+from bcpd import DENSE_PAIRS
+
+logger = logging.getLogger(__name__)
+
+# rough single-core seconds per unit of work (see _iteration_cost), calibrate with Pipeline.profile() and `autotune_rate`
+RATES = {'bcpd': 5e-9, 'native': 2.5e-8}
+
+
+@dataclass
+class Budget:
+    time: float = 600.0              # seconds for the non-rigid registration
+    memory: float = 4096.0           # megabytes for the non-rigid registration
+    small: int = 10000               # at most this many points: no acceleration
+    huge: int = 100000               # at least this many points: always downsample
+    rigid_points: int = 5000         # points kept by the rigid voxel grid
+    minimum: int = 2000              # never downsample below this
+    rate: float = None               # seconds per unit of work, defaults to RATES[backend]
+
+    @classmethod
+    def from_params(cls, params: dict) -> 'Budget':
+        """`autotune_*` keys of the nonrigid_registration params, e.g. autotune_time: 300"""
+        fields = cls.__dataclass_fields__
+        values = {key[len('autotune_'):]: value for key, value in params.items() if key.startswith('autotune_')}
+        return cls(**{name: fields[name].type(value) for name, value in values.items() if name in fields})
+
+@dataclass
+class Suggestion:
+    rigid: dict = field(default_factory=dict)
+    nonrigid: dict = field(default_factory=dict)
+    reasons: list = field(default_factory=list)
+
+def enabled(params: dict) -> bool:
+    # the YAML configs store flags as strings
+    return str(params.get('autotune', False)).lower() in ('true', '1', 'yes')
+
+def occupied_voxels(array: np.ndarray, size: float) -> int:
+    return np.unique(np.floor(array / size).astype(np.int64), axis=0).shape[0]
+
+def voxel_size_for(array: np.ndarray, points: int, initial: float, iterations: int = 4) -> float:
+    """Voxel edge that keeps about `points` occupied voxels (counts fall with the square of the edge on a surface)"""
+    size = initial
+    for _ in range(iterations):
+        count = occupied_voxels(array, size)
+        if abs(count - points) <= 0.1 * points:
+            break
+        size *= np.sqrt(count / points)
+    return float(size)
+
+def nystrom_ranks(points: int) -> tuple:
+    """Nystrom samples (-J) and rank (-K), growing with the square root of the point count (~300 / 70 at ~26k points)"""
+    samples = int(min(points, np.clip(round(2 * np.sqrt(points)), 100, 1000)))
+    rank = int(min(samples, max(20, round(0.23 * samples))))
+    return samples, rank
+
+def _iteration_cost(source: int, target: int, samples: int, backend: str) -> float:
+    # the native engine evaluates every source-target pair in its dense E-step, above DENSE_PAIRS it searches a KD-tree
+    # as the BCPD binary (-p) does, leaving the Nystrom factor as the source dependent term
+    if backend == 'native' and source * target <= DENSE_PAIRS:
+        return source * target + source * samples
+    return 64 * (source + target) + source * samples
+
+def _memory(source: int, target: int, samples: int, params: dict) -> float:
+    # Nystrom columns, point sets and per-point statistics, plus the chunked E-step buffers of the native engine
+    memory = 8 * source * samples + 200 * (source + target)
+    if params.get('backend', 'bcpd') == 'native':
+        memory += 8 * float(params.get('chunk_elements', 2 ** 22)) * max(1, int(params.get('threads', 0)) or 4)
+    return memory / 2 ** 20
+
+def suggest(source: np.ndarray, target: np.ndarray, rigid_params: dict, nonrigid_params: dict, budget: Budget = None) -> Suggestion:
+    """
+    Picks the rigid voxel size and the BCPD downsampling and Nystrom ranks from the point counts and extent of the
+    (unit normalized) source and target, so that the non-rigid registration fits the time and memory budget
+    """
+    budget = budget or Budget.from_params(nonrigid_params)
+    backend = nonrigid_params.get('backend', 'bcpd')
+    threads = int(nonrigid_params.get('threads', 0)) or 1
+    rate = budget.rate or RATES.get(backend, RATES['bcpd']) / threads
+    iterations = int(nonrigid_params['max_iterations'])
+    suggestion = Suggestion()
+    M, N = source.shape[0], target.shape[0]
+
+    # rigid: a voxel grid that leaves enough points for FPFH / RANSAC, whatever the resolution of the meshes
+    voxel_size = voxel_size_for(source if M >= N else target, budget.rigid_points, float(rigid_params['voxel_size']))
+    suggestion.rigid['voxel_size'] = voxel_size
+    suggestion.reasons.append(f"voxel_size={voxel_size:.4g} keeps ~{budget.rigid_points} of {max(M, N)} points for global registration")
+
+    def fits(size, target_size):
+        samples, _ = nystrom_ranks(size)
+        seconds = _iteration_cost(size, target_size, samples, backend) * iterations * rate
+        memory = _memory(size, target_size, samples, nonrigid_params)
+        return seconds <= budget.time and memory <= budget.memory, seconds, memory
+
+    # non-rigid: small organs run on all points
+    fit, seconds, memory = fits(M, N)
+    if max(M, N) <= budget.small:
+        size, which, target_size = M, None, N
+        suggestion.reasons.append(f"no downsampling: {M} source / {N} target points are below {budget.small}")
+    elif fit and max(M, N) < budget.huge:
+        size, which, target_size = M, None, N
+        suggestion.reasons.append(f"no downsampling: all {M} points fit the budget (~{seconds:.0f} s, ~{memory:.0f} MB)")
+    else:
+        # downsample the source (and the target too when the E-step scales with it) until the run fits
+        which = 'B' if backend == 'native' and N >= budget.huge else 'Y'
+        size = min(M, budget.huge - 1) if M >= budget.huge else M
+        target_size = min(N, size) if which == 'B' else N
+        while size > budget.minimum and not fits(size, target_size)[0]:
+            size = max(int(budget.minimum), int(size * 0.8))
+            target_size = min(N, size) if which == 'B' else N
+        fit, seconds, memory = fits(size, target_size)
+        reason = 'above' if max(M, N) >= budget.huge else 'over budget with'
+        suggestion.reasons.append(f"downsampling {which} to {size} points: {reason} {max(M, N)} points "
+                                  f"(~{seconds:.0f} s of {budget.time:.0f} s, ~{memory:.0f} MB of {budget.memory:.0f} MB)")
+        if not fit:
+            suggestion.reasons.append(f"still over budget at the minimum of {budget.minimum} points")
+
+    if which is None:
+        # None removes a configured downsampling
+        suggestion.nonrigid['downsampling'] = None
+    else:
+        # voxel grid first (even coverage), then a random subset, as BCPD does; the radius is in the BCPD normalized space
+        normalized = (source - source.mean(axis=0)) / source.std()
+        radius = voxel_size_for(normalized, 2 * size, 0.05)
+        suggestion.nonrigid['downsampling'] = f'{which}, {size}, {radius:.4g}'
+
+    samples, rank = nystrom_ranks(size)
+    suggestion.nonrigid.update(nystrom_samples=samples, nystrom_rank=rank)
+    suggestion.reasons.append(f"nystrom_samples={samples}, nystrom_rank={rank} for {size} control points")
+
+    for reason in suggestion.reasons:
+        logger.info(reason)
+    return suggestion
@@ -0,0 +1,160 @@
+import time
+import argparse
+import traceback
+import pandas as pd
+
+from pathlib import Path
+from typing import Optional
+from dataclasses import dataclass
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from threadpoolctl import threadpool_limits
+
+from organ import Organ
+from pipeline import Pipeline, METRICS
+from utils.io import read_yaml
+from utils.cache import StageCache
+
+
+@dataclass
+class Job:
+    name: str
+    source: str
+    target: str
+    params: str = '../configs/params.yaml'
+    overrides: Optional[dict] = None
+    description: str = ''
+
+def read_manifest(path: str) -> list[Job]:
+    """Reads a YAML manifest with an optional `defaults` section and a list of `jobs`"""
+    manifest = read_yaml(path)
+    defaults = manifest.get('defaults', {})
+    jobs = [Job(**{**defaults, **job}) for job in manifest['jobs']]
+    
+    # job names double as output directory names
+    names = [job.name for job in jobs]
+    duplicates = sorted(set(name for name in names if names.count(name) > 1))
+    if duplicates:
+        raise ValueError(f"Job names must be unique, found duplicates: {', '.join(duplicates)}")
+    return jobs
+
+def _load_params(job: Job, bcpd_threads: int) -> dict:
+    params = read_yaml(job.params)
+
+    # apply the per-job overrides section by section
+    for section, values in (job.overrides or {}).items():
+        params.setdefault(section, {}).update(values)
+
+    # thread budget of the non-rigid backend
+    if bcpd_threads:
+        params['nonrigid_registration']['threads'] = bcpd_threads
+    return params
+
+def _initialize_worker(threads: int):
+    # caps the OpenMP / BLAS pools (Open3D, NumPy) of this worker process
+    if threads:
+        threadpool_limits(limits=threads)
+
+def run_job(job: Job, 
+            output_dir: str, 
+            bcpd_threads: int = 0, 
+            metrics: tuple = ('chamfer', 'hausdorff'), 
+            stage_cache: Optional[str] = None, 
+            inverse: bool = False) -> dict:
+    """Runs a single registration job, never raises: failures are reported in the returned record"""
+    record = {'name': job.name, 'source': job.source, 'target': job.target, 'status': 'failed'}
+    start = time.perf_counter()
+    try:
+        source, target = Organ(job.source), Organ(job.target)
+        pipeline = Pipeline(job.name, job.description, _load_params(job, bcpd_threads))
+        projection = pipeline.run(source, target, cache=StageCache(stage_cache) if stage_cache else None)
+        record['registration_time'] = time.perf_counter() - start
+
+        # per-step timings show which stage dominates for this organ
+        profile = pipeline.profile()
+        record.update({f'{step}_time': wall_time for step, wall_time in zip(profile['step'], profile['wall_time'])})
+        record['bcpd_subprocess_time'] = profile['subprocess_time'].sum()
+        record['slowest_step'] = profile.loc[profile['wall_time'].idxmax(), 'step']
+        pipeline.export_profile(str(Path(output_dir) / f'{job.name}-trace.json'), format='chrome')
+
+        # evaluate
+        for metric in metrics:
+            record[metric] = METRICS[metric](target, projection.registration)
+
+        # export
+        projection.export(str(Path(output_dir) / job.name))
+        record['projection'] = str(next(Path(output_dir).glob(f'{job.name}-{projection.id}')))
+
+        # the backward (target -> source) projection, derived instead of registered again
+        if inverse:
+            backward = projection.inverse()
+            backward.export(str(Path(output_dir) / 'Backward' / job.name))
+            record.update({f'round_trip_{name}': value for name, value in backward.round_trip_error.items()})
+        record['status'] = 'done'
+    except Exception:
+        record['error'] = traceback.format_exc()
+    record['wall_time'] = time.perf_counter() - start
+    return record
+
+def run_batch(jobs: list[Job], 
+              output_dir: str, 
+              workers: int = 1, 
+              threads: int = 1, 
+              bcpd_threads: int = 0, 
+              resume: bool = True, 
+              metrics: tuple = ('chamfer', 'hausdorff'), 
+              stage_cache: Optional[str] = None, 
+              inverse: bool = False) -> pd.DataFrame:
+    """Runs the jobs in a process pool, writing one projection per job and a summary table to `output_dir`"""
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    summary_path = output_dir / 'summary.csv'
+
+    # resume: skip jobs that already finished and whose projection still exists
+    records = {}
+    if resume and summary_path.exists():
+        previous = pd.read_csv(summary_path).to_dict(orient='records')
+        records = {record['name']: record for record in previous 
+                   if record['status'] == 'done' and Path(str(record.get('projection'))).exists()}
+    pending = [job for job in jobs if job.name not in records]
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_initialize_worker, initargs=(threads,)) as executor:
+        futures = {executor.submit(run_job, job, str(output_dir), bcpd_threads, metrics, stage_cache, inverse): job for job in pending}
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                record = future.result()
+            except Exception:
+                # the worker process itself died (e.g. out of memory)
+                record = {'name': job.name, 'source': job.source, 'target': job.target, 
+                          'status': 'failed', 'error': traceback.format_exc()}
+            records[job.name] = record
+
+            # write the summary as we go so that an interrupted batch can resume
+            pd.DataFrame([records[job.name] for job in jobs if job.name in records]).to_csv(summary_path, index=False)
+
+    return pd.DataFrame([records[job.name] for job in jobs if job.name in records])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Register a manifest of source/target organ pairs in parallel')
+    parser.add_argument('manifest', help='Path to the YAML manifest of jobs')
+    parser.add_argument('--output', dest='output_dir', required=True, help='Directory for the projections and the summary table')
+    parser.add_argument('--workers', type=int, default=1, help='Number of worker processes')
+    parser.add_argument('--threads', type=int, default=1, help='OpenMP / BLAS threads per worker (0 leaves them unlimited)')
+    parser.add_argument('--bcpd-threads', type=int, default=0, help='Threads per BCPD registration (0 keeps params.yaml)')
+    parser.add_argument('--metrics', nargs='*', default=['chamfer', 'hausdorff'], choices=list(METRICS), help='Metrics to report per job')
+    parser.add_argument('--stage-cache', default=None, help='Directory to memoize pipeline steps in, reused by jobs that share inputs and params')
+    parser.add_argument('--inverse', action='store_true', help='Also derive and export the backward (target -> source) projections')
+    parser.add_argument('--no-resume', dest='resume', action='store_false', help='Re-run jobs that already finished')
+    args = parser.parse_args()
+
+    summary = run_batch(read_manifest(args.manifest), 
+                        args.output_dir, 
+                        workers=args.workers, 
+                        threads=args.threads, 
+                        bcpd_threads=args.bcpd_threads, 
+                        resume=args.resume, 
+                        metrics=tuple(args.metrics), 
+                        stage_cache=args.stage_cache, 
+                        inverse=args.inverse)
+    print(summary.drop(columns=['error'], errors='ignore').to_string(index=False))
@@ -0,0 +1,218 @@
+import logging
+import numpy as np
+
+from typing import Optional
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+from threadpoolctl import threadpool_limits
+from scipy.spatial import cKDTree
+
+logger = logging.getLogger(__name__)
+
+# above this many (source x target) pairs the dense E-step is too slow to be practical (about 30 s per iteration
+# at 27443 x 26443 points), the 'auto' E-step then only looks at the nearest source points of every target point
+DENSE_PAIRS = 5e7
+
+
+@dataclass
+class BCPDResult:
+    scale: float
+    rotation: np.ndarray
+    translation: np.ndarray
+    source: np.ndarray
+    deformed: np.ndarray
+    registered: np.ndarray
+    sigma2: float
+    iterations: int
+
+def parse_downsampling(spec) -> tuple:
+    """Parses a BCPD style downsampling spec such as 'Y, 26443, 0.05' into (target, size, radius)"""
+    fields = [field.strip() for field in str(spec).split(',')]
+    return (fields[0].upper(), int(fields[1]), float(fields[2]) if len(fields) > 2 else 0.0)
+
+def downsample(array: np.ndarray, size: int, radius: float = 0.0, rng: Optional[np.random.Generator] = None) -> np.ndarray:
+    """Downsamples to at most `size` points, first on a voxel grid of edge `radius` (if positive), then at random"""
+    rng = np.random.default_rng() if rng is None else rng
+    indices = np.arange(array.shape[0])
+
+    # keep one (existing) point per occupied voxel
+    if radius > 0:
+        _, first = np.unique(np.floor(array / radius).astype(np.int64), axis=0, return_index=True)
+        indices = np.sort(first)
+
+    # random subset if still above the budget
+    if indices.shape[0] > size:
+        indices = np.sort(rng.choice(indices, size, replace=False))
+
+    return array[indices]
+
+def gaussian_kernel(a: np.ndarray, b: np.ndarray, beta: float) -> np.ndarray:
+    squared = np.sum(a ** 2, axis=1)[:, None] + np.sum(b ** 2, axis=1)[None, :] - 2 * a @ b.T
+    return np.exp(-np.maximum(squared, 0) / (2 * beta ** 2))
+
+def nystrom(array: np.ndarray, beta: float, samples: int, rank: int, rng: np.random.Generator) -> np.ndarray:
+    """Low-rank factor U such that G ~ U @ U.T for the Gaussian kernel matrix of `array`"""
+    if array.shape[0] <= samples:
+        # small enough to decompose the exact kernel
+        values, vectors = np.linalg.eigh(gaussian_kernel(array, array, beta))
+        keep = values > values.max() * 1e-10
+        return vectors[:, keep] * np.sqrt(values[keep])
+
+    # approximate the kernel from a random subset of columns
+    subset = rng.choice(array.shape[0], samples, replace=False)
+    columns = gaussian_kernel(array, array[subset], beta)
+    values, vectors = np.linalg.eigh(columns[subset])
+    order = np.argsort(values)[::-1][:rank]
+    values, vectors = values[order], vectors[:, order]
+    keep = values > values[0] * 1e-10
+    return columns @ (vectors[:, keep] / np.sqrt(values[keep]))
+
+def _expectation_chunk(target, registered, log_alpha, params):
+    """Posterior correspondences for a chunk of target points, reduced to the sufficient statistics"""
+    sigma2, log_outlier = params
+    squared = (np.sum(registered ** 2, axis=1)[:, None] + np.sum(target ** 2, axis=1)[None, :] - 2 * registered @ target.T)
+    log_phi = log_alpha[:, None] - np.maximum(squared, 0) / (2 * sigma2)
+
+    # normalize over source points (and the outlier term) in the log domain
+    peak = np.max(log_phi, axis=0)
+    if log_outlier is not None:
+        peak = np.maximum(peak, log_outlier)
+    phi = np.exp(log_phi - peak)
+    denominator = np.sum(phi, axis=0) + (np.exp(log_outlier - peak) if log_outlier is not None else 0)
+    probabilities = phi / denominator
+
+    return (probabilities.sum(axis=1), probabilities @ target, probabilities.sum(axis=0), -np.sum(np.log(denominator) + peak))
+
+def _expectation(target, registered, log_alpha, sigma2, log_outlier, chunk_size, executor):
+    chunks = [target[start:start + chunk_size] for start in range(0, target.shape[0], chunk_size)]
+    args = (sigma2, log_outlier)
+    results = list(executor.map(lambda chunk: _expectation_chunk(chunk, registered, log_alpha, args), chunks))
+
+    # combine the chunks
+    nu = np.sum([result[0] for result in results], axis=0)
+    px = np.sum([result[1] for result in results], axis=0)
+    nu_target = np.concatenate([result[2] for result in results])
+    likelihood = np.sum([result[3] for result in results])
+    return nu, px, nu_target, likelihood
+
+def _expectation_neighbours(target, registered, log_alpha, sigma2, log_outlier, neighbours, workers):
+    """
+    As _expectation, truncated to the `neighbours` nearest registered source points of every target point (KD-tree),
+    the other posteriors are negligible once sigma2 is small, as with the -p option of the BCPD binary.
+    """
+    M, k = registered.shape[0], min(neighbours, registered.shape[0])
+    distances, indices = cKDTree(registered).query(target, k=k, workers=workers or -1)
+    distances, indices = distances.reshape(target.shape[0], k), indices.reshape(target.shape[0], k)
+    log_phi = log_alpha[indices] - distances ** 2 / (2 * sigma2)
+
+    # normalize over the neighbours (and the outlier term) in the log domain
+    peak = np.max(log_phi, axis=1)
+    if log_outlier is not None:
+        peak = np.maximum(peak, log_outlier)
+    phi = np.exp(log_phi - peak[:, None])
+    denominator = np.sum(phi, axis=1) + (np.exp(log_outlier - peak) if log_outlier is not None else 0)
+    probabilities = phi / denominator[:, None]
+
+    # scatter back onto the source points
+    nu = np.bincount(indices.ravel(), weights=probabilities.ravel(), minlength=M)
+    px = np.stack([np.bincount(indices.ravel(), weights=(probabilities * target[:, [d]]).ravel(), minlength=M) 
+                   for d in range(target.shape[1])], axis=1)
+    return nu, px, probabilities.sum(axis=1), -np.sum(np.log(denominator) + peak)
+
+def register(source: np.ndarray, target: np.ndarray, params: dict) -> BCPDResult:
+    """Bayesian Coherent Point Drift (Hirose, 2021) of `source` (Y) onto `target` (X) with Nystrom acceleration"""
+    rng = np.random.default_rng(int(params.get('seed', 0)))
+    lambda_ = float(params['lambda'])
+    beta = float(params['beta'])
+    gamma = float(params.get('gamma', 1))
+    omega = float(params.get('omega', 0))
+    tolerance = float(params['distance_threshold'])
+    max_iterations = int(params['max_iterations'])
+    threads = int(params.get('threads', 0)) or None
+    e_step = params.get('e_step', 'auto')
+    neighbours = int(params.get('e_step_neighbours', 64))
+
+    # downsampling acceleration
+    if 'downsampling' in params:
+        which, size, radius = parse_downsampling(params['downsampling'])
+        if which in ('Y', 'B'):
+            source = downsample(source, size, radius, rng)
+        if which in ('X', 'B'):
+            target = downsample(target, size, radius, rng)
+
+    (M, D), N = source.shape, target.shape[0]
+    # bound the (M x chunk) matrices held in memory per thread to ~32 MB
+    chunk_size = max(1, int(params.get('chunk_elements', 2 ** 22)) // M)
+
+    # dense (exact) or KD-tree truncated E-step
+    if e_step not in ('auto', 'dense', 'kdtree'):
+        raise ValueError(f"{e_step} not recognized, must be one of auto, dense or kdtree")
+    dense = e_step == 'dense' or (e_step == 'auto' and M * N <= DENSE_PAIRS)
+    if dense and M * N > DENSE_PAIRS:
+        logger.warning(f'dense E-step over {M} x {N} points, every iteration costs O(M x N), consider e_step: kdtree or downsampling')
+
+    # initialize
+    scale, rotation, translation = 1.0, np.eye(D), np.zeros(D)
+    deformation = np.zeros((M, D))
+    sigma2_m = np.zeros(M)
+    log_alpha = np.full(M, -np.log(M))
+    sigma2 = gamma * (M * np.sum(target ** 2) + N * np.sum(source ** 2) - 2 * np.sum(target, axis=0) @ np.sum(source, axis=0)) / (M * N * D)
+    volume = np.prod(np.ptp(target, axis=0))
+    likelihood, iteration = np.inf, 0
+
+    with threadpool_limits(limits=threads), ThreadPoolExecutor(max_workers=threads) as executor:
+        factor = nystrom(source, beta, int(params.get('nystrom_samples', 300)), int(params.get('nystrom_rank', 70)), rng)
+
+        for iteration in range(1, max_iterations + 1):
+            deformed = source + deformation
+            registered = scale * deformed @ rotation.T + translation
+
+            # E-step: correspondences, with the shape uncertainty folded into the prior
+            log_prior = log_alpha - (scale ** 2) * D * sigma2_m / (2 * sigma2) - (D / 2) * np.log(2 * np.pi * sigma2)
+            log_outlier = np.log(omega / (1 - omega)) - np.log(volume) if omega > 0 else None
+            if dense:
+                nu, px, nu_target, current = _expectation(target, registered, log_prior, sigma2, log_outlier, chunk_size, executor)
+            else:
+                nu, px, nu_target, current = _expectation_neighbours(target, registered, log_prior, sigma2, log_outlier, neighbours, threads)
+            nu = np.maximum(nu, np.finfo(float).tiny)
+            total = nu.sum()
+
+            # M-step: deformation and its posterior covariance (Woodbury identity on the low-rank kernel)
+            residual = ((px / nu[:, None] - translation) @ rotation) / scale - source
+            weights = (scale ** 2) * nu / (lambda_ * sigma2)
+            inner = np.linalg.inv(np.eye(factor.shape[1]) + factor.T @ (weights[:, None] * factor))
+            deformation = factor @ (inner @ (factor.T @ (weights[:, None] * residual)))
+            sigma2_m = np.sum((factor @ inner) * factor, axis=1) / lambda_
+
+            # M-step: similarity transform
+            deformed = source + deformation
+            target_mean = px.sum(axis=0) / total
+            deformed_mean = nu @ deformed / total
+            sigma2_bar = nu @ sigma2_m / total
+            centered = deformed - deformed_mean
+            covariance = (px - nu[:, None] * target_mean).T @ centered / total
+            u, _, vt = np.linalg.svd(covariance)
+            correction = np.eye(D)
+            correction[-1, -1] = np.linalg.det(u @ vt)
+            rotation = u @ correction @ vt
+            scale = np.trace(rotation.T @ covariance) / (np.sum(nu[:, None] * centered ** 2) / total + D * sigma2_bar)
+            translation = target_mean - scale * rotation @ deformed_mean
+
+            # M-step: residual variance
+            registered = scale * deformed @ rotation.T + translation
+            sigma2 = (nu_target @ np.sum(target ** 2, axis=1) - 2 * np.sum(px * registered) + nu @ np.sum(registered ** 2, axis=1)) / (total * D) + scale ** 2 * sigma2_bar
+            sigma2 = max(sigma2, np.finfo(float).eps)
+
+            # convergence on the relative change of the negative log-likelihood
+            if np.isfinite(likelihood) and abs(likelihood - current) <= tolerance * abs(current):
+                break
+            likelihood = current
+
+    return BCPDResult(scale=float(scale),
+                      rotation=rotation,
+                      translation=translation,
+                      source=source,
+                      deformed=source + deformation,
+                      registered=scale * (source + deformation) @ rotation.T + translation,
+                      sigma2=float(sigma2),
+                      iterations=iteration)
@@ -0,0 +1,52 @@
+import io
+import json
+import numpy as np
+
+from urllib.request import Request, urlopen
+
+"""
+Client of the projection service (service.py), it only needs NumPy and the standard library.
+
+    client = ProjectionClient('http://127.0.0.1:8765')
+    projected = client.project('Kidney-...', vertices)
+    locations = client.project_samples('Kidney-...', samples)
+"""
+
+NPY = 'application/x-npy'
+
+
+class ProjectionClient:
+    def __init__(self, url: str = 'http://127.0.0.1:8765', timeout: float = 60) -> None:
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+
+    def _request(self, path: str, body: bytes = None, content_type: str = 'application/json') -> tuple:
+        request = Request(f'{self.url}{path}', data=body, headers={'Content-Type': content_type} if body is not None else {})
+        with urlopen(request, timeout=self.timeout) as response:
+            return response.read(), response.headers.get('Content-Type')
+
+    def _json(self, path: str, data: dict = None):
+        body, _ = self._request(path, None if data is None else json.dumps(data).encode())
+        return json.loads(body)
+
+    def projections(self) -> dict:
+        return self._json('/projections')
+
+    def metrics(self) -> dict:
+        return self._json('/metrics')
+
+    def project(self, name: str, vertices: np.ndarray) -> np.ndarray:
+        """Projects an (N, 3) array, sent and received as .npy"""
+        buffer = io.BytesIO()
+        np.save(buffer, np.asarray(vertices, dtype=np.float64))
+        body, _ = self._request(f'/projections/{name}/vertices', buffer.getvalue(), NPY)
+        return np.load(io.BytesIO(body), allow_pickle=False)
+
+    def project_samples(self, name: str, samples: list[dict], target: str = None, oriented: bool = False) -> list[dict]:
+        """Projected rui_location of every sample"""
+        return self._json(f'/projections/{name}/blocks', {'samples': samples, 'target': target, 'oriented': oriented})['locations']
+
+    def batch(self, requests: list[dict]) -> list[dict]:
+        """Many requests ({"projection": name, "vertices" | "samples": ...}) handled concurrently by the service"""
+        return self._json('/batch', {'requests': [{**request, 'vertices': np.asarray(request['vertices']).tolist()} 
+                                                  if 'vertices' in request else request for request in requests]})['results']
@@ -0,0 +1,239 @@
+import trimesh
+import numpy as np
+
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+from config import get_registry
+
+# namespace of the reference organs and their anatomical structures
+CCF = 'http://purl.org/ccf/latest/ccf.owl#'
+# the box corners (+/- 0.5) every tissue block is built from, as in TissueBlockSet.UNIT_BOX
+UNIT_BOX = trimesh.creation.box(extents=(1, 1, 1))
+
+
+# float64 temporaries held per (point, triangle) pair by _solid_angles: the corner vectors (9), their lengths (3),
+# b x c (3), the numerator / denominator and their einsum / product intermediates (8)
+PAIR_BYTES = 8 * 23
+
+
+def _solid_angles(points: np.ndarray, triangles: np.ndarray) -> np.ndarray:
+    """Signed solid angle / 2 (the arctan2 of Van Oosterom & Strackee) of (..., 3, 3) triangles seen from (..., 3) points"""
+    a, b, c = (triangles[..., corner, :] - points for corner in range(3))
+    la, lb, lc = (np.linalg.norm(vector, axis=-1) for vector in (a, b, c))
+    numerator = np.einsum('...k,...k->...', a, np.cross(b, c))
+    denominator = la * lb * lc + np.einsum('...k,...k->...', a, b) * lc + np.einsum('...k,...k->...', b, c) * la + np.einsum('...k,...k->...', c, a) * lb
+    return np.arctan2(numerator, denominator)
+
+def winding_numbers(points: np.ndarray, triangles: np.ndarray, memory: int = 2 ** 26) -> np.ndarray:
+    """
+    Generalized winding number (Jacobson et al., 2013) of a triangle soup at each point, ~1 inside, ~0 outside, by brute
+    force over every triangle (see WindingTree), in chunks whose temporaries stay within `memory` bytes
+    """
+    winding = np.empty(points.shape[0])
+    chunk_size = max(1, memory // (PAIR_BYTES * triangles.shape[0]))
+    for start in range(0, points.shape[0], chunk_size):
+        chunk = points[start:start + chunk_size, None, :]
+        winding[start:start + chunk_size] = np.sum(_solid_angles(chunk, triangles[None]), axis=1) / (2 * np.pi)
+    return winding
+
+class WindingTree:
+    """
+    Fast winding numbers (Barill et al., 2018): a bounding volume hierarchy over the triangles where every node keeps the
+    first two terms of the far-field expansion of its triangles about its area-weighted centre: the dipole (the sum of the
+    area vectors) and its first moment. Nodes farther than `accuracy` times their radius contribute the expansion, nearer
+    ones are opened down to leaves of `leaf_size` triangles evaluated exactly.
+    """
+    def __init__(self, triangles: np.ndarray, leaf_size: int = 8, accuracy: float = 2.0) -> None:
+        self.accuracy = accuracy
+        self.leaf_size = leaf_size
+        centroids = triangles.mean(axis=1)
+
+        # top-down median splits along the longest axis of the centroids' bounds, every node a range of `order`
+        starts, ends, children, order = [], [], [], np.arange(triangles.shape[0])
+        stack = [(0, triangles.shape[0], -1, 0)]
+        while stack:
+            start, end, parent, side = stack.pop()
+            node = len(starts)
+            starts.append(start), ends.append(end), children.append([-1, -1])
+            if parent >= 0:
+                children[parent][side] = node
+            if end - start > leaf_size:
+                indices = order[start:end]
+                axis = np.argmax(np.ptp(centroids[indices], axis=0))
+                order[start:end] = indices[np.argsort(centroids[indices, axis], kind='stable')]
+                middle = (start + end) // 2
+                stack.extend([(middle, end, node, 1), (start, middle, node, 0)])
+        self.children = np.array(children)
+        starts, ends = np.array(starts), np.array(ends)
+
+        # node sums over their ranges as differences of prefix sums
+        triangles, centroids = triangles[order], centroids[order]
+        areas = np.cross(triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0]) / 2
+        weights = np.linalg.norm(areas, axis=1)[:, None]
+        total = lambda values: (lambda prefix: prefix[ends] - prefix[starts])(np.concatenate([np.zeros((1,) + values.shape[1:]), np.cumsum(values, axis=0)]))
+        self.dipoles = total(areas)
+        self.centers = total(weights * centroids) / np.maximum(total(weights), 1e-300)
+        uniform = total(weights)[:, 0] <= 1e-300
+        self.centers[uniform] = (total(centroids) / (ends - starts)[:, None])[uniform]
+        # sum of a_t (p_t - centre)^T, about the node's centre
+        self.moments = total(np.einsum('ti,tj->tij', areas, centroids)) - np.einsum('ni,nj->nij', self.dipoles, self.centers)
+
+        # the triangles of every leaf, padded with a degenerate (zero solid angle) triangle
+        self.triangles = np.concatenate([triangles, np.zeros((1, 3, 3))])
+        self.leaves = np.full((len(starts), leaf_size), triangles.shape[0])
+        leaves = np.flatnonzero(self.children[:, 0] < 0)
+        for position in range(leaf_size):
+            index = starts[leaves] + position
+            inside = index < ends[leaves]
+            self.leaves[leaves[inside], position] = index[inside]
+
+        # radius of a ball about the centre holding the node's triangles: exact at the leaves, bounded above them
+        self.radii = np.zeros(len(starts))
+        corners = self.triangles[self.leaves[leaves]].reshape(len(leaves), -1, 3)
+        padded = np.repeat(self.leaves[leaves] == triangles.shape[0], 3, axis=1)
+        self.radii[leaves] = np.where(padded, 0, np.linalg.norm(corners - self.centers[leaves, None, :], axis=2)).max(axis=1)
+        for node in reversed(range(len(starts))):
+            if self.children[node, 0] >= 0:
+                child = self.children[node]
+                self.radii[node] = np.max(np.linalg.norm(self.centers[child] - self.centers[node], axis=1) + self.radii[child])
+
+    def __call__(self, points: np.ndarray, memory: int = 2 ** 26) -> np.ndarray:
+        """Winding number at each point, the (point, node) frontier and leaf evaluations kept within `memory` bytes"""
+        winding = np.zeros(points.shape[0])
+        chunk_size = max(1, memory // (PAIR_BYTES * self.leaf_size))
+        frontier = [(np.arange(points.shape[0]), np.zeros(points.shape[0], dtype=int))]
+        while frontier:
+            indices, nodes = frontier.pop()
+            if len(indices) > chunk_size:
+                # split oversized frontiers, the leaf evaluations allocate per pair
+                frontier.extend((indices[start:start + chunk_size], nodes[start:start + chunk_size]) for start in range(0, len(indices), chunk_size))
+                continue
+            offsets = self.centers[nodes] - points[indices]
+            distances = np.linalg.norm(offsets, axis=1)
+
+            # far field: a.r / |r|^3 and its first order correction tr(M) / |r|^3 - 3 r.M.r / |r|^5, over 4 pi
+            far = distances > self.accuracy * self.radii[nodes]
+            r, length, moments = offsets[far], np.maximum(distances[far], 1e-300), self.moments[nodes[far]]
+            solid = (np.einsum('nk,nk->n', self.dipoles[nodes[far]], r) + np.trace(moments, axis1=1, axis2=2)) / length ** 3 \
+                    - 3 * np.einsum('ni,nij,nj->n', r, moments, r) / length ** 5
+            winding += np.bincount(indices[far], solid / (4 * np.pi), minlength=points.shape[0])
+
+            # near leaves exactly, near internal nodes opened
+            leaf = ~far & (self.children[nodes, 0] < 0)
+            triangles = self.triangles[self.leaves[nodes[leaf]]]
+            exact = np.sum(_solid_angles(points[indices[leaf], None, :], triangles), axis=1) / (2 * np.pi)
+            winding += np.bincount(indices[leaf], exact, minlength=points.shape[0])
+            opened = ~far & ~leaf
+            if opened.any():
+                frontier.append((np.repeat(indices[opened], 2), self.children[nodes[opened]].reshape(-1)))
+        return winding
+
+def block_volumes(corners: np.ndarray) -> np.ndarray:
+    """Volumes of (N, 8, 3) hexahedral blocks through the divergence theorem over the shared box faces"""
+    triangles = corners[:, UNIT_BOX.faces]
+    return np.abs(np.einsum('nfk,nfk->n', triangles[:, :, 0], np.cross(triangles[:, :, 1], triangles[:, :, 2])) / 6)
+
+def block_samples(corners: np.ndarray, samples_per_axis: int) -> np.ndarray:
+    """Regular (N, k^3, 3) grid of points inside each (possibly deformed) block, trilinear in its 8 corners"""
+    steps = (np.arange(samples_per_axis) + 0.5) / samples_per_axis
+    grid = np.stack(np.meshgrid(steps, steps, steps, indexing='ij'), axis=-1).reshape(-1, 3)
+    # weight of every corner at every grid point
+    positive = UNIT_BOX.vertices > 0
+    weights = np.prod(np.where(positive[None, :, :], grid[:, None, :], 1 - grid[:, None, :]), axis=2)
+    return np.einsum('gk,nkd->ngd', weights, corners)
+
+
+class CollisionDetector:
+    """Estimates how much of each tissue block overlaps each anatomical structure of a reference organ"""
+    def __init__(self, 
+                 structures: dict, 
+                 target_name: str = None, 
+                 samples_per_axis: int = 4, 
+                 workers: int = 4, 
+                 memory: int = 2 ** 26, 
+                 crosswalk: dict = None, 
+                 file: str = None) -> None:
+        self.names = list(structures)
+        # node name -> HRA crosswalk entry (label, representation_of, ...), see Registry.crosswalk
+        self.crosswalk = crosswalk or {}
+        self.file = file
+        self.trees = [WindingTree(np.asarray(structures[name].triangles)) for name in self.names]
+        self.bounds = np.stack([structures[name].bounds for name in self.names])
+        self.target_name = target_name
+        self.samples_per_axis = samples_per_axis
+        self.workers = workers
+        # bytes of temporaries per task, `workers` tasks run at once
+        self.memory = memory
+
+    @classmethod
+    def from_target(cls, target_name: str, division_factor: float = 1e3, **kwargs):
+        """
+        Loads the anatomical structures (scene nodes) of an HRA reference organ, in the RUI placement frame of the
+        blocks (the organ's back-bottom-left at the origin, see Registry.target_transform) rather than the GLB world
+        """
+        registry = get_registry()
+        placement = registry.target_transform(target_name, division_factor).matrix
+        scene = trimesh.load(registry.mappings['RUI'][target_name], force='scene')
+        structures = {}
+        for node in scene.graph.nodes_geometry:
+            transform, geometry = scene.graph[node]
+            mesh = scene.geometry[geometry]
+            if isinstance(mesh, trimesh.Trimesh) and len(mesh.faces):
+                structures[node] = mesh.copy().apply_transform(placement @ transform)
+        return cls(structures, target_name, crosswalk=registry.crosswalk(target_name), file=Path(registry.mappings['RUI'][target_name]).name, **kwargs)
+
+    def describe(self, structure: int) -> dict:
+        """The anatomical structure as the RUI locations processor reports it: node IRI, ontology IRI, label and reference organ"""
+        node = self.names[structure]
+        entry = self.crosswalk.get(node)
+        if entry is None:
+            # structures without a crosswalk entry keep their node name
+            return {'as_3d_id': node, 'as_id': None, 'as_label': node, 'reference_organ': None, 'file': self.file}
+        organ = entry.get('anatomical_structure_of', f'#{self.target_name}').lstrip('#')
+        return {'as_3d_id': f'{CCF}{organ}_{node}', 
+                'as_id': entry['representation_of'], 
+                'as_label': entry.get('label', node), 
+                'reference_organ': f'{CCF}{organ}', 
+                'file': self.file}
+
+    def _overlap(self, structure: int, blocks: np.ndarray, samples: np.ndarray) -> np.ndarray:
+        # only the samples inside the structure's bounding box need the winding number
+        points = samples[blocks].reshape(-1, 3)
+        lower, upper = self.bounds[structure]
+        candidates = np.all((points >= lower) & (points <= upper), axis=1)
+        inside = np.zeros(points.shape[0], dtype=bool)
+        inside[candidates] = self.trees[structure](points[candidates], self.memory) > 0.5
+        return inside.reshape(len(blocks), -1).mean(axis=1)
+
+    def collide(self, corners: np.ndarray) -> np.ndarray:
+        """(N, S) fraction of the volume of each of the N blocks inside each of the S structures"""
+        fractions = np.zeros((corners.shape[0], len(self.names)))
+
+        # broad phase: block vs structure bounding boxes, all pairs at once
+        lower, upper = corners.min(axis=1), corners.max(axis=1)
+        overlaps = np.all((lower[:, None, :] <= self.bounds[None, :, 1, :]) & (upper[:, None, :] >= self.bounds[None, :, 0, :]), axis=2)
+
+        # narrow phase: volume sampling, one structure per task
+        samples = block_samples(corners, self.samples_per_axis)
+        candidates = [(structure, np.flatnonzero(overlaps[:, structure])) for structure in range(len(self.names)) if overlaps[:, structure].any()]
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            results = executor.map(lambda candidate: self._overlap(candidate[0], candidate[1], samples), candidates)
+            for (structure, blocks), result in zip(candidates, results):
+                fractions[blocks, structure] = result
+        return fractions
+
+    def summaries(self, corners: np.ndarray, division_factor: float = 1e3) -> list[list[dict]]:
+        """Collisions of every block in the shape of the RUI locations processor's `all_collisions`"""
+        fractions = self.collide(corners)
+        volumes = block_volumes(corners) * division_factor ** 3
+        structures = [self.describe(structure) for structure in range(len(self.names))]
+        summaries = []
+        for index in range(corners.shape[0]):
+            collisions = [{'@type': 'CollisionItem', 
+                           **structures[structure], 
+                           'percentage': fractions[index, structure].item(), 
+                           'as_volume': (fractions[index, structure] * volumes[index]).item()} 
+                          for structure in np.flatnonzero(fractions[index])]
+            summaries.append([{'@type': 'CollisionSummary', 'collision_method': 'MESH', 'collisions': collisions}])
+        return summaries
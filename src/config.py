@@ -0,0 +1,67 @@
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+from dataclass import Transform
+from utils.io import read_yaml, read_glb_nodes
+
+CONFIG_DIR = Path(__file__).parent.parent / 'configs'
+
+
+class Registry:
+    """Atlas paths and HRA transforms, parsed once and shared by every Organ and TissueBlock"""
+    def __init__(self, 
+                 atlas_paths: str = CONFIG_DIR / 'atlas_paths.yaml', 
+                 hra_transforms: str = CONFIG_DIR / 'hra_transforms.yaml', 
+                 mappings: Optional[dict] = None, 
+                 transforms: Optional[dict] = None) -> None:
+        self.mappings = mappings if mappings is not None else self._resolve(read_yaml(atlas_paths), Path(atlas_paths).parent)
+        self.hra_transforms = transforms if transforms is not None else read_yaml(hra_transforms)
+
+        # precompute the target transforms of the organs (in meters)
+        self._target_transforms = {}
+        self._crosswalks = {}
+        for name in self.hra_transforms:
+            self.target_transform(name)
+
+    @staticmethod
+    def _resolve(mappings: dict, root: Path) -> dict:
+        # paths in atlas_paths.yaml are relative, anchor them to the config file instead of the working directory
+        return {section: {name: str((root / path).resolve()) for name, path in paths.items()} 
+                for section, paths in mappings.items()}
+
+    def target_transform(self, name: str, division_factor: float = 1e3) -> Transform:
+        """Transform shifting the target HRA organ (its back-bottom-left) to the world origin (0, 0, 0)"""
+        key = (name, division_factor)
+        if key not in self._target_transforms:
+            hra_transform = self.hra_transforms[name]
+            self._target_transforms[key] = Transform(hra_transform['scaling'], 
+                                                     hra_transform['rotation'], 
+                                                     np.array(hra_transform['translation']) / division_factor)
+        return self._target_transforms[key]
+
+    def crosswalk(self, name: str) -> dict:
+        """
+        The HRA crosswalk of a reference organ, read from its .glb once: node name -> the node's extras (label, 
+        representation_of ontology IRI, anatomical_structure_of, ...), for the nodes that carry one
+        """
+        if name not in self._crosswalks:
+            nodes = read_glb_nodes(self.mappings['RUI'][name])
+            self._crosswalks[name] = {node: data['extras'] for node, data in nodes.items() if data.get('extras', {}).get('representation_of')}
+        return self._crosswalks[name]
+
+_registry = None
+
+def get_registry() -> Registry:
+    """The process-wide registry, created on first use"""
+    global _registry
+    if _registry is None:
+        _registry = Registry()
+    return _registry
+
+def set_registry(registry: Optional[Registry]) -> Optional[Registry]:
+    """Injects a registry (e.g. for tests), returns the previous one, None resets to the default configs"""
+    global _registry
+    previous, _registry = _registry, registry
+    return previous
@@ -1,17 +1,19 @@
+import uuid
 import pickle
 import trimesh
 import numpy as np
 import open3d as o3d
 
 from typing import Any, Optional
-from dataclasses import dataclass
+from functools import cached_property
+from dataclasses import dataclass, fields, asdict, replace
 from utils.preprocess import mean
+from utils.io import read_json, write_json, content_hash
 from utils.conversions import to_array, to_pointcloud, to_mesh
 
-from copy import deepcopy
 from pathlib import Path
 from scipy.spatial.transform import Rotation  
-from scipy.interpolate import NearestNDInterpolator
+from scipy.spatial import cKDTree
 
 
 @dataclass
@@ -23,6 +25,9 @@ class Transform:
     matrix: np.ndarray = None
     rotate_axes: str = 'xyz'
     apply: bool = True
+    control_points: Optional[np.ndarray] = None
+    dvf_neighbors: int = 1
+    dvf_chunk_size: int = 65536
 
     def __post_init__(self):
         if isinstance(self.matrix, np.ndarray):
@@ -43,41 +48,184 @@ class Transform:
             self.matrix[3, :] = [0, 0, 0, 1]
 
     def transform(self, geometry, invert=False):
-        if isinstance(geometry, o3d.geometry.PointCloud):
-            return geometry.transform(self.matrix if not invert else self.inverse)
+        matrix = self.matrix if not invert else self.inverse
+        if isinstance(geometry, np.ndarray):
+            return geometry @ matrix[:3, :3].T + matrix[:3, 3]
+        elif isinstance(geometry, o3d.geometry.PointCloud):
+            # copy-on-write, the input cloud may be shared with other steps
+            return o3d.geometry.PointCloud(geometry).transform(matrix)
         else: 
-            return geometry.apply_transform(self.matrix if not invert else self.inverse)
+            # copy-on-write as well, the mesh may be shared
+            return _copy_mesh(geometry).apply_transform(matrix)
         
     def invert(self, geometry):
         if isinstance(self.deformation_vector_field, np.ndarray):
-            raise ValueError("Inversion not supported on DVF transformations")
+            # undo s * R @ (x + t) analytically, then the displacement by fixed-point iteration
+            array = to_array(geometry) @ np.linalg.inv(self.scale * np.asarray(self.rotate)).T - self.translate
+            array = array + self.inverse_displacement(array)
+            if hasattr(self, "centered"):
+                array = array + self.mean
+            return _like(array, geometry)
         self.inverse = np.linalg.inv(self.matrix)
         geometry = self.transform(geometry, invert=True)
         if hasattr(self, "centered"):
-            array = to_array(geometry) + self.mean
-            geometry = to_pointcloud(array) if isinstance(geometry, o3d.geometry.PointCloud) else to_mesh(array, geometry.faces)
+            geometry = _like(to_array(geometry) + self.mean, geometry)
         return geometry
     
     def center(self, geometry):
         self.centered = True
         if not hasattr(self, "mean"):
             self.mean = mean(geometry)
-        array = to_array(geometry) - self.mean
-        geometry = to_pointcloud(array) if isinstance(geometry, o3d.geometry.PointCloud) else to_mesh(array, geometry.faces)
-        return geometry
+        return _like(to_array(geometry) - self.mean, geometry)
+
+    def affine(self, invert=False):
+        """The 4x4 matrix equivalent of calling (or inverting) this transform, including the centering"""
+        if isinstance(self.deformation_vector_field, np.ndarray):
+            # the part applied after the displacement: s * R @ (x + t)
+            matrix = np.eye(4)
+            matrix[:3, :3] = self.scale * np.asarray(self.rotate)
+            matrix[:3, 3] = matrix[:3, :3] @ np.asarray(self.translate)
+            return matrix
+        centering = np.eye(4)
+        if hasattr(self, "centered"):
+            centering[:3, 3] = self.mean if invert else -self.mean
+        return centering @ np.linalg.inv(self.matrix) if invert else self.matrix @ centering
+
+    @property
+    def index(self) -> cKDTree:
+        """Spatial index over the control points the deformation vector field is defined on (built once, pickled along)"""
+        if getattr(self, "_index", None) is None:
+            self._index = cKDTree(self.control_points)
+        return self._index
+
+    def displacement(self, array):
+        """Looks up the deformation vector field at the given (N, 3) points"""
+        if self.control_points is None:
+            # transforms created before the control points were stored
+            if hasattr(self, "interpolated_dvf"):
+                return self.interpolated_dvf(array)
+            self.control_points = np.array(array)
+
+        # query in chunks to bound the memory of the neighbour arrays
+        displacement = np.empty((array.shape[0], self.deformation_vector_field.shape[1]))
+        for start in range(0, array.shape[0], self.dvf_chunk_size):
+            chunk = slice(start, start + self.dvf_chunk_size)
+            distances, neighbours = self.index.query(array[chunk], k=self.dvf_neighbors)
+            if self.dvf_neighbors == 1:
+                displacement[chunk] = self.deformation_vector_field[neighbours]
+            else:
+                # inverse distance weighting of the k nearest control points
+                weights = 1 / np.maximum(distances, 1e-12)
+                weights /= weights.sum(axis=1, keepdims=True)
+                displacement[chunk] = np.einsum('nk,nkd->nd', weights, self.deformation_vector_field[neighbours])
+        return displacement
+
+    @property
+    def inverse_index(self) -> cKDTree:
+        """Spatial index over the displaced control points, where the inverse lookup starts from"""
+        if getattr(self, "_inverse_index", None) is None:
+            if self.control_points is None:
+                raise ValueError("Inversion needs the control points of the deformation vector field")
+            self._inverse_index = cKDTree(self.control_points + self.deformation_vector_field)
+        return self._inverse_index
+
+    def inverse_displacement(self, array, iterations: int = 50, tolerance: float = 1e-9):
+        """
+        Displacement that undoes the deformation vector field at the given (N, 3) points y, i.e. x - y for x + displacement(x) = y.
+        Solved by the fixed-point iteration x <- y - displacement(x), started from the displaced control point nearest to y.
+        Points that have not converged after `iterations` keep the estimate with the smallest residual.
+        """
+        array = np.asarray(array, dtype=np.float64)
+        _, nearest = self.inverse_index.query(array)
+        estimate = array - self.deformation_vector_field[nearest]
+
+        best, residual = estimate.copy(), np.full(array.shape[0], np.inf)
+        active = np.arange(array.shape[0])
+        for _ in range(iterations):
+            displacement = self.displacement(estimate[active])
+            error = np.linalg.norm(estimate[active] + displacement - array[active], axis=1)
+            improved = error < residual[active]
+            best[active[improved]], residual[active[improved]] = estimate[active[improved]], error[improved]
+
+            # only the points that have not converged are looked up again
+            estimate[active] = array[active] - displacement
+            active = active[error > tolerance]
+            if active.size == 0:
+                break
+        return best - array
 
     def __call__(self, geometry, center=False):
         if hasattr(self, "centered") or center == True:
             geometry = self.center(geometry)
         if isinstance(self.deformation_vector_field, np.ndarray):
-            geometry = to_array(geometry)
-            if not hasattr(self, "interpolated_dvf"):
-                self.interpolated_dvf = NearestNDInterpolator(geometry, self.deformation_vector_field)
-            geometry = ((self.scale * self.rotate) @ ((geometry + self.interpolated_dvf(geometry)) + self.translate).T).T
-            return to_pointcloud(geometry)
+            array = to_array(geometry)
+            array = ((self.scale * self.rotate) @ ((array + self.displacement(array)) + self.translate).T).T
+            return array if isinstance(geometry, np.ndarray) else to_pointcloud(array)
         else:
             return self.transform(geometry)
+
+    def to_dict(self, save) -> dict:
+        """JSON-able description of the transform, arrays are handed to `save(name, array)` which returns a reference"""
+        data = {'arrays': {}}
+        for field in fields(self):
+            value = getattr(self, field.name)
+            if isinstance(value, np.ndarray):
+                data['arrays'][field.name] = save(field.name, value)
+            else:
+                data[field.name] = list(value) if isinstance(value, tuple) else value
+
+        # state picked up while the pipeline ran
+        if hasattr(self, "centered"):
+            data['arrays']['mean'] = save('mean', self.mean)
+        data['centered'] = hasattr(self, "centered")
+        data['inverted'] = hasattr(self, "inverse")
+        return data
+
+    @classmethod
+    def from_dict(cls, data: dict, load):
+        """Inverse of to_dict, arrays are resolved lazily through `load(reference)`"""
+        values = {field.name: data[field.name] for field in fields(cls) if field.name in data}
+        values.update({name: load(reference) for name, reference in data['arrays'].items() if name != 'mean'})
+        transform = cls(**values)
+        if data['centered']:
+            transform.centered = True
+            transform.mean = load(data['arrays']['mean'])
+        if data['inverted']:
+            transform.inverse = np.linalg.inv(transform.matrix)
+        return transform
+
+def _copy_mesh(mesh: trimesh.base.Trimesh) -> trimesh.base.Trimesh:
+    """A copy of the mesh (its vertices not shared) that keeps the class and attributes of a subclass such as TissueBlock"""
+    copied = mesh.copy()
+    if type(copied) is not type(mesh):
+        copied.__class__ = type(mesh)
+        copied.__dict__.update({name: value for name, value in vars(mesh).items() if name not in vars(copied)})
+    return copied
+
+def _like(array, geometry):
+    """Wraps a (new) array of vertices in the same kind of geometry as `geometry`"""
+    if isinstance(geometry, np.ndarray):
+        return array
+    elif isinstance(geometry, o3d.geometry.PointCloud):
+        return to_pointcloud(array)
+    else:
+        return to_mesh(array, geometry.faces)
         
+@dataclass
+class StepProfile:
+    """Resources used by one invocation of a pipeline step, times in seconds and memory in bytes"""
+    start: float
+    wall_time: float
+    cpu_time: float
+    subprocess_time: float
+    peak_rss_delta: int
+    input_points: int
+    output_points: int
+    cached: bool = False
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
 @dataclass
 class PipelineStep:
     name: str
@@ -86,6 +234,36 @@ class PipelineStep:
     output: o3d.geometry.PointCloud = None
     transform: Optional[dict[Transform]] = None
     logs: Optional[str] = None
+    profile: Optional[StepProfile] = None
+
+@dataclass
+class MeshReference:
+    """Stands in for a mesh that is referenced (by path and content hash) instead of embedded in a projection"""
+    name: str
+    path: Optional[str]
+    sha256: str
+
+    @classmethod
+    def from_mesh(cls, mesh):
+        return cls(name=getattr(mesh, 'name', None), 
+                   path=str(mesh.path) if getattr(mesh, 'path', None) else None, 
+                   sha256=content_hash(mesh.vertices, mesh.faces))
+
+    def load(self) -> 'Organ':
+        """Loads the referenced mesh, checking it is the one the projection was made with"""
+        from organ import Organ
+        from config import get_registry
+        if self.path is None:
+            raise ValueError(f"{self.name} is referenced without a path, it can't be loaded")
+        # RUI reference organs are loaded from the registry by name
+        if not Path(self.path).exists() and Path(self.path).stem not in get_registry().mappings['RUI']:
+            raise FileNotFoundError(f"{self.name} is referenced at {self.path}, which does not exist")
+
+        organ = Organ(self.path)
+        sha256 = content_hash(organ.vertices, organ.faces)
+        if sha256 != self.sha256:
+            raise ValueError(f"{self.path} is not the mesh {self.name} was referenced with (sha256 {sha256}, expected {self.sha256})")
+        return organ
 
 @dataclass
 class Projection:
@@ -96,43 +274,189 @@ class Projection:
     transformations: list[dict[Transform]]
     registration: trimesh.base.Trimesh
     params: dict
+    inverted: bool = False
+    round_trip_error: Optional[dict] = None
+
+    # 2: inverted projections (derived target -> source projections), forward projections are still written as 1
+    FORMAT_VERSION = 2
 
     @classmethod
-    def load(cls, path: str):
-         # load from pickle
-        with open(path, 'rb') as file:
-            cls = pickle.load(file)
-        return cls
+    def load(cls, path: str, mmap_mode: Optional[str] = 'r'):
+        path = Path(path)
+        manifest_path = path / 'projection.json' if path.is_dir() else path
+        if path.is_dir() and not manifest_path.exists():
+            # a directory exported before the versioned format
+            manifest_path = path / 'projections.pickle'
+        if manifest_path.suffix != '.json':
+            # load from pickle (projections exported before the versioned format)
+            with open(manifest_path, 'rb') as file:
+                cls = pickle.load(file)
+            return cls
+
+        manifest = read_json(manifest_path)
+        if manifest['version'] > cls.FORMAT_VERSION:
+            raise ValueError(f"Projection format version {manifest['version']} is newer than the supported version {cls.FORMAT_VERSION}")
+
+        # arrays are memory-mapped, nothing is read until it is used
+        load = lambda reference: np.load(manifest_path.parent / reference, mmap_mode=mmap_mode)
+
+        return cls(id=manifest['id'], 
+                   description=manifest['description'], 
+                   source=MeshReference(**manifest['source']), 
+                   target=MeshReference(**manifest['target']), 
+                   transformations=[(transform['name'], Transform.from_dict(transform['transform'], load)) for transform in manifest['transformations']], 
+                   registration=trimesh.Trimesh(vertices=load(manifest['registration']['vertices']), 
+                                                faces=load(manifest['registration']['faces']), 
+                                                process=False), 
+                   params=manifest['params'], 
+                   inverted=manifest.get('inverted', False), 
+                   round_trip_error=manifest.get('round_trip_error'))
          
     def export(self, path: str):
         # create the parent directory with the id
         parent_dir = Path(f'{path}-{self.id}')
-        parent_dir.mkdir()
+        parent_dir.joinpath('arrays').mkdir(parents=True)
 
-        # save as pickle
-        with open(parent_dir / 'projections.pickle', 'wb') as file:
-            pickle.dump(self, file)
-            
-    def project(self, geometry):
-        # get pointcloud
-        # TO DO: make concatenated transforms work on Tissue / Organ objects as well
-        # currently, they work on pointclouds and arrays only
-        if hasattr(geometry, 'pointcloud'):
-            pointcloud = deepcopy(geometry.pointcloud)
-        else:
-            pointcloud = to_pointcloud(geometry)
+        def save(name, array):
+            # arrays are named by their content hash, so re-saving an identical array is a no-op
+            array = np.ascontiguousarray(array)
+            reference = f'arrays/{name}-{content_hash(array)[:16]}.npy'
+            if not parent_dir.joinpath(reference).exists():
+                np.save(parent_dir / reference, array)
+            return reference
+
+        manifest = {'format': 'hra-amap-projection', 
+                    'version': 2 if self.inverted else 1, 
+                    'id': str(self.id), 
+                    'description': self.description, 
+                    'params': self.params, 
+                    'inverted': self.inverted, 
+                    'round_trip_error': self.round_trip_error, 
+                    'source': vars(self.source if isinstance(self.source, MeshReference) else MeshReference.from_mesh(self.source)), 
+                    'target': vars(self.target if isinstance(self.target, MeshReference) else MeshReference.from_mesh(self.target)), 
+                    'registration': {'vertices': save('registration_vertices', self.registration.vertices), 
+                                     'faces': save('registration_faces', self.registration.faces)}, 
+                    'transformations': [{'name': name, 
+                                         'transform': transform.to_dict(lambda field, array: save(f'{index}_{field}', array))} 
+                                        for index, (name, transform) in enumerate(self.transformations)]}
+
+        # save the metadata as json
+        write_json(parent_dir / 'projection.json', manifest)
 
+    @cached_property
+    def chain(self) -> list[tuple]:
+        """Compiles the transformations into ('affine', 4x4) blocks around the ('dvf', Transform) lookups"""
+        chain, matrix = [], np.eye(4)
         for (_, transform) in self.transformations:
-            # apply projections
-            if transform.apply:
-                pointcloud = transform(pointcloud) if not hasattr(transform, "inverse") else transform.invert(pointcloud)
+            if not transform.apply:
+                continue
+            if isinstance(transform.deformation_vector_field, np.ndarray):
+                # everything up to here collapses into a single affine, applied before the lookup
+                centering = np.eye(4)
+                if hasattr(transform, "centered"):
+                    centering[:3, 3] = -transform.mean
+                chain.extend([('affine', centering @ matrix), ('dvf', transform)])
+                matrix = np.eye(4)
+            matrix = transform.affine(invert=hasattr(transform, "inverse")) @ matrix
+        chain.append(('affine', matrix))
+        if self.inverted:
+            # undone back to front: the affine blocks analytically, the lookups by fixed-point iteration
+            chain = [('affine', np.linalg.inv(operation)) if kind == 'affine' else ('inverse_dvf', operation) 
+                     for kind, operation in reversed(chain)]
+        return chain
 
-        # move pointcloud back to hra target position
-        if hasattr(geometry, 'target_transform'): 
-            pointcloud = geometry.target_transform(pointcloud) if geometry.target_transform else pointcloud
+    def inverse(self) -> 'Projection':
+        """
+        The target -> source projection derived from this one, without registering again. Its registration is the
+        target mapped onto the source and `round_trip_error` holds the distances of target -> source -> target.
+        """
+        inverse = replace(self, 
+                          id=uuid.uuid4(), 
+                          description=f"Inverse of {self.description or self.id} ({self.id}), derived without registration", 
+                          source=self.target, 
+                          target=self.source, 
+                          inverted=not self.inverted, 
+                          round_trip_error=None)
+
+        # the vertices of the target, the registered source stands in when the target mesh is not at hand
+        target = self.target
+        if isinstance(target, MeshReference) and target.path:
+            try:
+                target = target.load()
+            except FileNotFoundError:
+                pass
+        if not isinstance(target, trimesh.base.Trimesh):
+            target = self.registration
+        vertices = np.asarray(target.vertices)
+        projected = inverse.project_array(vertices)
+        inverse.registration = trimesh.Trimesh(vertices=projected, faces=target.faces, process=False)
+
+        distances = np.linalg.norm(self.project_array(projected) - vertices, axis=1)
+        inverse.round_trip_error = {'mean': float(distances.mean()), 
+                                    'median': float(np.median(distances)), 
+                                    'p95': float(np.percentile(distances, 95)), 
+                                    'max': float(distances.max())}
+        return inverse
+
+    def project_array(self, array: np.ndarray) -> np.ndarray:
+        """Runs an (N, 3) array through the compiled chain (without any target transform)"""
+        for kind, operation in self.chain:
+            if kind == 'affine':
+                array = array @ operation[:3, :3].T + operation[:3, 3]
+            elif kind == 'dvf':
+                array = array + operation.displacement(array)
+            else:
+                array = array + operation.inverse_displacement(array)
+        return array
+
+    def place(self, array: np.ndarray, target_transform: Optional[Transform]) -> np.ndarray:
+        """
+        Moves projected vertices to the RUI placement frame of their (input) placement target, the frame every projected
+        rui_location is written in. Both directions end there: the organ frames are taken to coincide with the GLB frame
+        of the placement target on either side, so an inverted projection places blocks on the source organ exactly as a
+        registered backward projection (results/Projections/Backward) does, and undoes its forward projection in RUI terms
+        """
+        return target_transform(array) if target_transform else array
+
+    def project(self, geometry):
+        # vertices as an (N, 3) array, the geometry itself is not touched
+        array = to_array(geometry)
+
+        # run the compiled chain
+        array = self.project_array(array)
+
+        # move back to hra target position
+        array = self.place(array, getattr(geometry, 'target_transform', None))
 
         # assign the transformation to the geometry object
         if isinstance(geometry, trimesh.base.Trimesh):
-            geometry.vertices = np.array(pointcloud.points)
-        
-        return geometry           
\ No newline at end of file
+            geometry.vertices = array
+            return geometry
+        return to_pointcloud(array) if isinstance(geometry, o3d.geometry.PointCloud) else array
+
+    def project_many(self, geometries: list):
+        """Projects many geometries (e.g. tissue blocks) through a single pass of the compiled chain"""
+        arrays = [to_array(geometry) for geometry in geometries]
+        projected = self.project_array(np.concatenate(arrays))
+        offsets = np.cumsum([0] + [array.shape[0] for array in arrays])
+
+        # move back to the hra target positions, one matrix product per distinct target transform
+        groups = {}
+        for index, geometry in enumerate(geometries):
+            target_transform = getattr(geometry, 'target_transform', None)
+            if target_transform:
+                groups.setdefault(target_transform.matrix.tobytes(), (target_transform, []))[1].append(index)
+        for target_transform, indices in groups.values():
+            rows = np.concatenate([np.arange(offsets[index], offsets[index + 1]) for index in indices])
+            projected[rows] = self.place(projected[rows], target_transform)
+
+        # assign the transformations to the geometry objects
+        results = []
+        for index, geometry in enumerate(geometries):
+            array = projected[offsets[index]:offsets[index + 1]]
+            if isinstance(geometry, trimesh.base.Trimesh):
+                geometry.vertices = array
+                results.append(geometry)
+            else:
+                results.append(to_pointcloud(array) if isinstance(geometry, o3d.geometry.PointCloud) else array)
+        return results
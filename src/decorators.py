@@ -1,23 +1,43 @@
-from dataclass import PipelineStep
+import numpy as np
 
+from dataclass import PipelineStep, StepProfile
+from utils.profiling import measure, points
 
-def step(name, description):
-  # initialize step
-  step = PipelineStep(name, description)
 
+def step(name, description):
   # execute step
   def execute_step(func):
-    def wrapper(**kwargs):
+    def wrapper(cache=None, **kwargs):
+      # every call gets its own record, so repeated runs do not overwrite each other
+      step = PipelineStep(name, description)
+
       # record inputs
-      step.inputs = {'Source': kwargs['source'], 'Target': kwargs['target']}
+      step.input = {'Source': kwargs['source'], 'Target': kwargs['target']}
+
+      # execute function (or reuse a cached result), measuring the resources it uses (including the BCPD subprocess)
+      with measure({}) as usage:
+        key = cache.key(func, kwargs) if cache is not None else None
+        entry = cache.get(key) if key else None
+        if entry is None:
+          outputs, transforms = func(**kwargs)
+          if key:
+            cache.put(key, (outputs, transforms))
+        else:
+          outputs, transforms = entry
 
-      # execute function
-      outputs, transforms = func(**kwargs)
+      # outputs are shared (not copied) with the following steps, so freeze them
+      for output in (outputs or {}).values():
+        if isinstance(output, np.ndarray):
+          output.flags.writeable = False
 
       # record outputs
       step.output = outputs
       step.transform = transforms
+      step.profile = StepProfile(**usage,
+                                 input_points=points(kwargs['source']),
+                                 output_points=points((outputs or {}).get('Source')),
+                                 cached=entry is not None)
 
       return step
     return wrapper
-  return execute_step
\ No newline at end of file
+  return execute_step
@@ -4,8 +4,8 @@ import numpy as np
 
 from pathlib import Path
 
-from dataclass import Transform
-from utils.io import load, read_yaml
+from config import get_registry
+from utils.cache import load_mesh
 from utils.conversions import to_array, to_pointcloud
 
 class Organ(trimesh.Trimesh):
@@ -14,15 +14,16 @@ class Organ(trimesh.Trimesh):
         self.path = Path(path)
         self.name = self.path.stem
         self.file_type = self.path.suffix if self.path.suffix else '.glb'
-        self.mappings = read_yaml('../configs/atlas_paths.yaml')
-        self.hra_transforms = read_yaml('../configs/hra_transforms.yaml')
+        self.registry = get_registry()
+        self.mappings = self.registry.mappings
+        self.hra_transforms = self.registry.hra_transforms
         if metadata:
             self.metadata = metadata
         if self.name in self.mappings['RUI']:
-            self.faces, self.vertices = load(self.mappings['RUI'][self.name], self.file_type)
+            self.faces, self.vertices = load_mesh(self.mappings['RUI'][self.name], self.file_type)
             self.target_transform = self._get_transform()
         else:
-            self.faces, self.vertices = load(self.path, self.file_type)
+            self.faces, self.vertices = load_mesh(self.path, self.file_type)
             self.target_transform = None
 
     @property
@@ -35,11 +36,7 @@ class Organ(trimesh.Trimesh):
 
     def _get_transform(self):
         """Get the necessary transform shift the target HRA organ (it's back-bottom-left) to the world origin (0, 0, 0)"""
-        hra_transform = self.hra_transforms[self.name]
-        target_transform = Transform(hra_transform['scaling'], 
-                                     hra_transform['rotation'], 
-                                     np.array(hra_transform['translation']) / 1e3)
-        return target_transform
+        return self.registry.target_transform(self.name)
     
 
     
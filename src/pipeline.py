@@ -1,5 +1,18 @@
+import math
+import time
+import atlas
+import autotune
 import yaml
 import uuid
+import itertools
+import traceback
+import numpy as np
+import pandas as pd
+
+from typing import Optional
+from dataclasses import replace
+from queue import Queue, Empty
+from multiprocessing import Pool
 
 from copy import deepcopy
 from scipy.spatial import distance
@@ -7,73 +20,319 @@ from scipy.spatial import distance
 from organ import Organ
 from dataclass import Projection
 from steps import *
-from utils.conversions import to_mesh
+from utils.conversions import Geometry, to_mesh, readonly
+from utils import profiling
+from utils.cache import StageCache
 from utils.metrics import sinkhorn, chamfer, hausdorff
 
+METRICS = {'chamfer': chamfer, 'hausdorff': hausdorff}
+RIGID_STAGES = ('normalize_rigid', 'global_registration', 'refine_registration', 'normalize_nonrigid')
+NONRIGID_STAGES = ('nonrigid_registration', 'denormalize_nonrigid', 'denormalize_rigid')
+
+# shared with the search worker processes once, instead of with every trial
+_search = {}
+
 
 class Pipeline():
-    def __init__(self, name: str, description: str, params: str) -> None:
+    def __init__(self, name: str, description: str, params: str | dict) -> None:
         self.__id = uuid.uuid4()
         self.name = name
         self.description = description
         self.steps = {}
-        with open(params) as f:
-            self.params = yaml.safe_load(f)
+        if isinstance(params, dict):
+            self.params = deepcopy(params)
+        else:
+            with open(params) as f:
+                self.params = yaml.safe_load(f)
+
+    def _hyperparamter_search(self,
+                              source: Organ,
+                              target: Organ,
+                              space: dict,
+                              strategy: str = 'grid',
+                              trials: Optional[int] = None,
+                              metric: str = 'chamfer',
+                              workers: int = 4,
+                              budget: Optional[float] = None,
+                              target_score: Optional[float] = None,
+                              patience: Optional[int] = None,
+                              eta: int = 3,
+                              min_iterations: int = 50,
+                              seed: int = 0,
+                              cache: Optional[StageCache | bool] = None) -> tuple:
+        """
+        Searches the nonrigid_registration params in `space` (name -> list of values, or (low, high) range for random search).
+        The rigid stages run once, the non-rigid trials run in a process pool and are scored with `metric` against the target.
+
+        strategy: 'grid' (every combination), 'random' (`trials` samples, 16 by default) or 'halving' (successive halving of
+                  `trials` random samples, keeping the best 1/eta and running them with eta times more BCPD iterations each round)
+        budget: wall-clock seconds after which no new trial starts, trials still running then are stopped and reported as abandoned
+        target_score / patience: stop early once a trial scores at most `target_score`, or after `patience` trials without improvement
+
+        Returns the best Projection and the table of all trials.
+        """
+        if metric not in METRICS:
+            raise ValueError(f"{metric} not recognized, must be one of {', '.join(METRICS)}")
+        cache = StageCache() if cache is True else (cache or None)
+        deadline = time.perf_counter() + budget if budget else math.inf
+        rng = np.random.default_rng(seed)
+
+        # candidates
+        if strategy == 'grid':
+            if trials is not None:
+                raise ValueError("trials does not apply to the grid strategy, which runs every combination of the space")
+            candidates = [dict(zip(space, values)) for values in itertools.product(*space.values())]
+        elif strategy in ('random', 'halving'):
+            candidates = [{name: _sample(values, rng) for name, values in space.items()} for _ in range(trials or 16)]
+        else:
+            raise ValueError(f"{strategy} not recognized, must be one of grid, random or halving")
+
+        # Steps 1-4 are shared by all trials
+        self._rigid_stages(readonly(source), readonly(target), cache)
+        shared = {name: replace(self.steps[name], input=None) for name in RIGID_STAGES if name in self.steps}
+
+        # successive halving raises the iteration budget of the surviving candidates every round
+        max_iterations = int(self.params['nonrigid_registration']['max_iterations'])
+        iterations = min(min_iterations, max_iterations) if strategy == 'halving' else max_iterations
 
-    def _hyperparamter_search():
-        raise NotImplementedError
-    
-    def _autotune():
-        raise NotImplementedError
+        records, best, state = [], None, {'best': math.inf, 'stale': 0, 'stop': False}
+        # a pool rather than an executor, its workers can be terminated when the budget runs out
+        pool = Pool(processes=workers,
+                    initializer=_initialize_search,
+                    initargs=(shared, source.faces, np.asarray(target.vertices), target.faces, metric, cache))
+        try:
+            for rung in itertools.count():
+                params = [{**self.params['nonrigid_registration'], **candidate, 'max_iterations': iterations} for candidate in candidates]
+                results, abandoned = _execute(pool, params, workers, deadline, target_score, patience, state)
 
-    def run(self, source: Organ, target: Organ):
+                # trial table
+                scored = []
+                for index, (candidate, result) in enumerate(zip(candidates, results)):
+                    record = {'trial': len(records), 'round': rung, 'max_iterations': iterations, **candidate}
+                    if index in abandoned:
+                        record.update({'wall_time': abandoned[index], 'status': 'abandoned'})
+                    elif result is None:
+                        record['status'] = 'skipped'
+                    else:
+                        score, steps, wall_time, error = result
+                        record.update({metric: score, 'wall_time': wall_time, 'status': 'failed' if error else 'done', 'error': error})
+                        if error is None:
+                            scored.append((score, index, steps))
+                    records.append(record)
+
+                # the best of the last (highest fidelity) round wins
+                if scored:
+                    score, index, steps = min(scored, key=lambda item: item[0])
+                    best = ({**candidates[index], 'max_iterations': iterations}, steps)
+
+                if strategy != 'halving' or state['stop'] or time.perf_counter() >= deadline or len(scored) <= 1 or iterations >= max_iterations:
+                    break
+                survivors = sorted(scored, key=lambda item: item[0])[:max(1, math.ceil(len(scored) / eta))]
+                candidates = [candidates[index] for _, index, _ in survivors]
+                iterations = min(iterations * eta, max_iterations)
+        finally:
+            # trials still running past the budget are abandoned, their workers stopped rather than left to finish
+            _terminate(pool)
+
+        table = pd.DataFrame(records)
+        if best is None:
+            raise RuntimeError(f"No trial finished, see the trial table:\n{table.to_string(index=False)}")
+
+        # consolidate the best trial
+        candidate, steps = best
+        self.params['nonrigid_registration'].update(candidate)
+        self.steps.update(steps)
+        return self._consolidate(source, target), table
+
+    def _autotune(self, source_array, target_array) -> list:
+        """Fits the rigid voxel size and the non-rigid downsampling / Nystrom ranks to the (unit normalized) organs and the budget"""
+        suggestion = autotune.suggest(source_array, target_array, self.params['rigid_registration'], self.params['nonrigid_registration'])
+
+        # the chosen values are kept in the params, so the projection records them
+        self.params['rigid_registration'].update(suggestion.rigid)
+        for key, value in suggestion.nonrigid.items():
+            if value is None:
+                self.params['nonrigid_registration'].pop(key, None)
+            else:
+                self.params['nonrigid_registration'][key] = value
+        self.autotune_log = suggestion.reasons
+        return suggestion.reasons
+
+    def _rigid_stages(self, source_array, target_array, cache=None):
         # Step 1: Normalize (ICP)
-        self.steps['normalize_rigid'] = normalize_rigid(source=deepcopy(source.pointcloud), 
-                                                        target=deepcopy(target.pointcloud))
-
-        # Step 2: Global (Fast) Registration
-        self.steps['global_registration'] = global_registration(source=deepcopy(self.steps['normalize_rigid'].output['Source']), 
-                                                                target=deepcopy(self.steps['normalize_rigid'].output['Target']), 
-                                                                params=self.params['rigid_registration'])
-        
-        # Step 3: Rigid Registration
-        self.steps['refine_registration'] = refine_registration(source=deepcopy(self.steps['normalize_rigid'].output['Source']), 
-                                                                target=deepcopy(self.steps['normalize_rigid'].output['Target']),
-                                                                transform=self.steps['global_registration'].transform, 
-                                                                params=self.params['rigid_registration'])
+        self.steps['normalize_rigid'] = normalize_rigid(source=source_array,
+                                                        target=target_array,
+                                                        cache=cache)
+
+        # pick the voxel size, downsampling and Nystrom ranks from the normalized organs
+        if autotune.enabled(self.params['nonrigid_registration']):
+            self._autotune(self.steps['normalize_rigid'].output['Source'], self.steps['normalize_rigid'].output['Target'])
+
+        # the target side of Steps 2-3 is precomputed for the reference organs (see atlas.py),
+        # otherwise its point cloud (and normals) are built once and shared
+        atlas_index = atlas.find(target_array)
+        target = Geometry(self.steps['normalize_rigid'].output['Target'])
+
+        # Steps 2-3: Rigid Registration, coarse-to-fine over a voxel pyramid or global + refine at a single scale
+        if self.params['rigid_registration'].get('mode', 'single') == 'multiscale':
+            self.steps.pop('global_registration', None)
+            self.steps['refine_registration'] = multiscale_registration(source=self.steps['normalize_rigid'].output['Source'],
+                                                                        target=target,
+                                                                        params=self.params['rigid_registration'],
+                                                                        atlas=atlas_index,
+                                                                        cache=cache)
+        else:
+            # Step 2: Global (Fast) Registration
+            self.steps['global_registration'] = global_registration(source=self.steps['normalize_rigid'].output['Source'],
+                                                                    target=target,
+                                                                    params=self.params['rigid_registration'],
+                                                                    atlas=atlas_index,
+                                                                    cache=cache)
+
+            # Step 3: Rigid Registration
+            self.steps['refine_registration'] = refine_registration(source=self.steps['normalize_rigid'].output['Source'],
+                                                                    target=target,
+                                                                    transform=self.steps['global_registration'].transform,
+                                                                    params=self.params['rigid_registration'],
+                                                                    atlas=atlas_index,
+                                                                    cache=cache)
 
         # Step 4: Normalize (BCPD)
-        self.steps['normalize_nonrigid'] = normalize_nonrigid(source=deepcopy(self.steps['refine_registration'].output['Source']), 
-                                                              target=deepcopy(self.steps['normalize_rigid'].output['Target']))
+        self.steps['normalize_nonrigid'] = normalize_nonrigid(source=self.steps['refine_registration'].output['Source'],
+                                                              target=self.steps['normalize_rigid'].output['Target'],
+                                                              cache=cache)
 
+    def _nonrigid_stages(self, cache=None):
         # Step 5: Non-rigid Registration (BCPD)
-        self.steps['nonrigid_registration'] = nonrigid_registration(source=deepcopy(self.steps['normalize_nonrigid'].output['Source']), 
-                                                                    target=deepcopy(self.steps['normalize_nonrigid'].output['Target']),
-                                                                    params=self.params['nonrigid_registration'])
+        self.steps['nonrigid_registration'] = nonrigid_registration(source=self.steps['normalize_nonrigid'].output['Source'],
+                                                                    target=self.steps['normalize_nonrigid'].output['Target'],
+                                                                    params=self.params['nonrigid_registration'],
+                                                                    cache=cache)
 
         # Step 6: Denormalization (BCPD)
-        self.steps['denormalize_nonrigid'] = denormalize_nonrigid(source=deepcopy(self.steps['nonrigid_registration'].output['Source']),
-                                                                  target=deepcopy(self.steps['nonrigid_registration'].output['Source']),
-                                                                  transforms=self.steps['normalize_nonrigid'].transform)
-        
+        self.steps['denormalize_nonrigid'] = denormalize_nonrigid(source=self.steps['nonrigid_registration'].output['Source'],
+                                                                  target=self.steps['nonrigid_registration'].output['Source'],
+                                                                  transforms=self.steps['normalize_nonrigid'].transform,
+                                                                  cache=cache)
+
         # Step 7: Denormalization (ICP)
-        self.steps['denormalize_rigid'] = denormalize_rigid(source=deepcopy(self.steps['denormalize_nonrigid'].output['Source']),
-                                                            target=deepcopy(self.steps['denormalize_nonrigid'].output['Source']),
-                                                            transforms=self.steps['normalize_rigid'].transform)
-        
+        self.steps['denormalize_rigid'] = denormalize_rigid(source=self.steps['denormalize_nonrigid'].output['Source'],
+                                                            target=self.steps['denormalize_nonrigid'].output['Source'],
+                                                            transforms=self.steps['normalize_rigid'].transform,
+                                                            cache=cache)
+
+    def _consolidate(self, source: Organ, target: Organ) -> Projection:
+        return Projection(id=self.__id,
+                          description=self.description,
+                          source=source,
+                          target=target,
+                          params=self.params,
+                          registration=to_mesh(self.steps['denormalize_rigid'].output['Source'], source.faces, process=False),
+                          transformations=[(name, step.transform['Source']) for name, step in self.steps.items() if step.transform])
+
+    def run(self, source: Organ, target: Organ, cache: Optional[StageCache | bool] = None):
+        """Registers source onto target, with a `cache` (True for the default location) steps whose inputs, params and code did not change are reused"""
+        cache = StageCache() if cache is True else (cache or None)
+
+        # steps share immutable arrays, a step that needs to modify its input works on a copy
+        source_array, target_array = readonly(source), readonly(target)
+
+        # Steps 1-4: rigid registration and normalization
+        self._rigid_stages(source_array, target_array, cache)
+
+        # Steps 5-7: non-rigid registration and denormalization
+        self._nonrigid_stages(cache)
+
         # consolidate projections
-        projections = Projection(id=self.__id, 
-                                 description=self.description, 
-                                 source=source, 
-                                 target=target,
-                                 params=self.params,
-                                 registration=to_mesh(self.steps['denormalize_rigid'].output['Source'], source.faces, process=False),
-                                 transformations=[(name, step.transform['Source']) for name, step in self.steps.items() if step.transform])
+        return self._consolidate(source, target)
 
-        # return projections
-        return projections
+    def profile(self):
+        """Per-step wall / CPU / subprocess time, peak RSS growth and point counts of the last run"""
+        return profiling.summary(self.steps)
+
+    def export_profile(self, path: str, format: str = 'json'):
+        """Writes the step profiles of the last run as JSON or as a Chrome trace (format='chrome')"""
+        profiling.export(self.steps, path, format=format, process_name=self.name)
 
     def compute_metrics(self, metric: str):
         if metric not in ['sinkhorn, chamfer, hausdorff']:
             raise ValueError(f"{metric} not recognized, must be one of sinkhorn, chamfer or hausdorff")
-        return metric(self.result)
\ No newline at end of file
+        return metric(self.result)
+
+def _sample(values, rng: np.random.Generator):
+    # (low, high) ranges are sampled uniformly (integers if both bounds are), lists are choices
+    if isinstance(values, tuple) and len(values) == 2:
+        low, high = values
+        if isinstance(low, int) and isinstance(high, int):
+            return int(rng.integers(low, high + 1))
+        return float(rng.uniform(low, high))
+    return values[rng.integers(len(values))]
+
+def _initialize_search(steps, source_faces, target_vertices, target_faces, metric, cache):
+    _search.update(steps=steps,
+                   source_faces=source_faces,
+                   target=to_mesh(target_vertices, target_faces, process=False),
+                   metric=METRICS[metric],
+                   cache=cache)
+
+def _run_trial(params: dict) -> tuple:
+    """Runs Steps 5-7 on the shared rigid stages, never raises: returns (score, steps, wall time, error)"""
+    start = time.perf_counter()
+    try:
+        pipeline = Pipeline('trial', '', {'nonrigid_registration': params})
+        pipeline.steps = dict(_search['steps'])
+        pipeline._nonrigid_stages(_search['cache'])
+
+        registered = to_mesh(pipeline.steps['denormalize_rigid'].output['Source'], _search['source_faces'], process=False)
+        score = float(_search['metric'](_search['target'], registered))
+        steps = {name: replace(pipeline.steps[name], input=None) for name in NONRIGID_STAGES}
+        return (score, steps, time.perf_counter() - start, None)
+    except Exception:
+        return (None, None, time.perf_counter() - start, traceback.format_exc())
+
+def _terminate(pool: Pool):
+    """Stops the pool without waiting, terminating the workers of the trials still running"""
+    pool.terminate()
+    pool.join()
+
+def _execute(pool: Pool, params: list, workers: int, deadline: float, target_score, patience, state: dict) -> tuple:
+    """
+    Runs the trials with at most `workers` in flight, so that the deadline and early stopping take effect between trials.
+    Returns the results (None for trials never started) and the trials running at the deadline, with their wall time.
+    """
+    results = [None] * len(params)
+    pending, running, finished = iter(range(len(params))), {}, Queue()
+    while True:
+        # top up the pool unless out of time or stopping early
+        while not state['stop'] and len(running) < workers and time.perf_counter() < deadline:
+            index = next(pending, None)
+            if index is None:
+                break
+            # the callbacks run on the pool's result thread, they only hand the result over
+            pool.apply_async(_run_trial, (params[index],),
+                             callback=lambda result, index=index: finished.put((index, result)),
+                             error_callback=lambda error, index=index: finished.put((index, (None, None, None, repr(error)))))
+            running[index] = time.perf_counter()
+        if not running:
+            return results, {}
+
+        try:
+            done = [finished.get(timeout=max(0, deadline - time.perf_counter()) if deadline < math.inf else None)]
+        except Empty:
+            # out of time, abandon the running trials
+            now = time.perf_counter()
+            return results, {index: now - started for index, started in running.items()}
+        while not finished.empty():
+            done.append(finished.get())
+        for index, result in done:
+            running.pop(index)
+            results[index] = result
+
+            # early stopping
+            score = results[index][0]
+            if score is not None and score < state['best']:
+                state['best'], state['stale'] = score, 0
+            else:
+                state['stale'] += 1
+            if (target_score is not None and state['best'] <= target_score) or (patience and state['stale'] >= patience):
+                state['stop'] = True
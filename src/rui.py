@@ -1,7 +1,9 @@
 import subprocess
+import numpy as np
 
 from pathlib import Path
-from utils.io import read_yaml, write_yaml, add_header
+from collisions import CollisionDetector
+from utils.io import read_json, read_yaml, write_json, write_yaml, add_header
 
 class RUIProcessor:
     def __init__(self, blocks, registration_dir):
@@ -34,14 +36,64 @@ class RUIProcessor:
         add_header(self.registration_dir.joinpath('registrations.yaml'))
 
 
-    def generate_rui_locations(self):
+    def add_collisions(self, samples_per_axis: int = 4, workers: int = 4):
+        """Computes the anatomical structure collisions of every block in-process, written along by to_sample"""
+        for target_name, division_factor in set((block.target_name, block.division_factor) for block in self.blocks):
+            blocks = [block for block in self.blocks if (block.target_name, block.division_factor) == (target_name, division_factor)]
+            # the structures are moved into the placement frame of the (projected) blocks
+            detector = CollisionDetector.from_target(target_name, division_factor, samples_per_axis=samples_per_axis, workers=workers)
+
+            # the exported boxes are the blocks' bounding boxes (see TissueBlock.to_sample)
+            corners = np.stack([block.bounding_box.vertices for block in blocks])
+            summaries = detector.summaries(corners, division_factor)
+            for block, summary in zip(blocks, summaries):
+                block.collisions = summary
+
+    def write_rui_locations(self):
+        """Assembles rui_locations.jsonld from registrations.yaml and the registration JSONs, without the npx processor"""
+        graph = []
+        for registration in read_yaml(self.registration_dir.joinpath('registrations.yaml')):
+            defaults = registration.get('defaults', {})
+            for donor_number, donor in enumerate(registration['donors'], start=1):
+                donor_id = f"{defaults['id']}#Donor{donor_number}"
+                samples = []
+                for sample_number, sample in enumerate(donor['samples'], start=1):
+                    rui_location = read_json(self.registration_dir.joinpath('registrations', sample['rui_location']))
+                    samples.append({'@id': f'{donor_id}_TissueBlock{sample_number}', 
+                                    '@type': 'Sample', 
+                                    'sample_type': 'Tissue Block', 
+                                    'link': defaults.get('link'), 
+                                    'section_count': 0, 
+                                    'rui_location': rui_location})
+                graph.append({'@id': donor_id, 
+                              '@type': 'Donor', 
+                              'label': donor.get('sex'), 
+                              'link': defaults.get('link'), 
+                              'consortium_name': registration.get('consortium_name'), 
+                              'provider_name': registration.get('provider_name'), 
+                              'provider_uuid': registration.get('provider_uuid'), 
+                              'sex': donor.get('sex'), 
+                              'samples': samples})
+
+        write_json(self.registration_dir.joinpath('rui_locations.jsonld'), 
+                   {'@context': 'https://hubmapconsortium.github.io/ccf-ontology/ccf-context.jsonld', '@graph': graph})
+
+    def generate_rui_locations(self, collisions: str = 'npx'):
         # save all the registration data
         assert (self.registration_dir).exists(), "Please initialize a registration object first using initialize_registration"
 
+        # collisions in-process, the registration can then be finalized offline
+        if collisions == 'native':
+            self.add_collisions()
+
         # save tissue blocks as jsons
         for block in self.blocks:
             block.to_sample(self.registration_dir.joinpath('registrations'))
         
         # normalize
-        subprocess.run(['npx', 'github:hubmapconsortium/hra-rui-locations-processor', 'normalize', '--add-collisions', str(self.registration_dir)])
-
+        if collisions == 'native':
+            self.write_rui_locations()
+        elif collisions == 'npx':
+            subprocess.run(['npx', 'github:hubmapconsortium/hra-rui-locations-processor', 'normalize', '--add-collisions', str(self.registration_dir)])
+        else:
+            raise ValueError(f"{collisions} not recognized, must be one of npx or native")
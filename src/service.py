@@ -0,0 +1,267 @@
+import io
+import re
+import json
+import time
+import logging
+import argparse
+import threading
+import numpy as np
+
+from pathlib import Path
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from dataclass import Projection
+from tissue import TissueBlockSet
+
+logger = logging.getLogger(__name__)
+
+"""
+Long-running local HTTP service projecting vertices and tissue blocks with preloaded projections, so that consumers
+need neither the projections nor the geometry stack (see client.py for a client that only needs NumPy).
+
+    GET  /projections                  the loaded projections
+    GET  /metrics                      request latency per route
+    POST /projections/<name>/vertices  {"vertices": [[x, y, z], ...]} or an (N, 3) .npy body (application/x-npy)
+    POST /projections/<name>/blocks    {"samples": [...]} or a rui_locations.jsonld {"@graph": [...]}, answered with
+                                       the projected RUI locations (or {"format": "corners"} the (N, 8, 3) corners)
+    POST /batch                        {"requests": [{"projection": <name>, "vertices" | "samples" | "@graph": ...}, ...]}
+                                       handled concurrently, answered with {"results": [...]} in the same order
+"""
+
+NPY = 'application/x-npy'
+ROUTES = [('GET', re.compile(r'^/projections/?$'), 'projections'),
+          ('GET', re.compile(r'^/metrics/?$'), 'metrics'),
+          ('POST', re.compile(r'^/projections/(?P<name>[^/]+)/vertices/?$'), 'vertices'),
+          ('POST', re.compile(r'^/projections/(?P<name>[^/]+)/blocks/?$'), 'blocks'),
+          ('POST', re.compile(r'^/batch/?$'), 'batch')]
+
+
+class UnknownProjection(KeyError):
+    pass
+
+class Metrics:
+    """Request count, errors, projected points and latency percentiles per route, over the last `window` requests"""
+    def __init__(self, window: int = 10000) -> None:
+        self.window = window
+        self._lock = threading.Lock()
+        self._routes = {}
+
+    def record(self, route: str, seconds: float, points: int = 0, failed: bool = False):
+        with self._lock:
+            entry = self._routes.setdefault(route, {'count': 0, 'errors': 0, 'points': 0, 'latencies': deque(maxlen=self.window)})
+            entry['count'] += 1
+            entry['errors'] += int(failed)
+            entry['points'] += points
+            entry['latencies'].append(seconds)
+
+    def summary(self) -> dict:
+        with self._lock:
+            routes = {route: (dict(entry), np.array(entry['latencies'])) for route, entry in self._routes.items()}
+        summary = {}
+        for route, (entry, latencies) in routes.items():
+            p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1e3
+            summary[route] = {'count': entry['count'],
+                              'errors': entry['errors'],
+                              'points': entry['points'],
+                              'mean_ms': latencies.mean() * 1e3,
+                              'p50_ms': p50,
+                              'p95_ms': p95,
+                              'p99_ms': p99,
+                              'max_ms': latencies.max() * 1e3}
+        return summary
+
+class ProjectionService:
+    """Projections loaded once, their compiled chains and DVF spatial indexes built up front"""
+    def __init__(self, projections: dict[str, Projection], workers: int = 4) -> None:
+        self.projections = projections
+        self.metrics = Metrics()
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        for name, projection in projections.items():
+            self.warm(projection)
+            logger.info(f'{name}: {projection.description or projection.id} loaded')
+
+    @classmethod
+    def from_directory(cls, directory: str, mmap: bool = False, workers: int = 4) -> 'ProjectionService':
+        """
+        Loads every exported projection in `directory`, named after it: directories with a projection.json, legacy
+        <name>-<uuid> directories holding a projections.pickle, and pickles
+        """
+        projections = {}
+        for path in sorted(Path(directory).iterdir()):
+            if path.joinpath('projection.json').exists() or path.joinpath('projections.pickle').exists():
+                projections[path.name] = Projection.load(path, mmap_mode='r' if mmap else None)
+            elif path.suffix == '.pickle':
+                projections[path.stem] = Projection.load(path)
+        if not projections:
+            raise ValueError(f"No projections found in {directory}")
+        return cls(projections, workers)
+
+    @staticmethod
+    def warm(projection: Projection):
+        # compiling the chain builds the lookups' indexes, concurrent requests then only read them
+        for kind, operation in projection.chain:
+            if kind != 'affine' and operation.control_points is not None:
+                operation.index
+                if kind == 'inverse_dvf':
+                    operation.inverse_index
+
+    def projection(self, name: str) -> Projection:
+        if name not in self.projections:
+            raise UnknownProjection(f"Projection {name} not loaded, must be one of {', '.join(self.projections)}")
+        return self.projections[name]
+
+    def describe(self) -> dict:
+        return {name: {'id': str(projection.id),
+                       'description': projection.description,
+                       'source': getattr(projection.source, 'name', None),
+                       'target': getattr(projection.target, 'name', None),
+                       'inverted': projection.inverted,
+                       'round_trip_error': projection.round_trip_error}
+                for name, projection in self.projections.items()}
+
+    def project_vertices(self, name: str, vertices) -> np.ndarray:
+        vertices = np.asarray(vertices, dtype=np.float64)
+        if vertices.ndim != 2 or vertices.shape[1] != 3:
+            raise ValueError(f"Vertices must be an (N, 3) array, got shape {vertices.shape}")
+        return self.projection(name).project_array(vertices)
+
+    def project_blocks(self, name: str, request: dict):
+        """Projected RUI locations (or corners) of the samples, or of every sample of a JSON-LD @graph"""
+        if '@graph' in request:
+            blocks = TissueBlockSet.from_graph(request['@graph'], request.get('target'))
+        else:
+            blocks = TissueBlockSet.from_samples(request['samples'], request.get('donor', {}), target_name=request.get('target'))
+        blocks = blocks.project(self.projection(name))
+        if request.get('format', 'rui') == 'corners':
+            return {'corners': blocks.corners.tolist()}, len(blocks) * 8
+        return {'locations': blocks.to_locations(request.get('oriented', False))}, len(blocks) * 8
+
+    def handle(self, request: dict):
+        """A single item of a batch, errors are reported in its result instead of failing the batch"""
+        try:
+            if 'vertices' in request:
+                vertices = self.project_vertices(request['projection'], request['vertices'])
+                return {'vertices': vertices.tolist()}, vertices.shape[0]
+            return self.project_blocks(request['projection'], request)
+        except Exception as error:
+            return {'error': f'{type(error).__name__}: {error}'}, 0
+
+    def batch(self, requests: list[dict]):
+        results = list(self.executor.map(self.handle, requests))
+        return {'results': [result for result, _ in results]}, sum(points for _, points in results)
+
+class Handler(BaseHTTPRequestHandler):
+    service: ProjectionService = None
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def _dispatch(self, method: str):
+        start, route, points, status = time.perf_counter(), 'unknown', 0, 200
+        self._unread = int(self.headers.get('Content-Length', 0))
+        try:
+            for route_method, pattern, name in ROUTES:
+                match = pattern.match(self.path.split('?')[0])
+                if match and route_method == method:
+                    route = name
+                    points = getattr(self, f'_{name}')(**match.groupdict())
+                    break
+            else:
+                status = 404
+                self._send_json({'error': f'{method} {self.path} not found'}, status)
+        except UnknownProjection as error:
+            status = 404
+            self._send_json({'error': error.args[0]}, status)
+        except KeyError as error:
+            status = 400
+            self._send_json({'error': f'Missing field {error}'}, status)
+        except (ValueError, TypeError, json.JSONDecodeError) as error:
+            status = 400
+            self._send_json({'error': f'{type(error).__name__}: {error}'}, status)
+        except Exception as error:
+            status = 500
+            logger.exception(f'{method} {self.path} failed')
+            self._send_json({'error': f'{type(error).__name__}: {error}'}, status)
+        finally:
+            # a body left unread (unknown route, early error) would be parsed as the next request on the connection
+            self._body()
+            self.service.metrics.record(route, time.perf_counter() - start, points, status >= 400)
+
+    def _body(self) -> bytes:
+        body, self._unread = self.rfile.read(self._unread), 0
+        return body
+
+    def _json(self) -> dict:
+        return json.loads(self._body())
+
+    def _send(self, body: bytes, content_type: str, status: int = 200):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, data: dict, status: int = 200):
+        self._send(json.dumps(data).encode(), 'application/json', status)
+
+    def _projections(self):
+        self._send_json(self.service.describe())
+        return 0
+
+    def _metrics(self):
+        self._send_json(self.service.metrics.summary())
+        return 0
+
+    def _vertices(self, name: str):
+        # binary in, binary out
+        if self.headers.get('Content-Type') == NPY:
+            vertices = self.service.project_vertices(name, np.load(io.BytesIO(self._body()), allow_pickle=False))
+            buffer = io.BytesIO()
+            np.save(buffer, vertices)
+            self._send(buffer.getvalue(), NPY)
+        else:
+            vertices = self.service.project_vertices(name, self._json()['vertices'])
+            self._send_json({'vertices': vertices.tolist()})
+        return vertices.shape[0]
+
+    def _blocks(self, name: str):
+        result, points = self.service.project_blocks(name, self._json())
+        self._send_json(result)
+        return points
+
+    def _batch(self):
+        result, points = self.service.batch(self._json()['requests'])
+        self._send_json(result)
+        return points
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+def serve(service: ProjectionService, host: str = '127.0.0.1', port: int = 8765) -> ThreadingHTTPServer:
+    """A server (one thread per connection) bound to `service`, call serve_forever() on it"""
+    handler = type('ProjectionHandler', (Handler,), {'service': service})
+    return ThreadingHTTPServer((host, port), handler)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve tissue block and vertex projections over HTTP')
+    parser.add_argument('projections', help='Directory of exported projections (and/or pickles)')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to bind, local only by default')
+    parser.add_argument('--port', type=int, default=8765, help='Port to listen on')
+    parser.add_argument('--workers', type=int, default=4, help='Threads handling the items of batch requests')
+    parser.add_argument('--mmap', action='store_true', help='Memory map the projection arrays instead of reading them in')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    server = serve(ProjectionService.from_directory(args.projections, args.mmap, args.workers), args.host, args.port)
+    logger.info(f'serving on http://{args.host}:{args.port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -1,10 +1,15 @@
+import os
+import bcpd
+import tempfile
 import subprocess
 import numpy as np
 import open3d as o3d
 
+from pathlib import Path
 from decorators import step
 from dataclass import Transform
-from utils.conversions import pointcloud_to_numpy, numpy_to_pointcloud, txt_to_numpy, pointcloud_to_mesh
+from utils.conversions import to_array, to_pointcloud, txt_to_numpy, pointcloud_to_mesh
+from utils.io import write_txt
 from utils.preprocess import scale, compute_features
 
 @step(name='Normalize ICP', description='Scale organs to a common range about the centre')
@@ -32,31 +37,37 @@ def normalize_rigid(source, target):
 def flip(source, target):
     raise NotImplementedError
 
-@step(name='Global Registration', description='Initial, fast registration before rigid registration')
-def global_registration(source, target, params):
+def _ransac(source, target, params, target_fpfh_features=None):
+    """FPFH feature matching with RANSAC on point clouds already downsampled to params['voxel_size']"""
     distance_threshold = params['voxel_size'] * params['global_distance_threshold_factor']
-    
-    # downsample
-    source = source.voxel_down_sample(params['voxel_size'])
-    target = target.voxel_down_sample(params['voxel_size'])
 
-    # compute features
+    # compute features (unless precomputed for the target)
     source_fpfh_features = compute_features(source, params)
-    target_fpfh_features = compute_features(target, params)
+    if target_fpfh_features is None:
+        target_fpfh_features = compute_features(target, params)
 
     # register
-    result = o3d.pipelines.registration.registration_ransac_based_on_feature_matching(source, 
-                                                                                      target, 
-                                                                                      source_fpfh_features,
-                                                                                      target_fpfh_features, 
-                                                                                      True, 
-                                                                                      distance_threshold,
-                                                                                      o3d.pipelines.registration.TransformationEstimationPointToPoint(False), 
-                                                                                      3,
-                                                                                      [o3d.pipelines.registration.CorrespondenceCheckerBasedOnEdgeLength(params['global_edge_length_threshold_factor']), 
-                                                                                       o3d.pipelines.registration.CorrespondenceCheckerBasedOnDistance(distance_threshold)], 
-                                                                                      o3d.pipelines.registration.RANSACConvergenceCriteria(params['global_max_iterations'], params['global_max_correspondence']))
-    
+    return o3d.pipelines.registration.registration_ransac_based_on_feature_matching(source, 
+                                                                                    target, 
+                                                                                    source_fpfh_features,
+                                                                                    target_fpfh_features, 
+                                                                                    True, 
+                                                                                    distance_threshold,
+                                                                                    o3d.pipelines.registration.TransformationEstimationPointToPoint(False), 
+                                                                                    3,
+                                                                                    [o3d.pipelines.registration.CorrespondenceCheckerBasedOnEdgeLength(params['global_edge_length_threshold_factor']), 
+                                                                                     o3d.pipelines.registration.CorrespondenceCheckerBasedOnDistance(distance_threshold)], 
+                                                                                    o3d.pipelines.registration.RANSACConvergenceCriteria(params['global_max_iterations'], params['global_max_correspondence']))
+
+@step(name='Global Registration', description='Initial, fast registration before rigid registration')
+def global_registration(source, target, params, atlas=None):
+    # downsample (the target is loaded from the atlas index with its features, if built for this voxel size)
+    level = atlas.level(params['voxel_size'], params['max_nn']) if atlas else None
+    source = to_pointcloud(source).voxel_down_sample(params['voxel_size'])
+    target = level.pointcloud if level else to_pointcloud(target).voxel_down_sample(params['voxel_size'])
+
+    # register
+    result = _ransac(source, target, params, level.features if level else None)
 
     # store transforms (no need to apply transform since this will be directly used to refine the registation)
     transforms = {'Source': Transform(matrix=result.transformation, apply=False), 
@@ -65,12 +76,13 @@ def global_registration(source, target, params):
     return (None, transforms)
 
 @step(name='Rigid Registration', description='Registeration using only rigid transformations (scale, translation and rotation)')
-def refine_registration(source, target, params, transform):
+def refine_registration(source, target, params, transform, atlas=None):
     distance_threshold = params['voxel_size'] * params['refine_distance_threshold_factor']
 
     # register
-    result = o3d.pipelines.registration.registration_icp(source, 
-                                                         target, 
+    # point-to-plane only needs the normals of the target
+    result = o3d.pipelines.registration.registration_icp(to_pointcloud(source), 
+                                                         atlas.pointcloud if atlas else to_pointcloud(target, normals=True), 
                                                          distance_threshold, 
                                                          transform['Source'].matrix, 
                                                          o3d.pipelines.registration.TransformationEstimationPointToPlane())
@@ -91,6 +103,78 @@ def refine_registration(source, target, params, transform):
     
     return (outputs, transforms)
 
+def _rotation_angle(matrix):
+    return np.arccos(np.clip((np.trace(matrix[:3, :3]) - 1) / 2, -1, 1))
+
+@step(name='Multi-scale Rigid Registration', description='RANSAC at the coarsest level of a voxel pyramid, then point-to-plane ICP warm-started at each finer level')
+def multiscale_registration(source, target, params, atlas=None):
+    source_pointcloud, target_pointcloud = to_pointcloud(source), to_pointcloud(target)
+    voxel_sizes = sorted((float(size) for size in params['pyramid_voxel_sizes']), reverse=True)
+    iterations = params.get('pyramid_max_iterations', [30] * len(voxel_sizes))
+    tolerance = float(params.get('pyramid_tolerance', 1e-4))
+    criteria = dict(relative_fitness=float(params.get('pyramid_relative_fitness', 1e-6)), 
+                    relative_rmse=float(params.get('pyramid_relative_rmse', 1e-6)))
+
+    matrix, levels = None, []
+    for level, (voxel_size, max_iterations) in enumerate(zip(voxel_sizes, iterations)):
+        # a voxel size of 0 is the full resolution, registered with the threshold of the single-scale ICP
+        atlas_level = atlas.level(voxel_size, params['max_nn']) if atlas and voxel_size > 0 else None
+        if voxel_size > 0:
+            # point-to-plane only needs the normals of the target
+            level_source = source_pointcloud.voxel_down_sample(voxel_size)
+            if atlas_level:
+                level_target = atlas_level.pointcloud
+            else:
+                level_target = target_pointcloud.voxel_down_sample(voxel_size)
+                level_target.estimate_normals(o3d.geometry.KDTreeSearchParamHybrid(radius=voxel_size * 2, max_nn=params['max_nn']))
+            distance_threshold = voxel_size * float(params.get('pyramid_distance_threshold_factor', 1.5))
+        else:
+            level_source, level_target = source_pointcloud, atlas.pointcloud if atlas else to_pointcloud(target, normals=True)
+            distance_threshold = params['voxel_size'] * params['refine_distance_threshold_factor']
+
+        # global registration only once, at the coarsest level
+        if matrix is None:
+            matrix = _ransac(level_source, 
+                             level_target, 
+                             {**params, 'voxel_size': voxel_size or params['voxel_size']}, 
+                             atlas_level.features if atlas_level else None).transformation
+
+        result = o3d.pipelines.registration.registration_icp(level_source, 
+                                                             level_target, 
+                                                             distance_threshold, 
+                                                             matrix, 
+                                                             o3d.pipelines.registration.TransformationEstimationPointToPlane(), 
+                                                             o3d.pipelines.registration.ICPConvergenceCriteria(max_iteration=int(max_iterations), **criteria))
+        
+        # how far this level moved the estimate
+        update = result.transformation @ np.linalg.inv(matrix)
+        change = max(_rotation_angle(update), np.linalg.norm(update[:3, 3]))
+        matrix = result.transformation
+        levels.append({'voxel_size': voxel_size, 
+                       'points': len(level_source.points), 
+                       'fitness': result.fitness, 
+                       'inlier_rmse': result.inlier_rmse, 
+                       'change': float(change)})
+
+        # converged: the finer levels would not move it any further
+        if level > 0 and change < tolerance:
+            break
+    
+    # create and apply transform
+    transform = Transform(matrix=matrix)
+    source = transform(source)
+
+    # store outputs
+    outputs = {'Source': source, 
+               'Target': None, 
+               'Levels': levels}
+    
+    # store transforms
+    transforms = {'Source': transform, 
+                  'Target': None}
+    
+    return (outputs, transforms)
+
 @step(name='Normalize BCPD', description='Normalize location and scale before nonrigid registration')
 def normalize_nonrigid(source, target):
     # calculate scale
@@ -114,65 +198,103 @@ def normalize_nonrigid(source, target):
     
     return (outputs, transforms)
 
+def _register_bcpd(source_array, target_array, params):
+    """Runs the compiled BCPD binary in its own scratch directory, exchanging point clouds through text files"""
+    executable = Path(params.get('executable', '../bcpd/bcpd')).resolve()
+
+    # limit the OpenMP threads of the binary
+    env = dict(os.environ)
+    if int(params.get('threads', 0)) > 0:
+        env['OMP_NUM_THREADS'] = str(params['threads'])
+
+    # every registration gets an isolated working directory (removed afterwards)
+    with tempfile.TemporaryDirectory(prefix='bcpd-', dir=params.get('workdir')) as workdir:
+        workdir = Path(workdir)
+
+        # the binary only reads text, so save the source and target point clouds as .txt
+        write_txt(workdir / 'source.txt', source_array, delimiter=',')
+        write_txt(workdir / 'target.txt', target_array, delimiter=',')
+
+        # build registration args 
+        reigstration_args = [str(executable), 
+                             '-x', str(workdir / 'target.txt'), 
+                             '-y', str(workdir / 'source.txt'), 
+                             '-o', str(workdir / 'output_'),
+                             '-J', str(params.get('nystrom_samples', 300)), 
+                             '-K', str(params.get('nystrom_rank', 70)), 
+                             '-p', '-u', 'n', 
+                             '-c', str(params['distance_threshold']), 
+                             '-r', str(params['seed']), 
+                             '-n', str(params['max_iterations']), 
+                             '-l', str(params['lambda']), 
+                             '-b', str(params['beta']),
+                             '-s', 'yxuveTY']
+
+        # for rotation
+        if 'gamma' in params:
+            reigstration_args.extend(['-g', str(params['gamma'])])
+
+        # for downsampling acceleration
+        # (chosen from the point counts and budget when `autotune` is on, see autotune.suggest)
+        if 'downsampling' in params:
+            reigstration_args.extend(['-D', str(params['downsampling'])])
+
+        # register using BCPD
+        result = subprocess.run(reigstration_args, cwd=workdir, env=env, capture_output=True)
+        if result.returncode != 0:
+            raise RuntimeError(f"BCPD failed with exit code {result.returncode}: {result.stderr.decode(errors='replace')}")
+        
+        # read transformations (single pass each)
+        if 'downsampling' in params:
+            source_points = txt_to_numpy(workdir / 'output_normY.txt')
+            registered = txt_to_numpy(workdir / 'output_y.interpolated.txt')
+        else:
+            source_points = source_array
+            registered = txt_to_numpy(workdir / 'output_y.txt')
+        deformed = txt_to_numpy(workdir / 'output_u.txt')
+        translation = txt_to_numpy(workdir / 'output_t.txt')
+        scale = txt_to_numpy(workdir / 'output_s.txt').item()
+        rotation = txt_to_numpy(workdir / 'output_r.txt')
+
+    return (source_points, deformed, scale, rotation, translation, registered)
+
+def _register_native(source_array, target_array, params):
+    """Runs the in-process NumPy BCPD engine"""
+    result = bcpd.register(source_array, target_array, params)
+
+    # the engine only registers the (possibly downsampled) control points, 
+    # the full source is registered through the interpolated DVF
+    registered = result.registered if result.source is source_array else None
+
+    return (result.source, result.deformed, result.scale, result.rotation, result.translation, registered)
+
 @step(name='Non-rigid Registration', description='Registration using rigid and non-rigid (local deformations) with BCPD algorithm')
 def nonrigid_registration(source, target, params):
     # convert to array
-    source_array = pointcloud_to_numpy(source)
-    target_array = pointcloud_to_numpy(target)
-
-    # save the source and target point clouds as .txt
-    np.savetxt(f"../bcpd/source.txt", source_array, delimiter=',')
-    np.savetxt(f"../bcpd/target.txt", target_array, delimiter=',')
-
-    # build registration args 
-    reigstration_args = ['./bcpd', 
-                         '-x', f"../bcpd/target.txt", 
-                         '-y', f"../bcpd/source.txt", 
-                         '-J', '300', 
-                         '-K', '70', 
-                         '-p', '-u', 'n', 
-                         '-c', str(params['distance_threshold']), 
-                         '-r', str(params['seed']), 
-                         '-n', str(params['max_iterations']), 
-                         '-l', str(params['lambda']), 
-                         '-b', str(params['beta']),
-                         '-s', 'yxuveTY']
-
-    # for rotation
-    if 'gamma' in params:
-        reigstration_args.extend(['-g', str(params['gamma'])])
-
-    # for downsampling acceleration
-    # TODO: auto-detect when downsampling acceleration is needed instead of having it specified
-    if 'downsampling' in params:
-        reigstration_args.extend(['-D', str(params['downsampling'])])
-
-    # register using BCPD
-    result = subprocess.run(reigstration_args, cwd="../bcpd", capture_output=True)
-    
-    # read transformations
-    if 'downsampling' in params:
-        downsampled_source = np.genfromtxt('../bcpd/output_normY.txt')
-        dvf = np.genfromtxt('../bcpd/output_u.txt') - downsampled_source
+    source_array = to_array(source)
+    target_array = to_array(target)
+
+    # register using the configured backend
+    backend = params.get('backend', 'bcpd')
+    if backend == 'bcpd':
+        source_points, deformed, scale, rotation, translation, registered = _register_bcpd(source_array, target_array, params)
+    elif backend == 'native':
+        source_points, deformed, scale, rotation, translation, registered = _register_native(source_array, target_array, params)
     else:
-        dvf = np.genfromtxt('../bcpd/output_u.txt') - source_array
-    translation = txt_to_numpy('../bcpd/output_t.txt')
-    scale = txt_to_numpy('../bcpd/output_s.txt').item()
-    rotation = txt_to_numpy('../bcpd/output_r.txt')
+        raise ValueError(f"{backend} not recognized, must be one of bcpd or native")
+    dvf = deformed - source_points
     
-    # create transform
-    transform = Transform(scale=scale, rotate=rotation, translate=translation, deformation_vector_field=dvf)
+    # create transform (the DVF is indexed over the points it was computed on, to use with ANY geometry)
+    transform = Transform(scale=scale, 
+                          rotate=rotation, 
+                          translate=translation, 
+                          deformation_vector_field=dvf, 
+                          control_points=source_points, 
+                          dvf_neighbors=int(params.get('dvf_neighbors', 1)))
 
     # apply transform and store outputs
-    if 'downsampling' in params:
-        # this automatically calculates and stores an interpolated DVF to use with ANY geometry
-        downsampled_source = transform(downsampled_source)
-        # transform the original source using the interpolated DVF calculated
-        source = transform(source)
-        registered = numpy_to_pointcloud(txt_to_numpy('../bcpd/output_y.interpolated.txt'))
-    else:
-        source = transform(source)
-        registered = numpy_to_pointcloud(txt_to_numpy('../bcpd/output_y.txt'))
+    source = transform(source)
+    registered = registered if registered is not None else source
 
     # store outputs
     outputs = {'Source': source, 
@@ -0,0 +1,272 @@
+import os
+import json
+import time
+import shutil
+import argparse
+
+from pathlib import Path
+from itertools import islice
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from dataclass import Projection
+from tissue import TissueBlockSet
+from utils.io import read_json, read_yaml, write_json
+
+"""
+Projects the tissue blocks of a rui_locations.jsonld or of a registrations directory without loading either whole.
+Samples are read incrementally, projected in chunks across worker processes (each holding the projection) and
+written as they complete, in input order, with a bounded number of chunks in flight so that memory stays flat.
+
+    python stream.py rui_locations.jsonld --projection <exported projection> --output projected.jsonld
+    python stream.py <registrations dir> --projection <exported projection> --output <registrations dir>
+"""
+
+
+class JSONStream:
+    """Incremental reader of a JSON document, decoding one value at a time (json raw_decode) from a buffered file"""
+    WHITESPACE = ' \t\r\n'
+
+    def __init__(self, file, block_size: int = 1 << 20) -> None:
+        self.file = file
+        self.block_size = block_size
+        self.buffer, self.position = '', 0
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self) -> bool:
+        data = self.file.read(self.block_size)
+        if not data:
+            return False
+        # drop what was consumed
+        self.buffer, self.position = self.buffer[self.position:] + data, 0
+        return True
+
+    def peek(self) -> str:
+        """The next non-whitespace character"""
+        while True:
+            while self.position < len(self.buffer) and self.buffer[self.position] in self.WHITESPACE:
+                self.position += 1
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if not self._fill():
+                raise ValueError("Unexpected end of the JSON document")
+
+    def expect(self, character: str):
+        if self.peek() != character:
+            raise ValueError(f"Expected {character!r} at {self.buffer[self.position:self.position + 32]!r}")
+        self.position += 1
+
+    def value(self):
+        """Decodes the next value as a whole"""
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+            except json.JSONDecodeError:
+                # the value continues in the next block
+                if not self._fill():
+                    raise
+                continue
+            # a number at the end of the buffer may continue in the next block
+            if end == len(self.buffer) and self._fill():
+                continue
+            self.position = end
+            return value
+
+    def keys(self):
+        """Keys of the object at the current position, each value has to be read (or streamed) before the next key"""
+        self.expect('{')
+        if self.peek() == '}':
+            self.position += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(':')
+            yield key
+            if self.peek() == ',':
+                self.position += 1
+            else:
+                self.expect('}')
+                return
+
+    def elements(self):
+        """Positions in the array at the current position, each element has to be read (or streamed) before the next"""
+        self.expect('[')
+        if self.peek() == ']':
+            self.position += 1
+            return
+        index = 0
+        while True:
+            yield index
+            index += 1
+            if self.peek() == ',':
+                self.position += 1
+            else:
+                self.expect(']')
+                return
+
+    def values(self):
+        """The decoded elements of the array at the current position"""
+        for _ in self.elements():
+            yield self.value()
+
+class OrderedWriter:
+    """Writes text and rendered chunk results in submission order, waiting on the oldest chunk beyond `in_flight`"""
+    def __init__(self, write, in_flight: int) -> None:
+        self.write = write
+        self.in_flight = in_flight
+        self.pending = deque()
+        self.chunks = 0
+
+    def text(self, text: str):
+        self.pending.append(text)
+        self._flush()
+
+    def submit(self, future, render):
+        self.pending.append((future, render))
+        self.chunks += 1
+        self._flush()
+
+    def _flush(self, wait: bool = False):
+        while self.pending:
+            item = self.pending[0]
+            if not isinstance(item, str):
+                future, render = item
+                if not (future.done() or wait or self.chunks > self.in_flight):
+                    return
+                item = render(future.result())
+                self.chunks -= 1
+            self.pending.popleft()
+            self.write(item)
+
+    def close(self):
+        self._flush(wait=True)
+
+_projection = None
+
+def _initialize_worker(path: str):
+    # every worker loads (memory maps) the projection once
+    global _projection
+    _projection = Projection.load(path)
+
+def project_samples(samples: list[dict], target_name: str = None, oriented: bool = False) -> list[dict]:
+    """The samples with their rui_location projected, samples without one are passed through"""
+    located = [index for index, sample in enumerate(samples) if 'rui_location' in sample]
+    if located:
+        blocks = TissueBlockSet.from_samples([samples[index] for index in located], {}, target_name=target_name).project(_projection)
+        for index, location in zip(located, blocks.to_locations(oriented)):
+            samples[index] = {**samples[index], 'rui_location': location}
+    return samples
+
+def _chunks(iterable, size: int):
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+def stream_jsonld(reader: JSONStream, writer: OrderedWriter, submit, chunk_size: int, jsonl: bool = False):
+    """Echoes the JSON-LD document with the samples of every donor replaced by their projections (or only those, as JSON lines)"""
+    text = (lambda _: None) if jsonl else writer.text
+    lines = lambda samples: ''.join(json.dumps(sample) + '\n' for sample in samples)
+
+    text('{')
+    for position, key in enumerate(reader.keys()):
+        text((',' if position else '') + json.dumps(key) + ':')
+        if key != '@graph':
+            text(json.dumps(reader.value()))
+            continue
+        text('[')
+        for index in reader.elements():
+            text((',' if index else '') + '{')
+            for donor_position, donor_key in enumerate(reader.keys()):
+                text((',' if donor_position else '') + json.dumps(donor_key) + ':')
+                if donor_key != 'samples':
+                    text(json.dumps(reader.value()))
+                    continue
+                text('[')
+                for count, chunk in enumerate(_chunks(reader.values(), chunk_size)):
+                    render = lines if jsonl else (lambda samples, count=count: (',' if count else '') + ','.join(map(json.dumps, samples)))
+                    writer.submit(submit(chunk), render)
+                text(']')
+            text('}')
+        text(']')
+    text('}')
+
+def registration_samples(registration_dir: Path):
+    """The samples of a registrations directory, read one registration JSON at a time"""
+    for registration in read_yaml(registration_dir.joinpath('registrations.yaml')):
+        for donor in registration['donors']:
+            for sample in donor['samples']:
+                location = read_json(registration_dir.joinpath('registrations', sample['rui_location']))
+                yield {'label': location.get('label'), 'rui_location': location, 'file': sample['rui_location']}
+
+def stream_registrations(registration_dir: Path, output: Path, writer: OrderedWriter, submit, chunk_size: int, jsonl: bool = False):
+    """Writes the projected registrations next to a copy of registrations.yaml (or the samples as JSON lines)"""
+    if jsonl:
+        render = lambda samples: ''.join(json.dumps({key: value for key, value in sample.items() if key != 'file'}) + '\n' for sample in samples)
+    else:
+        output.joinpath('registrations').mkdir(parents=True, exist_ok=True)
+        # projecting in place (output is the registrations directory) keeps its registrations.yaml as it is
+        manifest = output.joinpath('registrations.yaml')
+        if not (manifest.exists() and manifest.samefile(registration_dir.joinpath('registrations.yaml'))):
+            shutil.copy(registration_dir.joinpath('registrations.yaml'), manifest)
+
+        def render(samples):
+            for sample in samples:
+                write_json(output.joinpath('registrations', sample['file']), sample['rui_location'])
+            return ''
+    for chunk in _chunks(registration_samples(registration_dir), chunk_size):
+        writer.submit(submit(chunk), render)
+
+def stream(source: str,
+           projection: str,
+           output: str,
+           chunk_size: int = 256,
+           workers: int = os.cpu_count(),
+           in_flight: int = None,
+           target_name: str = None,
+           oriented: bool = False,
+           jsonl: bool = False) -> int:
+    """Projects every sample of `source` (a rui_locations.jsonld or a registrations directory) to `output`, returns the number of samples"""
+    source, output = Path(source), Path(output)
+    count = 0
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_initialize_worker, initargs=(str(projection),)) as executor:
+        def submit(chunk):
+            nonlocal count
+            count += len(chunk)
+            return executor.submit(project_samples, chunk, target_name, oriented)
+
+        def run(write):
+            writer = OrderedWriter(write, in_flight or 2 * workers)
+            if source.is_file():
+                with open(source) as f:
+                    stream_jsonld(JSONStream(f), writer, submit, chunk_size, jsonl)
+            else:
+                stream_registrations(source, output, writer, submit, chunk_size, jsonl)
+            writer.close()
+
+        # registrations are written file by file, JSON-LD and JSON lines are streamed to a single file
+        if source.is_file() or jsonl:
+            with open(output, 'w') as file:
+                run(file.write)
+        else:
+            run(lambda text: None)
+    return count
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Project the tissue blocks of a rui_locations.jsonld or registrations directory, streaming them in chunks')
+    parser.add_argument('source', help='rui_locations.jsonld or a registrations directory (with registrations.yaml)')
+    parser.add_argument('--projection', required=True, help='Exported projection: a directory (with a projection.json, or a legacy projections.pickle), a projection.json or a pickle')
+    parser.add_argument('--output', required=True, help='Projected .jsonld (JSON-LD source), registrations directory (registrations source) or .jsonl (--jsonl)')
+    parser.add_argument('--jsonl', action='store_true', help='Write one projected sample per line instead')
+    parser.add_argument('--target', default=None, help='Target organ of the samples (default: the target of each placement)')
+    parser.add_argument('--oriented', action='store_true', help='Fit oriented instead of axis-aligned boxes to the projected blocks')
+    parser.add_argument('--chunk-size', type=int, default=256, help='Samples projected per task')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Worker processes')
+    parser.add_argument('--in-flight', type=int, default=None, help='Chunks queued ahead of the writer (default: twice the workers)')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    count = stream(args.source, args.projection, args.output, args.chunk_size, args.workers, args.in_flight, args.target, args.oriented, args.jsonl)
+    print(f'{count} samples projected to {args.output} in {time.perf_counter() - start:.1f}s')
@@ -1,3 +1,4 @@
+import json
 import uuid
 import trimesh
 import numpy as np
@@ -9,9 +10,12 @@ from pathlib import Path
 from copy import deepcopy
 from datetime import datetime
 from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 from dataclass import Transform
-from utils.io import read_yaml, write_json
-from utils.conversions import to_pointcloud, to_array, split_transform
+from config import get_registry
+from utils.io import read_json, read_yaml, write_json
+from utils.cache import load_mesh
+from utils.conversions import to_pointcloud, to_array, split_transform, split_transforms
 
 
 class DivisionFactor(Enum):
@@ -19,6 +23,31 @@ class DivisionFactor(Enum):
     centimeter = 1e2
     meter = 1
 
+def default_metadata(donor: dict, label: str, target_name: str) -> dict:
+    """RUI location metadata for tissue blocks that were not created from a sample"""
+    metadata = dict()
+    metadata['@context'] = "https://hubmapconsortium.github.io/ccf-ontology/ccf-context.jsonld"
+    metadata['@id'] = f"{donor['id']}#{label}"
+    metadata['@type'] = 'SpatialEntity'
+    metadata['creator'] = 'Bhargav Snehal Desai'
+    metadata['creator_first_name'] = 'Bhargav Snehal'
+    metadata['creator_last_name'] = 'Desai'
+    metadata['creator_orcid'] = 'https://orcid.org/0009-0008-6509-7698'
+    metadata['label'] = label
+    metadata['creation_date'] = datetime.today().strftime('%Y-%m-%d')
+    metadata['dimension_units'] = 'millimeter'
+    metadata['placement'] = dict()
+    metadata['placement']['@context'] = "https://hubmapconsortium.github.io/ccf-ontology/ccf-context.jsonld"
+    metadata['placement']['@id'] = f"{metadata['@id']}_placement"
+    metadata['placement']['@type'] = 'SpatialPlacement'
+    metadata['placement']['target'] = f'http://purl.org/ccf/latest/ccf.owl#{target_name}'
+    metadata['placement']['placement_date'] = metadata['creation_date']
+    metadata['placement']['scaling_units'] = 'ratio'
+    metadata['placement']['rotation_order'] = 'XYZ'
+    metadata['placement']['rotation_units'] = 'degree'
+    metadata['placement']['translation_units'] = 'millimeter'
+    return metadata
+
 class TissueBlock(trimesh.Trimesh):
     def __init__(self, vertices, faces, donor: dict = None, metadata: dict = None) -> None:
         super(TissueBlock, self).__init__()
@@ -27,8 +56,9 @@ class TissueBlock(trimesh.Trimesh):
             self.donor = donor
         if metadata:
             self.metadata = metadata
-        self.mappings = read_yaml('../configs/atlas_paths.yaml')
-        self.hra_transforms = read_yaml('../configs/hra_transforms.yaml')
+        self.registry = get_registry()
+        self.mappings = self.registry.mappings
+        self.hra_transforms = self.registry.hra_transforms
 
     @property
     def pointcloud(self):
@@ -111,11 +141,7 @@ class TissueBlock(trimesh.Trimesh):
         # https://raw.githubusercontent.com/hubmapconsortium/hubmap-ontology/master/source_data/generated-reference-spatial-entities.jsonld
         if not hasattr(self, 'target_name'):
             self.target_name = self.metadata['placement']['target'].split('#')[-1]
-        hra_transform = self.hra_transforms[self.target_name]
-        target_transform = Transform(hra_transform['scaling'], 
-                                     hra_transform['rotation'], 
-                                     np.array(hra_transform['translation']) / self.division_factor)
-        return target_transform
+        return self.registry.target_transform(self.target_name, self.division_factor)
     
     def to_sample(self, export_path: str):
         # split the transform matrix back to individual transforms
@@ -124,26 +150,11 @@ class TissueBlock(trimesh.Trimesh):
         # if metadata does not exist, insert default values 
         # (this is for tissue blocks created using from_geometry method)
         if not self.metadata:
-            self.metadata['@context'] = "https://hubmapconsortium.github.io/ccf-ontology/ccf-context.jsonld"
-            self.metadata['@id'] = f"{self.donor['id']}#{self.label}"
-            self.metadata['@type'] = 'SpatialEntity'
-            self.metadata['creator'] = 'Bhargav Snehal Desai'
-            self.metadata['creator_first_name'] = 'Bhargav Snehal'
-            self.metadata['creator_last_name'] = 'Desai'
-            self.metadata['creator_orcid'] = 'https://orcid.org/0009-0008-6509-7698'
-            self.metadata['label'] = self.label
-            self.metadata['creation_date'] = datetime.today().strftime('%Y-%m-%d')
-            self.metadata['dimension_units'] = 'millimeter'
-            self.metadata['placement'] = dict()
-            self.metadata['placement']['@context'] = "https://hubmapconsortium.github.io/ccf-ontology/ccf-context.jsonld"
-            self.metadata['placement']['@id'] = f"{self.metadata['@id']}_placement"
-            self.metadata['placement']['@type'] = 'SpatialPlacement'
-            self.metadata['placement']['target'] = f'http://purl.org/ccf/latest/ccf.owl#{self.target_name}'
-            self.metadata['placement']['placement_date'] = self.metadata['creation_date']
-            self.metadata['placement']['scaling_units'] = 'ratio'
-            self.metadata['placement']['rotation_order'] = 'XYZ'
-            self.metadata['placement']['rotation_units'] = 'degree'
-            self.metadata['placement']['translation_units'] = 'millimeter'
+            self.metadata.update(default_metadata(self.donor, self.label, self.target_name))
+
+        # collisions computed in-process (see RUIProcessor.add_collisions)
+        if getattr(self, 'collisions', None):
+            self.metadata['all_collisions'] = self.collisions
 
         # dimensions
         self.metadata['x_dimension'] = self.bounding_box.extents[0].item() * self.division_factor
@@ -170,7 +181,237 @@ class TissueBlock(trimesh.Trimesh):
 
     @lru_cache
     def show_on_target(self):
-        self.target = trimesh.load(self.mappings['RUI'][self.target_name], force='mesh')
+        path = self.mappings['RUI'][self.target_name]
+        faces, vertices = load_mesh(path, Path(path).suffix)
+        self.target = trimesh.Trimesh(vertices=vertices, faces=faces, process=False)
         return trimesh.scene.Scene(geometry=[self, 
                                              trimesh.creation.axis(), 
-                                             deepcopy(self.target)]).show()
\ No newline at end of file
+                                             deepcopy(self.target)]).show()
+
+class TissueBlockSet:
+    """Many tissue blocks as stacked arrays: (N, 8, 3) corners sharing one set of box faces, plus per-block columns"""
+    # the box every block is built from, corners of a unit cube about the origin
+    UNIT_BOX = trimesh.creation.box(extents=(1, 1, 1))
+
+    def __init__(self, 
+                 corners: np.ndarray, 
+                 placements: np.ndarray, 
+                 labels: np.ndarray, 
+                 donor_index: np.ndarray, 
+                 donors: list[dict], 
+                 metadata: list[dict], 
+                 target_names: np.ndarray, 
+                 division_factors: np.ndarray, 
+                 samples: list[dict] = None) -> None:
+        self.corners = corners
+        self.faces = self.UNIT_BOX.faces
+        self.placements = placements
+        self.labels = labels
+        self.donor_index = donor_index
+        self.donors = donors
+        self.metadata = metadata
+        self.target_names = target_names
+        self.division_factors = division_factors
+        self.samples = samples
+        self.registry = get_registry()
+
+    def __len__(self):
+        return self.corners.shape[0]
+
+    def __getitem__(self, index: int) -> TissueBlock:
+        """A TissueBlock view of a single block, as TissueBlock.from_sample would have built it"""
+        block = TissueBlock(vertices=self.corners[index], 
+                            faces=self.faces, 
+                            donor=self.donors[self.donor_index[index]], 
+                            metadata=self.metadata[index])
+        block.division_factor = self.division_factors[index].item()
+        block.label = self.labels[index]
+        block.target_name = self.target_names[index]
+        block.target_transform = block._get_target_transform()
+        block.transform = block._get_block_transform()
+        return block
+
+    def __iter__(self):
+        return (self[index] for index in range(len(self)))
+
+    @property
+    def names(self) -> list[str]:
+        """File names of the blocks, the label or (unlabelled blocks) the index"""
+        return [str(label) if label is not None else str(index) for index, label in enumerate(self.labels)]
+
+    @property
+    def array(self) -> np.ndarray:
+        """All corners as a single (N * 8, 3) array"""
+        return self.corners.reshape(-1, 3)
+
+    @classmethod
+    def from_samples(cls, samples: list[dict], donors: list[dict] | dict, donor_index: np.ndarray = None, target_name: str = None):
+        """Builds all blocks from RUI samples in one vectorized pass"""
+        donors = [donors] if isinstance(donors, dict) else donors
+        donor_index = np.zeros(len(samples), dtype=int) if donor_index is None else np.asarray(donor_index)
+        locations = [sample['rui_location'] for sample in samples]
+        placements = [location['placement'] for location in locations]
+
+        # columns
+        division_factors = np.array([getattr(DivisionFactor, location['dimension_units']).value for location in locations], dtype=float)
+        sizes = np.array([[location['x_dimension'], location['y_dimension'], location['z_dimension']] for location in locations], dtype=float)
+        scaling = np.array([[placement['x_scaling'], placement['y_scaling'], placement['z_scaling']] for placement in placements], dtype=float)
+        rotation = np.array([[placement['x_rotation'], placement['y_rotation'], placement['z_rotation']] for placement in placements], dtype=float)
+        translation = np.array([[placement['x_translation'], placement['y_translation'], placement['z_translation']] for placement in placements], dtype=float)
+        labels = np.array([sample.get('label', None) for sample in samples], dtype=object)
+        target_names = np.array([target_name or placement['target'].split('#')[-1] for placement in placements], dtype=object)
+
+        # block transforms (rotation @ scale, translation), batched Euler angles to matrices
+        blocks = np.tile(np.eye(4), (len(samples), 1, 1))
+        blocks[:, :3, :3] = Rotation.from_euler('xyz', rotation, degrees=True).as_matrix() * scaling[:, None, :]
+        blocks[:, :3, 3] = translation / division_factors[:, None]
+
+        # undo the target transforms, one inverse per distinct (target, units)
+        targets = np.empty_like(blocks)
+        for name, division_factor in set(zip(target_names, division_factors)):
+            inverse = np.linalg.inv(get_registry().target_transform(name, division_factor).matrix)
+            targets[(target_names == name) & (division_factors == division_factor)] = inverse
+        placements = targets @ blocks
+
+        # place the (sized) boxes
+        boxes = cls.UNIT_BOX.vertices[None, :, :] * (sizes / division_factors[:, None])[:, None, :]
+        corners = np.einsum('nij,nkj->nki', placements[:, :3, :3], boxes) + placements[:, None, :3, 3]
+
+        return cls(corners=corners, 
+                   placements=placements, 
+                   labels=labels, 
+                   donor_index=donor_index, 
+                   donors=donors, 
+                   metadata=locations, 
+                   target_names=target_names, 
+                   division_factors=division_factors, 
+                   samples=samples)
+
+    @classmethod
+    def from_jsonld(cls, path: str, target_name: str = None):
+        """Loads every sample of every donor in a rui_locations.jsonld"""
+        return cls.from_graph(read_json(path)['@graph'], target_name)
+
+    @classmethod
+    def from_graph(cls, graph: list[dict], target_name: str = None):
+        """Loads every sample of the donors of a (parsed) JSON-LD @graph"""
+        donors, samples, donor_index = [], [], []
+        for donor in graph:
+            donor_samples = [sample for sample in donor.get('samples', []) if 'rui_location' in sample]
+            donors.append({**{key: value for key, value in donor.items() if key != 'samples'}, 'id': donor.get('link', donor.get('@id'))})
+            samples.extend(donor_samples)
+            donor_index.extend([len(donors) - 1] * len(donor_samples))
+        return cls.from_samples(samples, donors, donor_index, target_name)
+
+    @classmethod
+    def from_registrations(cls, registration_dir: str, target_name: str = None):
+        """Loads the samples of a registrations directory (registrations.yaml and the registrations/*.json it lists)"""
+        registration_dir = Path(registration_dir)
+        donors, samples, donor_index = [], [], []
+        for registration in read_yaml(registration_dir.joinpath('registrations.yaml')):
+            defaults = registration.get('defaults', {})
+            for donor in registration['donors']:
+                donors.append({'id': defaults.get('id'), 
+                               'link': defaults.get('link'), 
+                               'consortium_name': registration.get('consortium_name'), 
+                               'provider_name': registration.get('provider_name'), 
+                               'provider_uuid': registration.get('provider_uuid'), 
+                               'sex': donor.get('sex')})
+                for sample in donor['samples']:
+                    location = read_json(registration_dir.joinpath('registrations', sample['rui_location']))
+                    samples.append({'label': location.get('label'), 'rui_location': location})
+                    donor_index.append(len(donors) - 1)
+        return cls.from_samples(samples, donors, donor_index, target_name)
+
+    def with_corners(self, corners: np.ndarray) -> 'TissueBlockSet':
+        """A set sharing every column with this one but the corners"""
+        return TissueBlockSet(corners=corners, 
+                              placements=self.placements, 
+                              labels=self.labels, 
+                              donor_index=self.donor_index, 
+                              donors=self.donors, 
+                              metadata=self.metadata, 
+                              target_names=self.target_names, 
+                              division_factors=self.division_factors, 
+                              samples=self.samples)
+
+    def project(self, projection) -> 'TissueBlockSet':
+        """Projects all blocks in one pass of the projection's compiled chain, then moves them back to their targets"""
+        corners = projection.project_array(self.array).reshape(self.corners.shape)
+        for name, division_factor in set(zip(self.target_names, self.division_factors)):
+            blocks = (self.target_names == name) & (self.division_factors == division_factor)
+            target_transform = self.registry.target_transform(name, division_factor)
+            corners[blocks] = projection.place(corners[blocks].reshape(-1, 3), target_transform).reshape(-1, 8, 3)
+        return self.with_corners(corners)
+
+    def boxes(self, oriented: bool = False) -> tuple:
+        """Extents and (N, 4, 4) box transforms of all blocks, axis-aligned (as TissueBlock.bounding_box) or oriented"""
+        transforms = np.tile(np.eye(4), (len(self), 1, 1))
+        if not oriented:
+            minimum, maximum = self.corners.min(axis=1), self.corners.max(axis=1)
+            transforms[:, :3, 3] = (minimum + maximum) / 2
+            return (maximum - minimum, transforms)
+
+        # the block's own (projected) edges: the least-squares linear part mapping the unit box onto the corners,
+        # orthonormalized to the nearest rotation (unlike the corner covariance, defined for cube-like blocks too)
+        centroid = self.corners.mean(axis=1)
+        centered = self.corners - centroid[:, None, :]
+        edges = np.einsum('nki,kj->nij', centered, np.sign(self.UNIT_BOX.vertices)) / 4
+        u, _, vt = np.linalg.svd(edges)
+        u[:, :, 2] *= np.sign(np.linalg.det(u @ vt))[:, None]
+        axes = u @ vt
+        local = np.einsum('nki,nij->nkj', centered, axes)
+        minimum, maximum = local.min(axis=1), local.max(axis=1)
+        transforms[:, :3, :3] = axes
+        transforms[:, :3, 3] = centroid + np.einsum('nij,nj->ni', axes, (minimum + maximum) / 2)
+        return (maximum - minimum, transforms)
+
+    def to_locations(self, oriented: bool = False) -> list[dict]:
+        """Updated rui_location of every block, computed for all blocks at once (see TissueBlock.to_sample)"""
+        extents, transforms = self.boxes(oriented)
+        scale, rotation, translation = split_transforms(transforms)
+        extents = (extents * self.division_factors[:, None]).tolist()
+        scale, rotation = scale.tolist(), rotation.tolist()
+        translation = (translation * self.division_factors[:, None]).tolist()
+
+        locations = []
+        for index in range(len(self)):
+            metadata = self.metadata[index] or default_metadata(self.donors[self.donor_index[index]], self.labels[index], self.target_names[index])
+            placement = {**metadata['placement'], 
+                         'x_scaling': scale[index][0], 'y_scaling': scale[index][1], 'z_scaling': scale[index][2], 
+                         'x_rotation': rotation[index][0], 'y_rotation': rotation[index][1], 'z_rotation': rotation[index][2], 
+                         'x_translation': translation[index][0], 'y_translation': translation[index][1], 'z_translation': translation[index][2]}
+            locations.append({**metadata, 
+                              'placement': placement, 
+                              'x_dimension': extents[index][0], 
+                              'y_dimension': extents[index][1], 
+                              'z_dimension': extents[index][2]})
+        return locations
+
+    def to_samples(self, export_path: str, oriented: bool = False, workers: int = 8, jsonld: str = None) -> list[dict]:
+        """Writes one RUI JSON per block (with a thread pool) and/or, with `jsonld`, a single consolidated JSON-LD"""
+        locations = self.to_locations(oriented)
+
+        if export_path:
+            export_path = Path(export_path)
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                list(executor.map(lambda item: write_json(f"{export_path / f'{item[0]}'}.json", item[1]), zip(self.names, locations)))
+
+        if jsonld:
+            self.write_jsonld(jsonld, locations)
+
+        return locations
+
+    def write_jsonld(self, path: str, locations: list[dict]):
+        """Streams the donors and their samples (with the given locations) to a rui_locations.jsonld"""
+        with open(path, 'w') as f:
+            f.write('{"@context": "https://hubmapconsortium.github.io/ccf-ontology/ccf-context.jsonld", "@graph": [')
+            for position, donor in enumerate(np.unique(self.donor_index)):
+                # the donor without its samples, left open to stream them in
+                header = json.dumps({**{key: value for key, value in self.donors[donor].items() if key != 'samples'}, 'samples': []})
+                f.write((',' if position else '') + header[:-2])
+                for count, index in enumerate(np.flatnonzero(self.donor_index == donor)):
+                    sample = self.samples[index] if self.samples else {'@type': 'Sample', 'sample_type': 'Tissue Block', 'label': self.labels[index]}
+                    f.write((',' if count else '') + json.dumps({**sample, 'rui_location': locations[index]}))
+                f.write(']}')
+            f.write(']}')
@@ -0,0 +1,141 @@
+import os
+import pickle
+import shutil
+import inspect
+import hashlib
+import tempfile
+import numpy as np
+
+from pathlib import Path
+from functools import lru_cache
+
+from utils.io import load, content_hash
+
+# bump whenever utils.io.load changes how meshes are parsed, this invalidates the on-disk cache
+LOADER_VERSION = 1
+# bump whenever a change outside the step's own module (e.g. utils.preprocess) changes its results
+STAGE_VERSION = 1
+CACHE_DIR = Path(os.environ.get('HRA_AMAP_CACHE', Path.home() / '.cache' / 'hra-amap'))
+
+
+def file_hash(path: str, chunk_size: int = 1 << 20) -> str:
+    """SHA-256 of a file's content"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _save(directory: Path, faces: np.ndarray, vertices: np.ndarray):
+    # write next to the final location and rename, so that concurrent readers never see a partial entry
+    directory.parent.mkdir(parents=True, exist_ok=True)
+    staging = Path(tempfile.mkdtemp(dir=directory.parent))
+    np.save(staging / 'faces.npy', np.ascontiguousarray(faces))
+    np.save(staging / 'vertices.npy', np.ascontiguousarray(vertices))
+    try:
+        os.replace(staging, directory)
+    except OSError:
+        # another process cached the same file first
+        shutil.rmtree(staging, ignore_errors=True)
+
+@lru_cache(maxsize=64)
+def _load_mesh(path: str, file_type: str, modified: int, size: int) -> tuple:
+    # `modified` and `size` are only part of the key, so that an edited file is not served from memory
+    directory = CACHE_DIR / 'meshes' / f'{file_hash(path)}-{LOADER_VERSION}'
+    if not directory.joinpath('vertices.npy').exists():
+        faces, vertices = load(path, file_type)
+        _save(directory, faces, vertices)
+    return (np.load(directory / 'faces.npy', mmap_mode='r'), np.load(directory / 'vertices.npy', mmap_mode='r'))
+
+def load_mesh(path: str, file_type: str) -> tuple:
+    """Cached utils.io.load: parsed meshes are kept on disk (keyed by file content) and in memory, as read-only arrays"""
+    path = Path(path).resolve()
+    stat = path.stat()
+    return _load_mesh(str(path), file_type, stat.st_mtime_ns, stat.st_size)
+
+def _fingerprint(value, digest):
+    # feeds a canonical description of the value to the digest, arrays by content
+    if isinstance(value, np.ndarray):
+        digest.update(b'array' + content_hash(value).encode())
+    elif isinstance(value, dict):
+        digest.update(b'dict')
+        for key in sorted(value, key=str):
+            digest.update(repr(key).encode())
+            _fingerprint(value[key], digest)
+    elif isinstance(value, (list, tuple)):
+        digest.update(type(value).__name__.encode())
+        for item in value:
+            _fingerprint(item, digest)
+    elif hasattr(value, 'points'):
+        _fingerprint(np.asarray(value.points), digest)
+    elif hasattr(value, '__dict__'):
+        # e.g. Transform, private attributes are derived (lazy indexes) and skipped
+        digest.update(type(value).__name__.encode())
+        _fingerprint({key: item for key, item in vars(value).items() if not key.startswith('_')}, digest)
+    else:
+        digest.update(repr(value).encode())
+
+@lru_cache(maxsize=None)
+def _code_version(path: str) -> str:
+    return file_hash(path)
+
+class StageCache:
+    """On-disk memoization of pipeline steps, keyed by their inputs, params and code, evicting least recently used entries"""
+    def __init__(self, directory: str = None, max_bytes: int = 2 << 30) -> None:
+        self.directory = Path(directory) if directory else CACHE_DIR / 'stages'
+        self.max_bytes = max_bytes
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def key(self, func, kwargs: dict) -> str:
+        digest = hashlib.sha256()
+        digest.update(f'{func.__module__}.{func.__qualname__}-{STAGE_VERSION}'.encode())
+        digest.update(_code_version(inspect.getsourcefile(func)).encode())
+        _fingerprint(kwargs, digest)
+        return digest.hexdigest()
+
+    def get(self, key: str):
+        path = self.directory / f'{key}.pkl'
+        try:
+            with open(path, 'rb') as f:
+                entry = pickle.load(f)
+            # mark as recently used
+            os.utime(path)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return None
+        return entry
+
+    def put(self, key: str, entry):
+        # atomic write, concurrent pipelines may compute the same stage
+        handle, staging = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(handle, 'wb') as f:
+            pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(staging, self.directory / f'{key}.pkl')
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for path in self.directory.glob('*.pkl'):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        # drop least recently used entries until the cache fits
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries, key=lambda entry: entry[0]):
+            if total <= self.max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+
+    def clear(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+def clear(memory: bool = True, disk: bool = False):
+    if memory:
+        _load_mesh.cache_clear()
+    if disk:
+        shutil.rmtree(CACHE_DIR / 'meshes', ignore_errors=True)
+        shutil.rmtree(CACHE_DIR / 'stages', ignore_errors=True)
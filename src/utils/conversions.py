@@ -24,61 +24,130 @@ def split_transform(matrix):
 
     return (scale, rotation, translation)
 
+def split_transforms(matrices: np.ndarray) -> tuple:
+    """Batched split_transform over (N, 4, 4) matrices"""
+    translation = matrices[:, :3, 3]
+    scale = np.linalg.norm(matrices[:, :3, :3], axis=1)
+    rotation = R.from_matrix(matrices[:, :3, :3] / scale[:, None, :]).as_euler('xyz', degrees=True)
+    return (scale, rotation, translation)
+
+class Geometry:
+    """
+    Points held as a (read-only) NumPy array, the source of truth. The Open3D point cloud and its normals
+    are only built when asked for and cached until the points change.
+    """
+    def __init__(self, points, faces: np.ndarray = None) -> None:
+        self.faces = faces
+        self.points = points
+
+    @property
+    def points(self) -> np.ndarray:
+        return self._points
+
+    @points.setter
+    def points(self, points):
+        self._points = readonly(points)
+        self._pointcloud = None
+        self._oriented = {}
+
+    def __len__(self) -> int:
+        return self._points.shape[0]
+
+    @property
+    def pointcloud(self) -> o3d.geometry.PointCloud:
+        """The points as an Open3D point cloud, without normals"""
+        if self._pointcloud is None:
+            self._pointcloud = numpy_to_pointcloud(self._points)
+        return self._pointcloud
+
+    def with_normals(self, radius: float = None, max_nn: int = 30) -> o3d.geometry.PointCloud:
+        """The point cloud with normals estimated over the `max_nn` nearest neighbours (within `radius` if given)"""
+        key = (radius, max_nn)
+        if key not in self._oriented:
+            pointcloud = o3d.geometry.PointCloud(self.pointcloud)
+            pointcloud.estimate_normals(_search(radius, max_nn))
+            self._oriented[key] = pointcloud
+        return self._oriented[key]
+
+def _search(radius: float = None, max_nn: int = 30):
+    if radius is None:
+        return o3d.geometry.KDTreeSearchParamKNN(max_nn)
+    return o3d.geometry.KDTreeSearchParamHybrid(radius=radius, max_nn=max_nn)
+
 def to_array(geometry):
+    """The vertices as an (N, 3) array, a read-only view (no copy) for point clouds, meshes and Geometry"""
     if isinstance(geometry, o3d.geometry.PointCloud):
         return pointcloud_to_numpy(geometry)
-    elif isinstance(geometry, trimesh.base.Trimesh):
-        return mesh_to_numpy(geometry)
+    elif isinstance(geometry, (trimesh.base.Trimesh, Geometry)):
+        return readonly(geometry)
     else: 
         return geometry
     
-def to_pointcloud(geometry):
-    if isinstance(geometry, np.ndarray):
-        return numpy_to_pointcloud(geometry)
+def to_pointcloud(geometry, normals: bool = False):
+    """An Open3D point cloud of the vertices, normals are only estimated when asked for (`normals=True`)"""
+    if isinstance(geometry, Geometry):
+        return geometry.with_normals() if normals else geometry.pointcloud
+    elif isinstance(geometry, np.ndarray):
+        return numpy_to_pointcloud(geometry, normals)
     elif isinstance(geometry, trimesh.base.Trimesh):
-        return mesh_to_pointcloud(geometry)
-    else: 
-        return geometry
+        return mesh_to_pointcloud(geometry, normals)
+    elif normals and not geometry.has_normals():
+        geometry = o3d.geometry.PointCloud(geometry)
+        geometry.estimate_normals(_search())
+    return geometry
     
 def to_mesh(geometry, faces, process=True):
     if isinstance(geometry, np.ndarray):
         return numpy_to_mesh(geometry, faces, process)
     elif isinstance(geometry, o3d.geometry.PointCloud):
         return pointcloud_to_mesh(geometry, faces, process)
+    elif isinstance(geometry, Geometry):
+        return numpy_to_mesh(geometry.points, faces, process)
     else: 
         return geometry
 
-def mesh_to_pointcloud(mesh: trimesh.base.Trimesh) -> o3d.geometry.PointCloud:
+def readonly(geometry) -> np.ndarray:
+    """Returns an immutable view of the vertices, shared instead of copied between pipeline steps"""
+    if isinstance(geometry, trimesh.base.Trimesh):
+        geometry = geometry.vertices
+    elif isinstance(geometry, Geometry):
+        geometry = geometry.points
+    view = np.asarray(geometry).view()
+    view.flags.writeable = False
+    return view
+
+def mesh_to_pointcloud(mesh: trimesh.base.Trimesh, normals: bool = False) -> o3d.geometry.PointCloud:
     """Converts a trimesh mesh object to an open3d compatible point cloud"""
-    pcd = o3d.geometry.PointCloud()
-    pcd.points = o3d.utility.Vector3dVector(np.array(mesh.vertices))
-    pcd.estimate_normals()
-    return pcd
+    return numpy_to_pointcloud(np.asarray(mesh.vertices), normals)
 
 def mesh_to_numpy(mesh: trimesh.Trimesh) -> np.ndarray:
     """Converts a trimesh mesh object to a numpy array"""
     return np.array(mesh.vertices)
 
-def numpy_to_pointcloud(numpy_array: np.ndarray) -> o3d.geometry.PointCloud:
+def numpy_to_pointcloud(numpy_array: np.ndarray, normals: bool = False) -> o3d.geometry.PointCloud:
     """Converts a numpy array to an open3d compatible point cloud"""
     pcd = o3d.geometry.PointCloud()
-    pcd.points = o3d.utility.Vector3dVector(numpy_array)
-    pcd.estimate_normals()
+    # Open3D rejects read-only arrays (as shared between pipeline steps), it copies the points either way
+    pcd.points = o3d.utility.Vector3dVector(np.require(numpy_array, dtype=np.float64, requirements=['C', 'W']))
+    if normals:
+        pcd.estimate_normals(_search())
     return pcd
 
 def numpy_to_mesh(numpy_array: np.ndarray, faces: np.ndarray, process=True) -> trimesh.base.Trimesh:
     return trimesh.Trimesh(vertices=numpy_array, faces=faces, process=process)
 
 def pointcloud_to_numpy(pointcloud: o3d.geometry.PointCloud) -> np.ndarray:
-    return np.array(pointcloud.points)
+    # a read-only view of Open3D's buffer, copy it to modify it
+    return readonly(np.asarray(pointcloud.points))
 
 def pointcloud_to_mesh(pointcloud: o3d.geometry.PointCloud, faces: np.ndarray, process=True) -> o3d.geometry.PointCloud:
     """Converts a open3d point cloud object to trimesh mesh object"""
     return trimesh.Trimesh(vertices=np.array(pointcloud.points), faces=faces, process=process)
 
-def txt_to_numpy(path: str) -> np.ndarray:
+def txt_to_numpy(path: str, delimiter=None) -> np.ndarray:
     """Converts an array saved as a text to a numpy object"""
-    return np.genfromtxt(path)
+    # loadtxt parses in a single pass, unlike genfromtxt
+    return np.loadtxt(path, delimiter=delimiter)
 
 def txt_to_pandas(path: str) -> pd.DataFrame:
     # load the correspondences
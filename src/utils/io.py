@@ -1,6 +1,9 @@
 import json
 import yaml
+import struct
+import hashlib
 import trimesh
+import numpy as np
 import open3d as o3d
 
 from pathlib import Path
@@ -23,6 +26,15 @@ def load(file_name: str, file_type: str) -> trimesh.Trimesh:
 
     return (mesh.faces, mesh.vertices)
 
+def content_hash(*arrays) -> str:
+    """SHA-256 over the raw bytes of the given arrays"""
+    digest = hashlib.sha256()
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        digest.update(str((array.dtype.str, array.shape)).encode())
+        digest.update(array.data)
+    return digest.hexdigest()
+
 def read_json(path: str) -> dict:
     """Reads a JSON file, returns a Python Dict object"""
     with open(path) as f:
@@ -34,6 +46,24 @@ def write_json(path: str, data):
     with open(path, 'w') as f:
         json.dump(data, f, indent='\t')
 
+def read_glb_nodes(path: str) -> dict:
+    """The nodes of a .glb (its JSON chunk only), name -> node, with the `extras` trimesh drops on load"""
+    with open(path, 'rb') as f:
+        magic, _, _ = struct.unpack('<4sII', f.read(12))
+        length, kind = struct.unpack('<I4s', f.read(8))
+        if magic != b'glTF' or kind != b'JSON':
+            raise ValueError(f"{path} is not a binary glTF (.glb) file")
+        document = json.loads(f.read(length))
+    return {node.get('name', str(index)): node for index, node in enumerate(document.get('nodes', []))}
+
+def write_txt(path: str, array, delimiter=',', fmt='%.17g', chunk_size=65536):
+    """Writes a 2D array as delimited text, formatting a whole chunk of rows at once instead of row by row"""
+    row = delimiter.join([fmt] * array.shape[1]) + '\n'
+    with open(path, 'w') as f:
+        for start in range(0, array.shape[0], chunk_size):
+            chunk = array[start:start + chunk_size]
+            f.write((row * chunk.shape[0]) % tuple(chunk.ravel().tolist()))
+
 def read_yaml(path: str) -> dict:
     """Reads a YAML file, returns a Python Dict object"""
     with open(path, "r") as f:
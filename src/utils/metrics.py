@@ -1,27 +1,99 @@
+import trimesh
 import numpy as np
 import point_cloud_utils as pcu
 
+from pathlib import Path
+from collections import OrderedDict
+from dataclasses import dataclass
+from scipy.spatial import cKDTree
+from scipy.special import gammaln
+
+from utils.io import content_hash
 from utils.conversions import mesh_to_numpy
 
-def sinkhorn(target_mesh, registered_mesh):
-    dec_ref, dec_reg = target_mesh.simplify_quadratic_decimation(20000), registered_mesh.simplify_quadratic_decimation(20000)
-    a, b = mesh_to_numpy(dec_ref), mesh_to_numpy(dec_reg)
+def _sample(mesh, max_points: int, rng: np.random.Generator) -> np.ndarray:
+    """Mesh vertices, randomly subsampled down to the point budget"""
+    points = mesh_to_numpy(mesh)
+    if max_points and points.shape[0] > max_points:
+        points = points[rng.choice(points.shape[0], max_points, replace=False)]
+    return points
+
+def _distances(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Euclidean distances between the rows of a tile of `a` and a tile of `b`"""
+    squared = np.sum(a ** 2, axis=1)[:, None] + np.sum(b ** 2, axis=1)[None, :] - 2 * a @ b.T
+    return np.sqrt(np.maximum(squared, 0))
+
+def _softmin(a: np.ndarray, b: np.ndarray, potential: np.ndarray, eps: float, tile_size: int) -> np.ndarray:
+    """-eps * log sum_j exp((potential_j - C_ij) / eps) for every row i, streamed over (tile x tile) blocks of C"""
+    result = np.empty(a.shape[0])
+    for i in range(0, a.shape[0], tile_size):
+        # running (max, sum) of the log-sum-exp over the column tiles
+        peak = np.full(min(tile_size, a.shape[0] - i), -np.inf)
+        total = np.zeros_like(peak)
+        for j in range(0, b.shape[0], tile_size):
+            exponent = (potential[j:j + tile_size][None, :] - _distances(a[i:i + tile_size], b[j:j + tile_size])) / eps
+            new_peak = np.maximum(peak, exponent.max(axis=1))
+            total = total * np.exp(peak - new_peak) + np.exp(exponent - new_peak[:, None]).sum(axis=1)
+            peak = new_peak
+        result[i:i + tile_size] = -eps * (peak + np.log(total))
+    return result
+
+def sinkhorn_points(a: np.ndarray, 
+                    b: np.ndarray, 
+                    eps: float = 1e-3, 
+                    tile_size: int = 2048, 
+                    max_iterations: int = 1000, 
+                    tolerance: float = 1e-6) -> float:
+    """Entropic optimal transport cost between two uniformly weighted point sets (log-domain Sinkhorn), 
+    the (n x m) cost matrix is never held in memory, only (tile_size x tile_size) blocks of it"""
+    log_a, log_b = -np.log(a.shape[0]), -np.log(b.shape[0])
+    f, g = np.zeros(a.shape[0]), np.zeros(b.shape[0])
+    for _ in range(max_iterations):
+        previous = f
+        f = _softmin(a, b, g + eps * log_b, eps, tile_size)
+        g = _softmin(b, a, f + eps * log_a, eps, tile_size)
+        if np.max(np.abs(f - previous)) < tolerance:
+            break
 
-    # M is a 100x100 array where each entry  (i, j) is the L2 distance between point a[i, :] and b[j, :]
-    M = pcu.pairwise_distances(a, b)
+    # <C, P> with P_ij = exp((f_i + g_j - C_ij) / eps) a_i b_j, block by block
+    cost = 0.0
+    for i in range(0, a.shape[0], tile_size):
+        for j in range(0, b.shape[0], tile_size):
+            distances = _distances(a[i:i + tile_size], b[j:j + tile_size])
+            plan = np.exp((f[i:i + tile_size, None] + g[None, j:j + tile_size] - distances) / eps + log_a + log_b)
+            cost += np.sum(plan * distances)
+    return cost
 
-    # w_a and w_b are masses assigned to each point. In this case each point is weighted equally.
-    w_a = np.ones(a.shape[0])
-    w_b = np.ones(b.shape[0])
+def sinkhorn(target_mesh, registered_mesh, max_points=10000, eps=1e-3, tile_size=2048, seed=0, **kwargs):
+    # a random subset of the vertices replaces decimation, memory only depends on the tile size
+    rng = np.random.default_rng(seed)
+    a, b = _sample(target_mesh, max_points, rng), _sample(registered_mesh, max_points, rng)
 
-    # P is the transport matrix between a and b, eps is a regularization parameter, smaller epsilons lead to
-    # better approximation of the true Wasserstein distance at the expense of slower convergence
-    P = pcu.sinkhorn(w_a, w_b, M, eps=1e-3)
+    # smaller epsilons lead to better approximation of the true Wasserstein distance at the expense of slower convergence
+    return sinkhorn_points(a, b, eps=eps, tile_size=tile_size, **kwargs)
 
-    # to get the distance as a number just compute the frobenius inner product <M, P>
-    sinkhorn_dist = (M*P).sum()
+def sliced_wasserstein_points(a: np.ndarray, b: np.ndarray, projections: int = 128, quantiles: int = 1024, seed: int = 0) -> float:
+    """Sliced 1-Wasserstein distance: mean over random directions of the 1D transport cost between the projections,
+    scaled by the mean |cos| between a random direction and a fixed one, so that a translation by t costs |t|"""
+    rng = np.random.default_rng(seed)
+    directions = rng.normal(size=(projections, a.shape[1]))
+    directions /= np.linalg.norm(directions, axis=1, keepdims=True)
 
-    return sinkhorn_dist
+    # compare both projected distributions at the same quantiles, so the point counts may differ
+    levels = (np.arange(quantiles) + 0.5) / quantiles
+    distance = 0.0
+    for direction in directions:
+        distance += np.mean(np.abs(np.quantile(a @ direction, levels) - np.quantile(b @ direction, levels)))
+
+    # E|<u, e>| over the unit sphere, 1/2 in 3D
+    dimensions = a.shape[1]
+    mean_cosine = np.exp(gammaln(dimensions / 2) - gammaln((dimensions + 1) / 2)) / np.sqrt(np.pi)
+    return distance / projections / mean_cosine
+
+def sliced_wasserstein(target_mesh, registered_mesh, max_points=None, projections=128, seed=0):
+    rng = np.random.default_rng(seed)
+    a, b = _sample(target_mesh, max_points, rng), _sample(registered_mesh, max_points, rng)
+    return sliced_wasserstein_points(a, b, projections=projections, seed=seed)
 
 def chamfer(target_mesh, registered_mesh):
     a = mesh_to_numpy(target_mesh)
@@ -35,6 +107,151 @@ def hausdorff(target_mesh, registered_mesh):
     hausdorff_dist = pcu.hausdorff_distance(a, b)
     return hausdorff_dist
 
+def closest_points_on_triangles(points: np.ndarray, a: np.ndarray, b: np.ndarray, c: np.ndarray) -> np.ndarray:
+    """Closest point on triangle (a, b, c) to each point, row-wise (Ericson, Real-Time Collision Detection, 5.1.5)"""
+    dot = lambda u, v: np.einsum('...k,...k->...', u, v)
+    ab, ac, ap, bp, cp = b - a, c - a, points - a, points - b, points - c
+    d1, d2, d3, d4, d5, d6 = dot(ab, ap), dot(ac, ap), dot(ab, bp), dot(ac, bp), dot(ab, cp), dot(ac, cp)
+    va, vb, vc = d3 * d6 - d5 * d4, d5 * d2 - d1 * d6, d1 * d4 - d3 * d2
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # barycentric (v, w) of the closest point for every Voronoi region of the triangle, picked in Ericson's order
+        denominator = va + vb + vc
+        regions = [((d1 <= 0) & (d2 <= 0), 0, 0), 
+                   ((d3 >= 0) & (d4 <= d3), 1, 0), 
+                   ((vc <= 0) & (d1 >= 0) & (d3 <= 0), d1 / (d1 - d3), 0), 
+                   ((d6 >= 0) & (d5 <= d6), 0, 1), 
+                   ((vb <= 0) & (d2 >= 0) & (d6 <= 0), 0, d2 / (d2 - d6)), 
+                   ((va <= 0) & (d4 - d3 >= 0) & (d5 - d6 >= 0), 1 - (d4 - d3) / ((d4 - d3) + (d5 - d6)), (d4 - d3) / ((d4 - d3) + (d5 - d6)))]
+        conditions = [condition for condition, _, _ in regions]
+        v = np.select(conditions, [np.broadcast_to(v, d1.shape) for _, v, _ in regions], vb / denominator)
+        w = np.select(conditions, [np.broadcast_to(w, d1.shape) for _, _, w in regions], vc / denominator)
+    return a + v[..., None] * ab + w[..., None] * ac
+
+class SurfaceIndex:
+    """
+    Exact nearest-surface (point-to-triangle) queries against a mesh, built once and shared between evaluations.
+
+    The triangles are binned by their radius (largest centroid-to-corner distance, within a factor of two per bin) with
+    a KD-tree over the centroids of each bin. A triangle whose centroid is d away is at least d - radius away, so the
+    nearest centroids of a bin are searched, doubling k, until the next one cannot hold a closer triangle. Large
+    triangles far from any vertex or small centroid are thereby never missed.
+    """
+    def __init__(self, mesh, candidates: int = 16, workers: int = -1) -> None:
+        self.vertices = np.asarray(mesh.vertices, dtype=float)
+        self.faces = np.asarray(mesh.faces)
+        self.candidates = candidates
+        self.workers = workers
+
+        # the nearest (referenced) vertex bounds the distance to the surface from above
+        self.points = cKDTree(self.vertices[np.unique(self.faces)])
+
+        triangles = self.vertices[self.faces]
+        centroids = triangles.mean(axis=1)
+        self.radii = np.linalg.norm(triangles - centroids[:, None, :], axis=2).max(axis=1)
+        scales = np.floor(np.log2(np.maximum(self.radii, np.finfo(float).tiny))).astype(int)
+
+        # the most populated bin first, it tightens the bound the other bins are searched with
+        self.bins = []
+        for scale in sorted(np.unique(scales), key=lambda scale: -np.count_nonzero(scales == scale)):
+            faces = np.flatnonzero(scales == scale)
+            self.bins.append((faces, cKDTree(centroids[faces]), self.radii[faces].max()))
+
+    def _search(self, points: np.ndarray, best: np.ndarray, closest: np.ndarray, faces: np.ndarray, centroids: cKDTree, radius: float):
+        """Lowers `best` / `closest` (in place) to the nearest triangle of a bin wherever it is closer"""
+        start, k, active = 0, min(self.candidates, len(faces)), np.arange(len(points))
+        while active.size:
+            centroid_distances, neighbours = centroids.query(points[active], k=k, workers=self.workers)
+            centroid_distances = centroid_distances.reshape(len(active), -1)[:, start:]
+            neighbours = faces[neighbours.reshape(len(active), -1)[:, start:]]
+
+            # exact distance to the new candidates that may be closer (lower bound: centroid distance - own radius)
+            rows, columns = np.nonzero(centroid_distances - self.radii[neighbours] < best[active, None])
+            if rows.size:
+                triangles = self.vertices[self.faces[neighbours[rows, columns]]]
+                candidates = closest_points_on_triangles(points[active[rows]], triangles[:, 0], triangles[:, 1], triangles[:, 2])
+                distances = np.linalg.norm(candidates - points[active[rows]], axis=1)
+
+                # the closest candidate of every point, kept where it improves
+                order = np.lexsort((distances, rows))
+                first = order[np.flatnonzero(np.diff(rows[order], prepend=-1))]
+                improved = distances[first] < best[active[rows[first]]]
+                best[active[rows[first[improved]]]] = distances[first[improved]]
+                closest[active[rows[first[improved]]]] = candidates[first[improved]]
+
+            # the triangles beyond the k-th centroid are at least its distance minus the radius away
+            if k == len(faces):
+                break
+            active = active[centroid_distances[:, -1] - radius < best[active]]
+            start, k = k, min(2 * k, len(faces))
+
+    def query(self, points: np.ndarray, chunk_size: int = 16384) -> tuple:
+        """Distance to, and closest point on, the surface for every point, in chunks"""
+        distances, closest = np.empty(points.shape[0]), np.empty_like(points, dtype=float)
+        for start in range(0, points.shape[0], chunk_size):
+            chunk = points[start:start + chunk_size]
+            best, nearest = self.points.query(chunk, workers=self.workers)
+            point = self.points.data[nearest]
+            for faces, centroids, radius in self.bins:
+                self._search(chunk, best, point, faces, centroids, radius)
+            distances[start:start + chunk_size] = best
+            closest[start:start + chunk_size] = point
+        return (distances, closest)
+
+_indexes = OrderedDict()
+
+def surface_index(mesh, max_indexes: int = 8) -> SurfaceIndex:
+    """SurfaceIndex of a mesh, cached by content so that evaluating many projections against one reference builds it once"""
+    key = content_hash(mesh.vertices, mesh.faces)
+    if key not in _indexes:
+        _indexes[key] = SurfaceIndex(mesh)
+        if len(_indexes) > max_indexes:
+            _indexes.popitem(last=False)
+    _indexes.move_to_end(key)
+    return _indexes[key]
+
+@dataclass
+class ErrorField:
+    """Per-vertex distance of a registered mesh to the target surface, with its summary statistics"""
+    distances: np.ndarray
+    statistics: dict
+    histogram: tuple
+
+    def to_mesh(self, registered_mesh, color_map: str = 'viridis') -> trimesh.Trimesh:
+        """The registered mesh with its vertices colored by error"""
+        return trimesh.Trimesh(vertices=registered_mesh.vertices, 
+                               faces=registered_mesh.faces, 
+                               vertex_colors=trimesh.visual.interpolate(self.distances, color_map=color_map), 
+                               process=False)
+
+    def export(self, registered_mesh, path: str, color_map: str = 'viridis'):
+        """Writes the vertex-colored error mesh (e.g. errormap.glb)"""
+        self.to_mesh(registered_mesh, color_map).export(file_obj=Path(path))
+
+def error_field(target_mesh, 
+                registered_mesh, 
+                symmetric: bool = True, 
+                bins: int = 50, 
+                percentiles: tuple = (50, 75, 90, 95, 99)) -> ErrorField:
+    """
+    Distances from every registered vertex to the target surface, with their mean / max / percentiles / histogram, 
+    and the (symmetric) chamfer and hausdorff distances, which also need the distances from the target back to the 
+    registered surface. The field and the one-sided statistics come from a single pass, symmetric=False skips the other
+    """
+    distances, _ = surface_index(target_mesh).query(mesh_to_numpy(registered_mesh))
+    statistics = {'mean_distance': distances.mean().item(), 
+                  'max_distance': distances.max().item(), 
+                  'rmse': np.sqrt(np.mean(distances ** 2)).item()}
+    statistics.update({f'p{percentile}': value.item() for percentile, value in zip(percentiles, np.percentile(distances, percentiles))})
+
+    if symmetric:
+        # the other direction needs an index over the registered surface, summed as pcu.chamfer_distance does
+        reverse, _ = surface_index(registered_mesh).query(mesh_to_numpy(target_mesh))
+        statistics['chamfer'] = (distances.mean() + reverse.mean()).item()
+        statistics['hausdorff'] = max(distances.max(), reverse.max()).item()
+
+    return ErrorField(distances=distances, statistics=statistics, histogram=np.histogram(distances, bins=bins))
+
 def shape_complexity(mesh):
     raise NotImplementedError
 
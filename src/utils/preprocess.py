@@ -9,7 +9,7 @@ def mean(geometry):
 
 def scale(geometry, method='unit'):
     if method == 'unit':
-        scale = (1 / np.max(to_pointcloud(geometry).get_max_bound() - to_pointcloud(geometry).get_min_bound()))
+        scale = (1 / np.max(np.ptp(to_array(geometry), axis=0)))
     if method == 'stddev':
         center = mean(geometry)
         array = to_array(geometry)
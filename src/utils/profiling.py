@@ -0,0 +1,85 @@
+import sys
+import json
+import time
+import resource
+import pandas as pd
+
+from contextlib import contextmanager
+
+# ru_maxrss is reported in kilobytes on Linux and in bytes on macOS
+_RSS_UNIT = 1 if sys.platform == 'darwin' else 1024
+
+
+def points(geometry) -> int:
+    """Number of points (vertices) of an array, point cloud or mesh, 0 for anything else"""
+    if hasattr(geometry, 'shape') and len(geometry.shape) == 2:
+        return int(geometry.shape[0])
+    elif hasattr(geometry, 'points'):
+        return len(geometry.points)
+    elif hasattr(geometry, 'vertices'):
+        return len(geometry.vertices)
+    return 0
+
+def _usage() -> tuple:
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return (time.perf_counter(),
+            time.process_time(),
+            children.ru_utime + children.ru_stime,
+            own.ru_maxrss * _RSS_UNIT)
+
+@contextmanager
+def measure(record: dict):
+    """Fills `record` with the wall time, CPU time, (waited for) subprocess CPU time and peak RSS growth of the block"""
+    wall, cpu, children, rss = _usage()
+    record['start'] = time.time()
+    try:
+        yield record
+    finally:
+        end_wall, end_cpu, end_children, end_rss = _usage()
+        record['wall_time'] = end_wall - wall
+        record['cpu_time'] = end_cpu - cpu
+        record['subprocess_time'] = end_children - children
+        # the peak is a high-water mark: only growth beyond the previous peak shows up
+        record['peak_rss_delta'] = end_rss - rss
+
+def summary(steps: dict) -> pd.DataFrame:
+    """One row per profiled step with its share of the total wall time"""
+    rows = [{'step': key, 'name': step.name, **step.profile.to_dict()} for key, step in steps.items() if step.profile]
+    table = pd.DataFrame(rows)
+    if not table.empty:
+        table['share'] = table['wall_time'] / table['wall_time'].sum()
+    return table
+
+def to_chrome_trace(steps: dict, process_name: str = 'pipeline', pid: int = 0) -> list:
+    """Complete ('X') events in the Chrome trace event format, loadable in chrome://tracing or Perfetto"""
+    profiled = [(key, step) for key, step in steps.items() if step.profile]
+    if not profiled:
+        return []
+    origin = min(step.profile.start for _, step in profiled)
+
+    events = [{'name': 'process_name', 'ph': 'M', 'pid': pid, 'tid': 0, 'args': {'name': process_name}}]
+    for key, step in profiled:
+        profile = step.profile.to_dict()
+        events.append({'name': step.name,
+                       'cat': key,
+                       'ph': 'X',
+                       'ts': (profile.pop('start') - origin) * 1e6,
+                       'dur': profile['wall_time'] * 1e6,
+                       'pid': pid,
+                       'tid': 0,
+                       'args': profile})
+    return events
+
+def export(steps: dict, path: str, format: str = 'json', process_name: str = 'pipeline'):
+    """Writes the step profiles as a JSON list ('json') or as a Chrome trace ('chrome')"""
+    if format == 'json':
+        data = [{'step': key, 'name': step.name, 'description': step.description, **step.profile.to_dict()}
+                for key, step in steps.items() if step.profile]
+    elif format == 'chrome':
+        data = {'traceEvents': to_chrome_trace(steps, process_name), 'displayTimeUnit': 'ms'}
+    else:
+        raise ValueError(f"{format} not recognized, must be one of json or chrome")
+
+    with open(path, 'w') as f:
+        json.dump(data, f, indent='\t')
@@ -0,0 +1,9 @@
+import os
+import sys
+
+from pathlib import Path
+
+# the modules import each other as top-level modules and resolve configs relative to src/
+SRC = Path(__file__).parent.parent.joinpath('src')
+sys.path.insert(0, str(SRC))
+os.chdir(SRC)
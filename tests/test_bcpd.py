@@ -0,0 +1,85 @@
+import trimesh
+import numpy as np
+import pytest
+
+from pathlib import Path
+from scipy.spatial import cKDTree
+from scipy.spatial.transform import Rotation
+
+import bcpd
+
+DATA = Path(__file__).parent.parent.joinpath('data')
+FIXTURES = Path(__file__).parent.joinpath('fixtures')
+PARAMS = {'lambda': 10, 'beta': 2, 'gamma': 1, 'distance_threshold': 1e-8, 'max_iterations': 300, 'seed': 26, 
+          'nystrom_samples': 300, 'nystrom_rank': 70}
+
+
+def _pair(points: int = 1500):
+    """The kidney pair, unit normalized as by the pipeline and downsampled"""
+    arrays = []
+    for path in ('Kidney/Source/VH_F_Kidney_R.glb', 'Kidney/Reference/VH_M_Kidney_R.glb'):
+        array = np.asarray(trimesh.load(DATA / path, force='mesh').vertices)
+        array = (array - array.mean(axis=0)) / np.max(np.ptp(array, axis=0))
+        arrays.append(bcpd.downsample(array, points, rng=np.random.default_rng(0)))
+    return arrays
+
+def _distance(registered, target):
+    return cKDTree(target).query(registered)[0].mean()
+
+def test_kdtree_expectation_matches_dense():
+    source, target = _pair(800)
+    dense = bcpd.register(source, target, {**PARAMS, 'e_step': 'dense'})
+    truncated = bcpd.register(source, target, {**PARAMS, 'e_step': 'kdtree'})
+
+    assert np.abs(dense.registered - truncated.registered).mean() < 0.01
+    assert _distance(truncated.registered, target) < 1.1 * _distance(dense.registered, target) + 1e-3
+
+def test_auto_expectation_switches_to_kdtree(monkeypatch):
+    source, target = _pair(300)
+    calls = []
+    monkeypatch.setattr(bcpd, 'DENSE_PAIRS', 1)
+    monkeypatch.setattr(bcpd, '_expectation', lambda *args: calls.append(args))
+    bcpd.register(source, target, {**PARAMS, 'max_iterations': 2})
+    assert not calls
+
+def test_native_matches_reference_result():
+    """
+    Against a result of the BCPD binary kept in results/Projections (GenericOvary_Left, lambda 100, beta 1):
+    the source and target as normalized for the non-rigid step, with the source subsampled to 800 distinct points
+    and the reference similarity transform and deformation vector field at those points
+    """
+    reference = np.load(FIXTURES / 'bcpd_generic_ovary_left.npz')
+    source, target = reference['source'], reference['target']
+    registered = reference['scale'] * (source + reference['deformation']) @ reference['rotation'].T + reference['translation']
+    native = bcpd.register(source, target, {'lambda': 100, 'beta': 1, 'distance_threshold': 1e-8, 'max_iterations': 1000, 'seed': 26})
+
+    # same similarity transform
+    assert native.scale == pytest.approx(float(reference['scale']), rel=0.1)
+    assert Rotation.from_matrix(native.rotation @ reference['rotation'].T).magnitude() < np.radians(5)
+    assert np.linalg.norm(native.translation - reference['translation']) < 0.1
+
+    # same deformation and registration (the cloud has unit standard deviation)
+    assert np.abs((native.deformed - source) - reference['deformation']).mean() < 0.08
+    assert np.abs(native.registered - registered).mean() < 0.06
+    assert _distance(native.registered, target) < 1.1 * _distance(registered, target)
+
+@pytest.mark.skipif(not Path('../bcpd/bcpd').exists(), reason='the BCPD binary is not built')
+def test_native_matches_binary():
+    from steps import _register_bcpd, _register_native
+
+    source, target = _pair()
+    params = {**PARAMS, 'threads': 0}
+    binary = _register_bcpd(source, target, params)
+    native = _register_native(source, target, params)
+    (_, binary_deformed, binary_scale, binary_rotation, binary_translation, binary_registered) = binary
+    (_, native_deformed, native_scale, native_rotation, native_translation, native_registered) = native
+
+    # same similarity transform
+    assert native_scale == pytest.approx(binary_scale, rel=0.05)
+    assert Rotation.from_matrix(native_rotation @ binary_rotation.T).magnitude() < np.radians(5)
+    assert np.linalg.norm(native_translation - binary_translation) < 0.05
+
+    # same deformation and registration
+    assert np.abs((native_deformed - source) - (binary_deformed - source)).mean() < 0.02
+    assert np.abs(native_registered - binary_registered).mean() < 0.02
+    assert _distance(native_registered, target) < 1.2 * _distance(binary_registered, target) + 1e-3
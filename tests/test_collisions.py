@@ -0,0 +1,86 @@
+import numpy as np
+import trimesh
+
+from pathlib import Path
+
+from config import get_registry
+from utils.io import read_json
+from tissue import TissueBlockSet
+from collisions import CollisionDetector, WindingTree, winding_numbers
+
+TARGET = 'VHFLeftOvary'
+FIXTURES = Path(__file__).parent.joinpath('fixtures')
+JSONLD = Path(__file__).parent.parent.joinpath('data', 'Millitome', 'Generic Ovary', 'Female', 'Left', 'rui_locations.jsonld')
+
+
+def _placed(blocks: TissueBlockSet) -> np.ndarray:
+    # the corners in the RUI placement frame, as Projection.project / TissueBlockSet.project leave them
+    target_transform = get_registry().target_transform(TARGET, 1e3)
+    return target_transform(blocks.array).reshape(blocks.corners.shape)
+
+def _sample(center: np.ndarray, size: float) -> dict:
+    """A rui_location of a `size` mm cube centred at `center` (placement frame, meters)"""
+    placement = {'target': f'http://purl.org/ccf/latest/ccf.owl#{TARGET}', 
+                 'x_scaling': 1, 'y_scaling': 1, 'z_scaling': 1, 
+                 'x_rotation': 0, 'y_rotation': 0, 'z_rotation': 0, 
+                 'x_translation': center[0] * 1e3, 'y_translation': center[1] * 1e3, 'z_translation': center[2] * 1e3}
+    return {'label': 'block', 
+            'rui_location': {'dimension_units': 'millimeter', 'x_dimension': size, 'y_dimension': size, 'z_dimension': size, 
+                             'placement': placement}}
+
+def test_block_inside_a_structure_collides_with_it():
+    detector = CollisionDetector.from_target(TARGET)
+    # the centroid of the organ (GLB frame) and its position in the placement frame of the rui_locations
+    mesh = trimesh.load(get_registry().mappings['RUI'][TARGET], force='mesh')
+    assert winding_numbers(mesh.centroid[None, :], np.asarray(mesh.triangles))[0] > 0.5
+    center = get_registry().target_transform(TARGET, 1e3)(mesh.centroid[None, :])[0]
+
+    # a 1 mm block at the centre of the organ, placed from its rui_location
+    blocks = TissueBlockSet.from_samples([_sample(center, 1)], {})
+    assert detector.collide(_placed(blocks)).max() > 0.99
+
+    # and one far outside of it
+    blocks = TissueBlockSet.from_samples([_sample(center + 0.5, 1)], {})
+    assert detector.collide(_placed(blocks)).max() == 0
+
+def test_millitome_blocks_collide_with_the_ovary():
+    blocks = TissueBlockSet.from_jsonld(JSONLD)
+    detector = CollisionDetector.from_target(TARGET)
+    fractions = detector.collide(_placed(blocks))
+
+    # the millitome grid is laid over the organ, most blocks cut into it
+    assert (fractions.max(axis=1) > 0).mean() > 0.5
+
+def test_winding_tree_matches_brute_force():
+    rng = np.random.default_rng(0)
+    mesh = trimesh.creation.icosphere(subdivisions=4)
+    triangles = np.asarray(mesh.triangles)
+    points = rng.uniform(-1.5, 1.5, size=(1000, 3))
+
+    exact = winding_numbers(points, triangles)
+    # budgets far below a single chunk change the chunking, not the result
+    assert np.allclose(winding_numbers(points, triangles, memory=2 ** 20), exact)
+    tree = WindingTree(triangles)
+    approximate = tree(points)
+    assert np.abs(approximate - exact).max() < 0.05
+    assert np.allclose(tree(points, memory=2 ** 20), approximate)
+
+    # inside / outside away from the surface
+    radii = np.linalg.norm(points, axis=1)
+    assert np.all(((approximate > 0.5) == (radii < 1))[np.abs(radii - 1) > 0.02])
+
+def test_summary_in_the_shape_of_the_processor():
+    """
+    The stored all_collisions of a 1 mm block at the centre of the left ovary. It follows the RUI locations processor's
+    CollisionSummary, with the structure's IRIs and label taken from the crosswalk entry embedded in VH_F_Ovary_L.glb.
+    """
+    fixture = read_json(FIXTURES / 'collisions_ovary_centre.json')
+    blocks = TissueBlockSet.from_samples([fixture['sample']], {})
+    summary, = CollisionDetector.from_target(TARGET).summaries(_placed(blocks))
+
+    expected, = fixture['all_collisions']
+    assert {key: value for key, value in summary[0].items() if key != 'collisions'} == {key: value for key, value in expected.items() if key != 'collisions'}
+    assert len(summary[0]['collisions']) == len(expected['collisions'])
+    for item, expected_item in zip(summary[0]['collisions'], expected['collisions']):
+        assert {key: value for key, value in item.items() if not isinstance(value, float)} == {key: value for key, value in expected_item.items() if not isinstance(value, float)}
+        assert np.isclose(item['percentage'], expected_item['percentage']) and np.isclose(item['as_volume'], expected_item['as_volume'])
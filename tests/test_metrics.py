@@ -0,0 +1,78 @@
+import pytest
+import numpy as np
+import trimesh
+
+# utils.metrics imports point_cloud_utils for its chamfer / hausdorff metrics
+pytest.importorskip('point_cloud_utils')
+from utils.metrics import SurfaceIndex, closest_points_on_triangles, error_field, sinkhorn_points, sliced_wasserstein_points
+
+
+def test_chamfer_is_symmetric():
+    # the corners of the inner box are 0.5 from the outer box's faces, the outer corners sqrt(3) * 0.5 from the inner box
+    outer, inner = trimesh.creation.box(extents=(2, 2, 2)), trimesh.creation.box(extents=(1, 1, 1))
+    forward, backward = error_field(outer, inner), error_field(inner, outer)
+
+    assert np.isclose(forward.statistics['mean_distance'], 0.5)
+    assert np.isclose(backward.statistics['mean_distance'], np.sqrt(3) * 0.5)
+    for statistic in ('chamfer', 'hausdorff'):
+        assert np.isclose(forward.statistics[statistic], backward.statistics[statistic])
+    assert np.isclose(forward.statistics['chamfer'], 0.5 + np.sqrt(3) * 0.5)
+
+def test_one_sided_error_field():
+    field = error_field(trimesh.creation.box(extents=(2, 2, 2)), trimesh.creation.box(extents=(1, 1, 1)), symmetric=False)
+    assert 'chamfer' not in field.statistics and 'hausdorff' not in field.statistics
+    assert np.isclose(field.statistics['max_distance'], 0.5)
+    assert field.distances.shape == (8,)
+
+def _brute_force(mesh, points):
+    triangles = np.asarray(mesh.triangles)
+    closest = closest_points_on_triangles(points[:, None, :], triangles[None, :, 0], triangles[None, :, 1], triangles[None, :, 2])
+    return np.linalg.norm(closest - points[:, None, :], axis=2).min(axis=1)
+
+def test_surface_distance_to_a_large_triangle():
+    # one 200 unit triangle with 40 small ones nearby: neither its centroid nor its corners are close to the query
+    large = np.array([[-100, -100, 0], [100, -100, 0], [0, 100, 0]], dtype=float)
+    offsets = np.stack(np.meshgrid(np.arange(8), np.arange(5), indexing='ij'), axis=-1).reshape(-1, 2)
+    small = np.array([[0, 0, 0], [1, 0, 0], [0, 1, 0]], dtype=float)[None] + np.column_stack([offsets * 2 - [20, 45], np.full(len(offsets), 41.0)])[:, None, :]
+    triangles = np.concatenate([large[None], small])
+    mesh = trimesh.Trimesh(vertices=triangles.reshape(-1, 3), faces=np.arange(triangles.size // 3).reshape(-1, 3), process=False)
+
+    distances, closest = SurfaceIndex(mesh).query(np.array([[0.0, -40.0, 0.5]]))
+    assert np.isclose(distances[0], 0.5) and np.allclose(closest[0], [0, -40, 0])
+
+def test_surface_distances_match_brute_force():
+    rng = np.random.default_rng(0)
+    mesh = trimesh.creation.icosphere(subdivisions=3)
+    # a few very large and very small triangles among the regular ones
+    mesh = trimesh.util.concatenate([mesh, trimesh.creation.box(extents=(10, 10, 0.01)), trimesh.creation.icosphere(1, radius=0.01)])
+    points = rng.uniform(-3, 3, size=(500, 3))
+    for candidates in (1, 4, 16):
+        distances, closest = SurfaceIndex(mesh, candidates).query(points, chunk_size=128)
+        assert np.allclose(distances, _brute_force(mesh, points))
+        assert np.allclose(np.linalg.norm(closest - points, axis=1), distances)
+
+def _dense_sinkhorn(a, b, eps, max_iterations=1000, tolerance=1e-6):
+    """Log-domain Sinkhorn over the full cost matrix"""
+    from scipy.special import logsumexp
+    cost = np.linalg.norm(a[:, None] - b[None, :], axis=2)
+    log_a, log_b = -np.log(a.shape[0]), -np.log(b.shape[0])
+    f, g = np.zeros(a.shape[0]), np.zeros(b.shape[0])
+    for _ in range(max_iterations):
+        previous = f
+        f = -eps * logsumexp((g[None, :] + eps * log_b - cost) / eps, axis=1)
+        g = -eps * logsumexp((f[:, None] + eps * log_a - cost) / eps, axis=0)
+        if np.max(np.abs(f - previous)) < tolerance:
+            break
+    return np.sum(np.exp((f[:, None] + g[None, :] - cost) / eps + log_a + log_b) * cost)
+
+@pytest.mark.parametrize('tile_size', [64, 97, 300, 1000])
+def test_tiled_sinkhorn_matches_dense(tile_size):
+    rng = np.random.default_rng(0)
+    a, b = rng.uniform(size=(300, 3)), rng.normal(0.5, 0.2, size=(250, 3))
+    assert sinkhorn_points(a, b, eps=0.05, tile_size=tile_size) == pytest.approx(_dense_sinkhorn(a, b, 0.05), rel=1e-9)
+
+def test_sliced_wasserstein():
+    points = np.random.default_rng(0).normal(size=(200, 3))
+    translation = np.array([0.3, -0.2, 0.5])
+    assert sliced_wasserstein_points(points, points) == 0
+    assert sliced_wasserstein_points(points, points + translation, projections=2048) == pytest.approx(np.linalg.norm(translation), rel=0.05)
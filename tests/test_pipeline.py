@@ -0,0 +1,34 @@
+import time
+import math
+import pytest
+
+from multiprocessing import Pool, active_children
+
+# utils.metrics imports point_cloud_utils for its chamfer / hausdorff metrics
+pytest.importorskip('point_cloud_utils')
+import pipeline
+from pipeline import Pipeline, _execute, _terminate
+
+
+def _sleep(params: dict) -> tuple:
+    time.sleep(params['seconds'])
+    return (params['seconds'], None, params['seconds'], None)
+
+def test_deadline_abandons_and_stops_running_trials(monkeypatch):
+    monkeypatch.setattr(pipeline, '_run_trial', _sleep)
+    pool = Pool(processes=2)
+    state = {'best': math.inf, 'stale': 0, 'stop': False}
+    try:
+        results, abandoned = _execute(pool, [{'seconds': 0.1}, {'seconds': 60}, {'seconds': 0.1}], 2, time.perf_counter() + 2, None, None, state)
+    finally:
+        _terminate(pool)
+
+    # the short trials finish, the long one is abandoned at the deadline and its worker terminated
+    assert results[0][0] == 0.1 and results[2][0] == 0.1
+    assert list(abandoned) == [1] and abandoned[1] >= 1
+    assert not active_children()
+
+def test_grid_search_rejects_trials():
+    pipeline = Pipeline('search', '', {'nonrigid_registration': {'max_iterations': 10}})
+    with pytest.raises(ValueError, match='grid'):
+        pipeline._hyperparamter_search(None, None, {'lambda': [1, 2]}, strategy='grid', trials=8)
@@ -0,0 +1,94 @@
+import uuid
+import pytest
+import trimesh
+import numpy as np
+
+from pathlib import Path
+from dataclasses import replace
+from scipy.spatial.transform import Rotation
+
+from config import get_registry
+from tissue import TissueBlockSet
+from utils.io import read_json
+from organ import Organ
+from dataclass import MeshReference, Projection, Transform
+
+RESULTS = Path(__file__).parent.parent.joinpath('results', 'Projections')
+JSONLD = Path(__file__).parent.parent.joinpath('data', 'Millitome', 'Generic Ovary', 'Female', 'Left', 'rui_locations.jsonld')
+
+
+@pytest.mark.parametrize('path', sorted(RESULTS.glob('*/*-*')), ids=lambda path: path.name[:40])
+def test_load_legacy_pickle_directory(path):
+    projection = Projection.load(path)
+    assert isinstance(projection, Projection)
+
+    # the compiled chain runs on the old transforms
+    vertices = np.asarray(projection.source.vertices)
+    projected = projection.project_array(vertices)
+    assert projected.shape == vertices.shape and np.isfinite(projected).all()
+
+def _synthetic(corners: np.ndarray) -> Projection:
+    """A rigid + nearest-neighbour DVF projection over the region of the blocks, as the pipeline builds them"""
+    rng = np.random.default_rng(0)
+    lower, upper = corners.min(axis=(0, 1)) - 0.01, corners.max(axis=(0, 1)) + 0.01
+    control_points = rng.uniform(lower, upper, size=(20000, 3))
+    dvf = 2e-4 * np.sin(control_points / 0.01)
+    rotation = Rotation.from_euler('xyz', (3, -2, 4), degrees=True).as_matrix()
+    transformations = [('rigid', Transform(scale=(1.05, 1.05, 1.05), rotate=(5, 0, -5), translate=(1e-3, 0, -2e-3))), 
+                       ('nonrigid', Transform(scale=0.98, rotate=rotation, translate=np.array([0, 1e-3, 0]), 
+                                              deformation_vector_field=dvf, control_points=control_points))]
+    source = trimesh.Trimesh(vertices=control_points[:1000], faces=np.zeros((0, 3), dtype=int), process=False)
+    registration = trimesh.Trimesh(vertices=control_points[1000:2000], faces=np.zeros((0, 3), dtype=int), process=False)
+    return Projection(id=uuid.uuid4(), description='synthetic', source=source, target=registration, 
+                      transformations=transformations, registration=registration, params={})
+
+def test_inverse_round_trip(tmp_path):
+    blocks = TissueBlockSet.from_jsonld(JSONLD)
+    forward = _synthetic(blocks.corners)
+    backward = forward.inverse()
+
+    # a new projection, not a copy of the forward one
+    assert backward.id != forward.id and backward.inverted and not forward.inverted
+    assert str(forward.id) in backward.description and 'derived' in backward.description
+    # exact but where the nearest-neighbour field leaves a gap (no preimage) between the cells of its control points
+    assert backward.round_trip_error['median'] < 1e-12 and backward.round_trip_error['max'] < 1e-3
+
+    # RUI placements projected forward and the result projected backward land where they were placed
+    placement = get_registry().target_transform(blocks.target_names[0], 1e3)
+    placed = placement(blocks.array)
+    projected = blocks.project(forward)
+    returned = projected.with_corners(placement.invert(projected.array).reshape(blocks.corners.shape)).project(backward)
+    distances = np.linalg.norm(returned.array - placed, axis=1)
+    assert np.median(distances) < 1e-12 and distances.max() < 1e-3
+
+    # blocks end in the same frame whichever way they are projected
+    assert np.allclose(backward.project(blocks[0]).vertices, blocks.project(backward).corners[0])
+    assert np.allclose(backward.project_many([blocks[1]])[0].vertices, blocks.project(backward).corners[1])
+
+    # only inverted projections need the newer format
+    forward.export(str(tmp_path / 'forward'))
+    backward.export(str(tmp_path / 'backward'))
+    assert read_json(tmp_path / f'forward-{forward.id}' / 'projection.json')['version'] == 1
+    assert read_json(tmp_path / f'backward-{backward.id}' / 'projection.json')['version'] == 2
+
+    loaded = Projection.load(tmp_path / f'backward-{backward.id}')
+    assert loaded.inverted and loaded.id == str(backward.id) and loaded.round_trip_error == backward.round_trip_error
+    assert np.allclose(loaded.project_array(blocks.array), backward.project_array(blocks.array))
+
+def test_mesh_reference_checks_the_mesh(tmp_path, monkeypatch):
+    monkeypatch.setattr('utils.cache.CACHE_DIR', tmp_path / 'cache')
+    path = tmp_path / 'sphere.glb'
+    trimesh.creation.icosphere(2).export(path)
+    reference = MeshReference.from_mesh(Organ(str(path)))
+    assert np.allclose(reference.load().vertices, trimesh.creation.icosphere(2).vertices)
+
+    # another mesh at the same path
+    trimesh.creation.icosphere(3).export(path)
+    with pytest.raises(ValueError, match='sha256'):
+        reference.load()
+
+    path.unlink()
+    with pytest.raises(FileNotFoundError):
+        reference.load()
+    with pytest.raises(ValueError, match='without a path'):
+        replace(reference, path=None).load()
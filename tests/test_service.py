@@ -0,0 +1,79 @@
+import json
+import threading
+import numpy as np
+import pytest
+
+from pathlib import Path
+from http.client import HTTPConnection
+from urllib.error import HTTPError
+
+from client import ProjectionClient
+from service import ProjectionService, serve
+from tissue import TissueBlockSet
+from utils.io import read_json
+
+# legacy <name>-<uuid>/projections.pickle directories
+FORWARD = Path(__file__).parent.parent.joinpath('results', 'Projections', 'Forward')
+JSONLD = Path(__file__).parent.parent.joinpath('data', 'Millitome', 'Generic Ovary', 'Female', 'Left', 'rui_locations.jsonld')
+
+
+@pytest.fixture(scope='module')
+def service():
+    return ProjectionService.from_directory(FORWARD, workers=2)
+
+@pytest.fixture(scope='module')
+def client(service):
+    server = serve(service, port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield ProjectionClient(f'http://127.0.0.1:{server.server_address[1]}')
+    server.shutdown()
+    server.server_close()
+
+def test_from_directory_loads_legacy_directories(service):
+    assert sorted(service.projections) == sorted(path.name for path in FORWARD.iterdir())
+
+def test_vertices(service, client):
+    name = next(iter(service.projections))
+    vertices = np.asarray(service.projections[name].source.vertices)[:100]
+    expected = service.projections[name].project_array(vertices)
+
+    assert np.allclose(client._json(f'/projections/{name}/vertices', {'vertices': vertices.tolist()})['vertices'], expected)
+    assert np.allclose(client.project(name, vertices), expected)
+
+def test_blocks(service, client):
+    name = next(iter(service.projections))
+    samples = [sample for donor in read_json(JSONLD)['@graph'] for sample in donor['samples']][:10]
+    locations = client.project_samples(name, samples)
+    assert locations == TissueBlockSet.from_samples(samples, {}).project(service.projections[name]).to_locations()
+
+def test_batch_reports_errors_per_item(service, client):
+    name = next(iter(service.projections))
+    results = client.batch([{'projection': name, 'vertices': np.zeros((2, 3))}, 
+                            {'projection': 'missing', 'vertices': np.zeros((2, 3))}, 
+                            {'projection': name, 'vertices': np.zeros((2, 2))}])
+    assert np.allclose(results[0]['vertices'], service.projections[name].project_array(np.zeros((2, 3))))
+    assert 'missing' in results[1]['error'] and 'shape' in results[2]['error']
+
+def test_unknown_projection(client):
+    with pytest.raises(HTTPError) as error:
+        client.project('missing', np.zeros((1, 3)))
+    assert error.value.code == 404
+
+def test_unknown_route_keeps_the_connection_usable(client):
+    connection = HTTPConnection(client.url.split('//')[1])
+    connection.request('POST', '/unknown', body=json.dumps({'vertices': [[0, 0, 0]]}), headers={'Content-Type': 'application/json'})
+    response = connection.getresponse()
+    assert response.status == 404 and 'not found' in json.loads(response.read())['error']
+
+    # the next request on the same keep-alive connection
+    connection.request('GET', '/projections')
+    response = connection.getresponse()
+    assert response.status == 200 and json.loads(response.read())
+    connection.close()
+
+def test_metrics(client):
+    client.projections()
+    metrics = client.metrics()
+    assert metrics['projections']['count'] >= 1 and metrics['projections']['errors'] == 0
+    assert metrics['projections']['p50_ms'] <= metrics['projections']['max_ms']
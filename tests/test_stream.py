@@ -0,0 +1,40 @@
+import json
+import shutil
+import numpy as np
+
+from pathlib import Path
+
+from dataclass import Projection
+from tissue import TissueBlockSet
+from stream import stream
+
+# a legacy <name>-<uuid>/projections.pickle directory
+PROJECTION = next(Path(__file__).parent.parent.joinpath('results', 'Projections', 'Forward').glob('GenericOvary_Left-*'))
+LEFT = Path(__file__).parent.parent.joinpath('data', 'Millitome', 'Generic Ovary', 'Female', 'Left')
+
+
+def test_stream_jsonld_with_a_legacy_projection(tmp_path):
+    output = tmp_path / 'projected.jsonl'
+    count = stream(LEFT / 'rui_locations.jsonld', PROJECTION, output, chunk_size=8, workers=2, jsonl=True)
+
+    expected = TissueBlockSet.from_jsonld(LEFT / 'rui_locations.jsonld').project(Projection.load(PROJECTION)).to_locations()
+    locations = [json.loads(line)['rui_location'] for line in output.read_text().splitlines()]
+    assert count == len(expected) == len(locations)
+    assert np.allclose([location['placement']['x_translation'] for location in locations], 
+                       [location['placement']['x_translation'] for location in expected])
+
+def test_stream_registrations_in_place(tmp_path):
+    registrations = tmp_path / 'Left'
+    shutil.copytree(LEFT, registrations)
+    manifest = (registrations / 'registrations.yaml').read_text()
+    expected = TissueBlockSet.from_registrations(registrations).project(Projection.load(PROJECTION)).to_locations()
+
+    # the output is the source directory, its registrations.yaml is left as it is
+    count = stream(registrations, PROJECTION, registrations, chunk_size=8, workers=2)
+    assert count == len(expected)
+    assert (registrations / 'registrations.yaml').read_text() == manifest
+
+    projected = {location['@id']: location for location in map(json.loads, map(Path.read_text, (registrations / 'registrations').glob('*.json')))}
+    for location in expected:
+        assert np.allclose([projected[location['@id']]['placement'][f'{axis}_translation'] for axis in 'xyz'], 
+                           [location['placement'][f'{axis}_translation'] for axis in 'xyz'])
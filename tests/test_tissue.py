@@ -0,0 +1,34 @@
+import json
+import numpy as np
+
+from pathlib import Path
+
+from tissue import TissueBlockSet
+
+JSONLD = Path(__file__).parent.parent.joinpath('data', 'Millitome', 'Generic Pancreas', 'Male', 'rui_locations.jsonld')
+
+
+def _samples(count: int = 6) -> list[dict]:
+    graph = json.loads(JSONLD.read_text())['@graph']
+    return [sample for donor in graph for sample in donor['samples'] if 'rui_location' in sample][:count]
+
+def test_oriented_boxes_of_rotated_cubes():
+    samples = _samples()
+    for sample in samples:
+        location = sample['rui_location']
+        location.update(x_dimension=10, y_dimension=10, z_dimension=10)
+        location['placement'].update(x_rotation=30, y_rotation=-20, z_rotation=45)
+    blocks = TissueBlockSet.from_samples(samples, {})
+    extents, transforms = blocks.boxes(oriented=True)
+
+    # a cube fits itself: same size and the axes of its placement
+    assert np.allclose(extents, 10 / blocks.division_factors[:, None])
+    rotation = blocks.placements[:, :3, :3] / np.linalg.norm(blocks.placements[:, :3, :3], axis=1, keepdims=True)
+    assert np.allclose(transforms[:, :3, :3], rotation)
+    assert np.allclose(transforms[:, :3, 3], blocks.corners.mean(axis=1))
+
+def test_to_samples_names_unlabelled_blocks_by_index(tmp_path):
+    blocks = TissueBlockSet.from_samples(_samples(3), {})
+    blocks.labels[:] = None
+    blocks.to_samples(tmp_path)
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['0.json', '1.json', '2.json']